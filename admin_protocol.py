@@ -0,0 +1,126 @@
+# admin_protocol.py
+
+import asyncio
+import copy
+import os
+from typing import List, Dict, Any, Callable, Awaitable, Optional, Set, Union
+
+from structured_log import get_logger
+
+log = get_logger("Admin Channel")
+
+# --- Configuration ---
+ADMIN_FLUSH_MS = float(os.getenv("ADMIN_FLUSH_MS", "50"))
+
+Path = List[Union[str, int]]
+
+
+def _resolve(state: Any, path: Path) -> Any:
+    for key in path:
+        state = state[key]
+    return state
+
+
+def _covers(prefix: Path, path: Path) -> bool:
+    return len(prefix) <= len(path) and path[:len(prefix)] == prefix
+
+
+class AdminUpdateChannel:
+    """
+    Keeps the server-side copy of the admin panel state for one WebSocket and sends it as deltas.
+
+    Changes are recorded as ops and flushed together at most every flush_interval_ms as
+    {"type": "admin_patch", "data": {"seq": n, "ops": [...]}}. Ops (applied in order by static/script.js):
+      {"op": "reset", "value": {...}}               replace the whole state
+      {"op": "set", "path": [...], "value": ...}    set a key / list index
+      {"op": "append", "path": [...], "value": ...} append to a list
+    seq increases by one per message; a client that sees a gap sends {"type": "admin_resync"} and gets a reset.
+    """
+
+    def __init__(self, send: Callable[[Dict[str, Any]], Awaitable[None]], flush_interval_ms: float = ADMIN_FLUSH_MS):
+        self._send = send
+        self.flush_interval = max(0.0, flush_interval_ms) / 1000
+        self.state: Dict[str, Any] = {}
+        self.seq = 0
+        self._pending: List[Dict[str, Any]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flush_tasks: Set[asyncio.Task] = set() # Held so the loop can't collect them; cancelled by close()
+        self._lock = asyncio.Lock()
+        self.messages_sent = 0
+        self.ops_recorded = 0
+        self.ops_sent = 0
+
+    # --- Recording ---
+    def _record(self, op: Dict[str, Any]):
+        self.ops_recorded += 1
+        if op["op"] == "reset":
+            self._pending = [op] # Supersedes everything still pending
+        elif op["op"] == "set":
+            # A set overwrites earlier pending changes at or below its path
+            self._pending = [p for p in self._pending if p["op"] == "reset" or not _covers(op["path"], p["path"])]
+            self._pending.append(op)
+        else:
+            self._pending.append(op)
+        self._schedule()
+
+    def reset(self, state: Dict[str, Any]):
+        self.state = copy.deepcopy(state)
+        self._record({"op": "reset", "value": copy.deepcopy(state)})
+
+    def set(self, path: Path, value: Any):
+        _resolve(self.state, path[:-1])[path[-1]] = copy.deepcopy(value)
+        self._record({"op": "set", "path": list(path), "value": copy.deepcopy(value)})
+
+    def append(self, path: Path, value: Any):
+        _resolve(self.state, path).append(copy.deepcopy(value))
+        self._record({"op": "append", "path": list(path), "value": copy.deepcopy(value)})
+
+    def get(self, path: Path) -> Any:
+        return _resolve(self.state, path)
+
+    def resync(self):
+        """Queues a full snapshot (after a client reports a sequence gap)."""
+        self._record({"op": "reset", "value": copy.deepcopy(self.state)})
+
+    # --- Flushing ---
+    def _schedule(self):
+        if self._timer is None:
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_later(self.flush_interval, self._start_timer_flush)
+
+    def _start_timer_flush(self):
+        task = asyncio.get_running_loop().create_task(self._flush_from_timer())
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def _flush_from_timer(self):
+        try:
+            await self.flush()
+        except Exception as e:
+            log.warning(f"Flush failed ({e}).")
+
+    async def flush(self):
+        """Sends pending ops now (also called at the end of each turn)."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        async with self._lock:
+            if not self._pending:
+                return
+            ops, self._pending = self._pending, []
+            self.seq += 1
+            self.messages_sent += 1
+            self.ops_sent += len(ops)
+            await self._send({"type": "admin_patch", "data": {"seq": self.seq, "ops": ops}})
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        for task in list(self._flush_tasks):
+            task.cancel()
+        self._flush_tasks.clear()
+        self._pending = []
+
+    def stats(self) -> Dict[str, int]:
+        return {"messages_sent": self.messages_sent, "ops_recorded": self.ops_recorded, "ops_sent": self.ops_sent}
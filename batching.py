@@ -0,0 +1,102 @@
+# batching.py
+
+import asyncio
+import os
+import time
+from typing import List, Any, Callable, Awaitable, Dict, Optional, Tuple
+
+# --- Configuration ---
+MICRO_BATCHING = os.getenv("MICRO_BATCHING", "1") == "1"
+MICRO_BATCH_MAX = int(os.getenv("MICRO_BATCH_MAX", "64"))
+MICRO_BATCH_WAIT_MS = float(os.getenv("MICRO_BATCH_WAIT_MS", "2"))
+
+
+class MicroBatcher:
+    """
+    Collects items submitted by concurrent callers and processes them as one batch.
+    A batch is flushed when it reaches max_batch_size or max_wait_ms after its first item arrived.
+    While a batch is being processed, new arrivals queue up and form the next batch, so batches
+    grow with load. process_batch receives the list of items and must return one result per item.
+    """
+
+    def __init__(
+        self,
+        process_batch: Callable[[List[Any]], Awaitable[List[Any]]],
+        max_batch_size: int = MICRO_BATCH_MAX,
+        max_wait_ms: float = MICRO_BATCH_WAIT_MS,
+        name: str = "batcher"
+    ):
+        self.process_batch = process_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self.name = name
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._loop = None
+        self.batches = 0
+        self.items = 0
+        self.largest_batch = 0
+        self.total_queue_wait = 0.0
+
+    def _ensure_worker(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._worker is None or self._worker.done():
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+
+    async def submit(self, item: Any) -> Any:
+        """Queues one item and waits for its result from the next batch."""
+        self._ensure_worker()
+        future = self._loop.create_future()
+        self._queue.put_nowait((item, future, time.perf_counter()))
+        return await future
+
+    async def _collect(self) -> List[Tuple[Any, asyncio.Future, float]]:
+        batch = [await self._queue.get()]
+        deadline = self._loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            remaining = deadline - self._loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            batch = [entry for entry in batch if not entry[1].cancelled()] # Callers that gave up
+            if not batch:
+                continue
+            started = time.perf_counter()
+            self.batches += 1
+            self.items += len(batch)
+            self.largest_batch = max(self.largest_batch, len(batch))
+            self.total_queue_wait += sum(started - queued_at for _, _, queued_at in batch)
+            try:
+                results = await self.process_batch([item for item, _, _ in batch])
+                if len(results) != len(batch):
+                    raise RuntimeError(f"{self.name}: process_batch returned {len(results)} results for {len(batch)} items")
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": self.items / self.batches if self.batches else 0.0,
+            "largest_batch": self.largest_batch,
+            "avg_queue_wait_ms": 1000 * self.total_queue_wait / self.items if self.items else 0.0
+        }
@@ -0,0 +1,145 @@
+# benchmarks/fused_bench.py
+"""
+Latency and token cost of the fused single-call pipeline vs. the three-phase pipeline.
+
+Replays every turn of benchmarks/corpus/conversations.jsonl twice, on recorded LLM streams:
+  three_phase  plan -> retrieve -> synthesize for every turn (pipeline_bench.run_turn_direct)
+  fused        helper2.process_fused_query for turns routed to a FUSED_TOOLS tool, three-phase otherwise
+
+Counts LLM calls and estimated input/output tokens per turn, and reports turn latency, both for
+all turns and for the fused-eligible ones.
+
+    python benchmarks/fused_bench.py --tools legal_compliance_retrieval,user_data_query --speed 4
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from collections import defaultdict
+from typing import List, Dict, Any
+
+from pipeline_bench import (
+    DEFAULT_CONVERSATIONS, DEFAULT_STREAMS, RETRIEVAL_TOP_K, StageTimings, summarize, load_conversations,
+    run_turn_direct, git_revision
+)
+import llm_backends
+import helper2 as hlp
+from history import estimate_tokens
+from session_store import SessionState
+
+
+class CountingBackend(llm_backends.LLMBackend):
+    """Counts calls and estimated tokens per stage for the turn in progress."""
+    name = "counting"
+
+    def __init__(self, inner: llm_backends.LLMBackend):
+        self.inner = inner
+        self.turn = defaultdict(float)
+
+    async def stream_text(self, prompt, model_name, temperature, static_prefix=None):
+        self.turn["llm_calls"] += 1
+        self.turn["input_tokens"] += estimate_tokens(prompt)
+        async for text in self.inner.stream_text(prompt, model_name=model_name, temperature=temperature, static_prefix=static_prefix):
+            self.turn["output_tokens"] += estimate_tokens(text)
+            yield text
+
+    def take(self) -> Dict[str, float]:
+        counts, self.turn = dict(self.turn), defaultdict(float)
+        return counts
+
+
+async def run_turn_fused(session: SessionState, query: str, tool_name: str, static_sections) -> bool:
+    """One fused turn; returns False if it fell back (the caller then runs the three-phase turn)."""
+    answer = None
+    async for item in hlp.process_fused_query(
+        new_user_query=query,
+        message_history=session.chat_history,
+        user_context=hlp.user_context,
+        business_summary=hlp.business_summary,
+        available_tools=hlp.available_tools,
+        tool_name=tool_name,
+        top_k=RETRIEVAL_TOP_K,
+        static_sections=static_sections
+    ):
+        if item["type"] == "fused_fallback" and answer is None:
+            return False
+        if item["type"] == "final_response_text":
+            answer = item["data"]
+        elif item["type"] == "error":
+            raise RuntimeError(f"Fused error: {item['data']}")
+    session.chat_history.append({"role": "user", "content": query})
+    session.chat_history.append({"role": "assistant", "content": answer or ""})
+    return True
+
+
+async def bench_mode(mode: str, conversations: List[Dict[str, Any]], counter: CountingBackend, static_sections) -> Dict[str, Any]:
+    rows = []
+    fallbacks = 0
+    for conversation in conversations:
+        session = SessionState(f"fused-bench-{mode}-{conversation['id']}")
+        for query in conversation["turns"]:
+            tool_name = hlp.select_fused_tool(query, session.chat_history, hlp.available_tools, session.sticky_hint)
+            counter.take()
+            started = time.perf_counter()
+            answered = False
+            if mode == "fused" and tool_name:
+                answered = await run_turn_fused(session, query, tool_name, static_sections)
+                fallbacks += not answered
+            if not answered:
+                await run_turn_direct(session, query, StageTimings(), static_sections)
+            rows.append({"eligible": bool(tool_name), "seconds": time.perf_counter() - started, **counter.take()})
+
+    def report(selected: List[Dict[str, Any]]) -> Dict[str, Any]:
+        turns = len(selected) or 1
+        return {
+            "turns": len(selected),
+            "turn_latency": summarize([row["seconds"] for row in selected]),
+            "llm_calls_per_turn": round(sum(row.get("llm_calls", 0) for row in selected) / turns, 2),
+            "input_tokens_per_turn": round(sum(row.get("input_tokens", 0) for row in selected) / turns, 1),
+            "output_tokens_per_turn": round(sum(row.get("output_tokens", 0) for row in selected) / turns, 1)
+        }
+
+    return {"all": report(rows), "eligible": report([row for row in rows if row["eligible"]]), "fallbacks": fallbacks}
+
+
+async def run(args):
+    hlp.FUSED_TOOLS.clear()
+    hlp.FUSED_TOOLS.update(name.strip() for name in args.tools.split(",") if name.strip())
+    inner = llm_backends.ReplayBackend(args.streams, speed=args.speed) if args.backend == "replay" else llm_backends.create_backend(args.backend)
+    counter = CountingBackend(inner)
+    llm_backends.set_backend(counter)
+    conversations = load_conversations(args.conversations)
+    static_sections = hlp.get_static_sections(hlp.user_context, hlp.business_summary, hlp.available_tools)
+
+    results = {"meta": {"revision": git_revision(), "backend": args.backend, "speed": args.speed, "fused_tools": sorted(hlp.FUSED_TOOLS)}}
+    # Fresh retrieval cache state per mode so neither benefits from the other's cached results
+    for mode in ("three_phase", "fused"):
+        if hlp.retrieval_cache is not None:
+            hlp.retrieval_cache.clear()
+        results[mode] = await bench_mode(mode, conversations, counter, static_sections)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+    base, fused = results["three_phase"]["eligible"], results["fused"]["eligible"]
+    print(f"Bench: {fused['turns']} fused-eligible turns: p50 {base['turn_latency']['p50_ms']} -> {fused['turn_latency']['p50_ms']} ms, "
+          f"LLM calls {base['llm_calls_per_turn']} -> {fused['llm_calls_per_turn']}, "
+          f"input tokens {base['input_tokens_per_turn']} -> {fused['input_tokens_per_turn']} per turn")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tools", default=",".join(tool["name"] for tool in hlp.available_tools), help="Comma-separated FUSED_TOOLS for the fused run")
+    parser.add_argument("--backend", default="replay", help="replay (recorded streams), fake or gemini")
+    parser.add_argument("--streams", default=DEFAULT_STREAMS)
+    parser.add_argument("--speed", type=float, default=4.0, help="Replay speed-up factor")
+    parser.add_argument("--conversations", default=DEFAULT_CONVERSATIONS)
+    parser.add_argument("--output", default=None, help="Write results JSON here")
+    asyncio.run(run(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()
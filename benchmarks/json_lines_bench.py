@@ -0,0 +1,150 @@
+# benchmarks/json_lines_bench.py
+"""
+Microbenchmark for the LLM stream parsing and frame encoding paths.
+
+Compares the original buffer handling in helper2._execute_llm_json_lines
+(buffer += chunk; buffer.split('\\n', 1); json.loads) with json_stream.JsonLinesSplitter +
+fast_json.loads, on multi-MB synthetic streams:
+  - "many_lines": lots of short {"thought": ...} lines
+  - "one_long_line": a single huge {"final_response_text": ...} line, also decoded incrementally
+    (IncrementalStringFieldParser.feed on the whole partial line vs feed_delta)
+
+    python benchmarks/json_lines_bench.py --size-mb 2 --chunk-bytes 256
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fast_json
+from json_stream import IncrementalStringFieldParser, JsonLinesSplitter
+
+
+# --- Synthetic Streams ---
+def many_lines_stream(size_bytes: int) -> str:
+    lines = []
+    total = 0
+    i = 0
+    while total < size_bytes:
+        line = json.dumps({"thought": f"Step {i}: checking the user's vendor credits and sales tax settings — \"quoted\" text."})
+        lines.append(line)
+        total += len(line) + 1
+        i += 1
+    lines.append(json.dumps({"final_response_text": "Done.", "citation_map": {}}))
+    return "\n".join(lines) + "\n"
+
+
+def one_long_line_stream(size_bytes: int) -> str:
+    sentence = "Reconcile your bank account monthly — compare each \"cleared\" transaction.\n "
+    text = sentence * (size_bytes // len(sentence) + 1)
+    return json.dumps({"thought": "Composing the answer."}) + "\n" + json.dumps({"final_response_text": text}) + "\n"
+
+
+def chunked(stream: str, chunk_bytes: int):
+    return [stream[i:i + chunk_bytes] for i in range(0, len(stream), chunk_bytes)]
+
+
+# --- Parsers ---
+def legacy_parse(chunks, stream_key=None):
+    buffer = ""
+    parsed = 0
+    streamer = IncrementalStringFieldParser([stream_key]) if stream_key else None
+    for chunk in chunks:
+        buffer += chunk
+        while '\n' in buffer:
+            line, buffer = buffer.split('\n', 1)
+            line = line.strip()
+            if streamer:
+                streamer.reset()
+            if line.startswith('{') and line.endswith('}'):
+                json.loads(line)
+                parsed += 1
+        if streamer and buffer:
+            streamer.feed(buffer)
+    return parsed
+
+
+def splitter_parse(chunks, stream_key=None):
+    splitter = JsonLinesSplitter()
+    parsed = 0
+    streamer = IncrementalStringFieldParser([stream_key]) if stream_key else None
+    for chunk in chunks:
+        lines = splitter.feed(chunk)
+        for line in lines:
+            line = line.strip()
+            if line.startswith('{') and line.endswith('}'):
+                fast_json.loads(line)
+                parsed += 1
+        if streamer:
+            if lines:
+                streamer.reset()
+                chunk = chunk[chunk.rfind('\n') + 1:]
+            streamer.feed_delta(chunk)
+    return parsed
+
+
+def time_it(fn, *args, repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def frame_encode_bench(iterations: int = 2000):
+    frame = {
+        "type": "admin_patch",
+        "data": {"seq": 1, "ops": [{"op": "set", "path": ["function_calls_made", 0, "raw_result"], "value": {
+            "function_name": "general_product_support_retrieval",
+            "retrieved_chunks": [{"chunk_content": "To reconcile an account, go to Settings > Reconcile. " * 8, "source_article": f"Article {i}", "source_link": f"https://quickbooks.intuit.com/learn-support/{i}"} for i in range(5)],
+            "present_as_is": False, "rejected": False, "error": None
+        }}]}
+    }
+    encoder = json.JSONEncoder()
+    stdlib = time_it(lambda: [encoder.encode(frame) for _ in range(iterations)])
+    fast = time_it(lambda: [fast_json.dumps(frame) for _ in range(iterations)])
+    return {"frames": iterations, "json_seconds": round(stdlib, 4), "fast_json_seconds": round(fast, 4), "fast_json_backend": fast_json.JSON_BACKEND}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=float, default=2.0)
+    parser.add_argument("--chunk-bytes", type=int, default=256)
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args(argv)
+    size = int(args.size_mb * 1024 * 1024)
+
+    results = {"size_mb": args.size_mb, "chunk_bytes": args.chunk_bytes, "streams": {}}
+    for name, stream, stream_key in (
+        ("many_lines", many_lines_stream(size), None),
+        ("one_long_line", one_long_line_stream(size), "final_response_text"),
+    ):
+        chunks = chunked(stream, args.chunk_bytes)
+        assert legacy_parse(chunks, stream_key) == splitter_parse(chunks, stream_key)
+        legacy = time_it(legacy_parse, chunks, stream_key)
+        linear = time_it(splitter_parse, chunks, stream_key)
+        megabytes = len(stream) / (1024 * 1024)
+        results["streams"][name] = {
+            "legacy_mb_per_s": round(megabytes / legacy, 1),
+            "splitter_mb_per_s": round(megabytes / linear, 1),
+            "speedup": round(legacy / linear, 1)
+        }
+    results["frame_encoding"] = frame_encode_bench()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"Stream size {args.size_mb} MB, chunks of {args.chunk_bytes} bytes, parser backend: {fast_json.JSON_BACKEND}")
+    for name, row in results["streams"].items():
+        print(f"  {name:<14} legacy {row['legacy_mb_per_s']:>8} MB/s   splitter {row['splitter_mb_per_s']:>8} MB/s   x{row['speedup']}")
+    enc = results["frame_encoding"]
+    print(f"  frame encoding ({enc['frames']} frames): json {enc['json_seconds']}s   fast_json ({enc['fast_json_backend']}) {enc['fast_json_seconds']}s")
+
+
+if __name__ == "__main__":
+    main()
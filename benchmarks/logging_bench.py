@@ -0,0 +1,123 @@
+# benchmarks/logging_bench.py
+"""
+Event-loop lag with logging off, synchronous and queue-backed (structured_log.py).
+
+Each mode runs the direct replay pipeline (pipeline_bench.bench_direct) in a child process whose
+stdout is a pipe drained by a deliberately slow reader, like a log collector falling behind:
+
+  off    LOG_LEVEL=OFF
+  sync   LOG_ASYNC=0: the event loop writes each record to stdout itself and blocks when the pipe is full
+  async  LOG_ASYNC=1: records go through the bounded queue to the writer thread
+
+Reports event-loop lag, turn latency and turns/sec per mode, plus the logging stats (written, dropped, sampled out).
+
+    python benchmarks/logging_bench.py --clients 32 --speed 8 --sink-kbps 64 --level DEBUG
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+if "--child" not in sys.argv:
+    os.environ["LOG_LEVEL"] = "OFF" # The parent only reports; keep its stdout to the results JSON
+
+from pipeline_bench import ROOT, DEFAULT_CONVERSATIONS, DEFAULT_STREAMS, load_conversations, git_revision
+
+MODES = {
+    "off": {"LOG_LEVEL": "OFF"},
+    "sync": {"LOG_ASYNC": "0"},
+    "async": {"LOG_ASYNC": "1"}
+}
+
+
+def drain_slowly(pipe, bytes_per_sec: float, chunk_bytes: int = 4096):
+    """Reads the child's stdout at about bytes_per_sec, discarding it."""
+    while True:
+        data = pipe.read1(chunk_bytes) if hasattr(pipe, "read1") else pipe.read(chunk_bytes)
+        if not data:
+            return
+        time.sleep(len(data) / bytes_per_sec)
+
+
+def run_mode(mode: str, args) -> dict:
+    with tempfile.TemporaryDirectory(prefix="qb-logging-") as tmp:
+        output = os.path.join(tmp, "result.json")
+        env = dict(os.environ)
+        env.update({"LOG_LEVEL": args.level, "LOG_FORMAT": args.format})
+        env.update(MODES[mode])
+        command = [sys.executable, os.path.abspath(__file__), "--child", "--output", output,
+                   "--clients", str(args.clients), "--repeat", str(args.repeat), "--speed", str(args.speed),
+                   "--streams", args.streams, "--conversations", args.conversations]
+        process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        reader = threading.Thread(target=drain_slowly, args=(process.stdout, args.sink_kbps * 1024), daemon=True)
+        reader.start()
+        process.wait()
+        reader.join(timeout=1)
+        if process.returncode != 0:
+            raise SystemExit(f"Bench: '{mode}' child exited with code {process.returncode}.")
+        with open(output, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+
+async def child(args):
+    from pipeline_bench import configure_backend, bench_direct
+    from structured_log import structured_logging
+
+    args.backend = "replay"
+    configure_backend(args)
+    result = await bench_direct(load_conversations(args.conversations), args.clients, args.repeat)
+    # Stats before shutdown: what the loop had handed over when the run ended
+    result["logging"] = structured_logging.stats()
+    structured_logging.shutdown()
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(result, f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=list(MODES))
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--speed", type=float, default=8.0, help="Replay speed-up factor")
+    parser.add_argument("--level", default="INFO", help="LOG_LEVEL for the sync and async modes")
+    parser.add_argument("--format", default="text", choices=["text", "json"])
+    parser.add_argument("--sink-kbps", type=float, default=64.0, help="How fast the reader drains the child's stdout")
+    parser.add_argument("--streams", default=DEFAULT_STREAMS)
+    parser.add_argument("--conversations", default=DEFAULT_CONVERSATIONS)
+    parser.add_argument("--output", default=None, help="Write results JSON here")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.child:
+        asyncio.run(child(args))
+        return
+
+    results = {"meta": {"revision": git_revision(), "clients": args.clients, "repeat": args.repeat, "speed": args.speed,
+                        "level": args.level, "format": args.format, "sink_kbps": args.sink_kbps}}
+    for mode in args.modes:
+        result = run_mode(mode, args)
+        results[mode] = {
+            "turns": result["turns"],
+            "errors": result["errors"],
+            "turns_per_sec": result["turns_per_sec"],
+            "turn_latency": result["stages"].get("turn_total"),
+            "event_loop_lag": result["event_loop_lag"],
+            "logging": result["logging"]
+        }
+        print(f"Bench: {mode}: lag p99 {result['event_loop_lag']['p99_ms']} ms, max {result['event_loop_lag']['max_ms']} ms, "
+              f"{result['turns_per_sec']} turns/sec", file=sys.stderr)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
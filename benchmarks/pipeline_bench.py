@@ -0,0 +1,458 @@
+# benchmarks/pipeline_bench.py
+"""
+Replay benchmark for the three-phase pipeline (plan -> retrieve -> synthesize).
+
+Replays the conversations in benchmarks/corpus/conversations.jsonl against recorded LLM streams
+(benchmarks/corpus/llm_streams.jsonl, ReplayBackend format) so orchestration changes can be
+measured without a provider:
+
+  direct  runs helper2.process_quickbooks_query -> simulate_retrieval_stub -> generate_final_response
+  ws      drives the /ws endpoint with concurrent WebSocket clients (in-process uvicorn, or --url)
+
+Reports turns/sec, p50/p95/p99 per stage, memory per session and event-loop lag as JSON.
+
+    python benchmarks/pipeline_bench.py run --mode both --clients 50 --speed 4 --output results.json
+    python benchmarks/pipeline_bench.py compare baseline.json results.json
+    python benchmarks/pipeline_bench.py record --backend gemini   # re-record the LLM streams
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from typing import List, Dict, Any, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("LLM_BACKEND", "replay") # helper2 skips API key setup for local backends
+
+import llm_backends
+import helper2 as hlp
+import fast_json
+from history import history_compactor
+from response_assembly import assemble_response, bypass_stats
+from session_store import InMemorySessionStore, SessionState
+
+CORPUS_DIR = os.path.join(ROOT, "benchmarks", "corpus")
+DEFAULT_CONVERSATIONS = os.path.join(CORPUS_DIR, "conversations.jsonl")
+DEFAULT_STREAMS = os.path.join(CORPUS_DIR, "llm_streams.jsonl")
+RETRIEVAL_TOP_K = 2 # Same as main.RETRIEVAL_TOP_K
+
+
+# --- Measurement Helpers ---
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    """Latency summary in milliseconds."""
+    values = sorted(samples)
+    return {
+        "count": len(values),
+        "mean_ms": round(1000 * sum(values) / len(values), 2) if values else 0.0,
+        "p50_ms": round(1000 * percentile(values, 50), 2),
+        "p95_ms": round(1000 * percentile(values, 95), 2),
+        "p99_ms": round(1000 * percentile(values, 99), 2),
+        "max_ms": round(1000 * values[-1], 2) if values else 0.0
+    }
+
+
+class StageTimings:
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+
+    def add(self, stage: str, seconds: float):
+        self.samples[stage].append(seconds)
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        return {stage: summarize(values) for stage, values in sorted(self.samples.items())}
+
+
+class LoopLagMonitor:
+    """Samples how late a periodic sleep wakes up; a blocked event loop shows up as lag."""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples: List[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - expected))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> Dict[str, float]:
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        return summarize(self.samples)
+
+
+def rss_bytes() -> int:
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # Peak RSS on Linux
+
+
+def load_conversations(path: str) -> List[Dict[str, Any]]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, timeout=10).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+# --- Direct Pipeline ---
+async def _timed(timings: StageTimings, stage: str, coro):
+    started = time.perf_counter()
+    result = await coro
+    timings.add(stage, time.perf_counter() - started)
+    return result
+
+
+async def run_turn_direct(session: SessionState, query: str, timings: StageTimings, static_sections) -> str:
+    """One turn through the same three phases main.websocket_endpoint runs."""
+    turn_started = time.perf_counter()
+    history_window, session.history_summary, session.summarized_upto = await history_compactor.compact(
+        session.chat_history, session.history_summary, session.summarized_upto
+    )
+    sticky_hint, session.sticky_hint = session.sticky_hint, None
+
+    plan_calls, explanation, tasks = None, None, []
+    planning_started = time.perf_counter()
+    first_item = True
+    async for item in hlp.process_quickbooks_query(
+        new_user_query=query,
+        message_history=history_window,
+        user_context=hlp.user_context,
+        business_summary=hlp.business_summary,
+        available_tools=hlp.available_tools,
+        sticky_function_hint=sticky_hint,
+        static_sections=static_sections
+    ):
+        if first_item and item["type"] != "prompt_stats":
+            timings.add("planning_ttft", time.perf_counter() - planning_started)
+            first_item = False
+        if item["type"] == "function_calls" and plan_calls is None:
+            plan_calls = item["data"] or []
+            for call in plan_calls:
+                arguments = call.get("arguments", {})
+                query_arg = arguments.get("query") or arguments.get("data_request")
+                if call.get("name") and query_arg:
+                    tasks.append(asyncio.create_task(_timed(timings, "retrieval", hlp.simulate_retrieval_stub(
+                        function_name=call["name"], queries=[query_arg], top_k=RETRIEVAL_TOP_K
+                    ))))
+        elif item["type"] == "explanation":
+            explanation = item["data"]
+        elif item["type"] == "error":
+            raise RuntimeError(f"Planning error: {item['data']}")
+    timings.add("planning_total", time.perf_counter() - planning_started)
+
+    results = await asyncio.gather(*tasks) if tasks else []
+    answer = None
+    for result in results:
+        if result.get("asked_for_sticky"):
+            session.sticky_hint = result.get("function_name")
+        if result.get("follow_up_question"):
+            answer = result["follow_up_question"]
+    if results:
+        bypass_stats.record(assemble_response(results)) # Once per turn; generate_final_response doesn't record
+
+    if answer is None and results:
+        synthesis_started = time.perf_counter()
+        first_item = True
+        async for item in hlp.generate_final_response(
+            original_user_query=query,
+            message_history=history_window + [{"role": "user", "content": query}],
+            user_context=hlp.user_context,
+            business_summary=hlp.business_summary,
+            all_retrieval_results=results,
+            static_sections=static_sections
+        ):
+            if first_item and item["type"] != "prompt_stats":
+                timings.add("synthesis_ttft", time.perf_counter() - synthesis_started)
+                first_item = False
+            if item["type"] == "final_response_text":
+                answer = item["data"]
+            elif item["type"] == "error":
+                raise RuntimeError(f"Synthesis error: {item['data']}")
+        timings.add("synthesis_total", time.perf_counter() - synthesis_started)
+    answer = answer or explanation or "I wasn't able to retrieve or generate a specific answer for that."
+
+    session.chat_history.append({"role": "user", "content": query})
+    session.chat_history.append({"role": "assistant", "content": answer})
+    timings.add("turn_total", time.perf_counter() - turn_started)
+    return answer
+
+
+async def bench_direct(conversations: List[Dict[str, Any]], clients: int, repeat: int) -> Dict[str, Any]:
+    timings = StageTimings()
+    store = InMemorySessionStore()
+    static_sections = hlp.get_static_sections(hlp.user_context, hlp.business_summary, hlp.available_tools)
+    errors = 0
+    turns = 0
+
+    async def client(index: int):
+        nonlocal errors, turns
+        for round_index in range(repeat):
+            conversation = conversations[(index + round_index * clients) % len(conversations)]
+            session = await store.load(f"direct-{index}-{round_index}")
+            for query in conversation["turns"]:
+                try:
+                    await run_turn_direct(session, query, timings, static_sections)
+                    turns += 1
+                except Exception as e:
+                    errors += 1
+                    print(f"Bench: direct turn failed ({e})")
+            await store.save(session)
+
+    rss_before = rss_bytes()
+    monitor = LoopLagMonitor()
+    monitor.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(client(i) for i in range(clients)))
+    wall = time.perf_counter() - started
+    lag = await monitor.stop()
+    sessions = store.stats()["sessions"]
+    state_sizes = [len(fast_json.dumps(session.to_dict())) for session in store._sessions.values()]
+    return {
+        "clients": clients,
+        "turns": turns,
+        "errors": errors,
+        "wall_seconds": round(wall, 3),
+        "turns_per_sec": round(turns / wall, 2) if wall else 0.0,
+        "stages": timings.report(),
+        "event_loop_lag": lag,
+        "memory": {
+            "sessions": sessions,
+            "rss_delta_per_session_kb": round((rss_bytes() - rss_before) / 1024 / max(sessions, 1), 2),
+            "avg_session_state_bytes": round(sum(state_sizes) / len(state_sizes), 1) if state_sizes else 0.0
+        },
+        "llm_bypass": bypass_stats.stats()
+    }
+
+
+# --- WebSocket Clients ---
+async def bench_ws(conversations: List[Dict[str, Any]], clients: int, repeat: int, url: Optional[str], port: int) -> Dict[str, Any]:
+    try:
+        import websockets
+    except ImportError:
+        raise SystemExit("ws mode requires the 'websockets' package.")
+
+    server = server_task = None
+    if url is None:
+        import uvicorn
+        os.chdir(ROOT) # main.py mounts static/ and templates/ relative to the working directory
+        config = uvicorn.Config("main:app", host="127.0.0.1", port=port, log_level="warning", ws_max_size=16 * 1024 * 1024)
+        server = uvicorn.Server(config)
+        server_task = asyncio.create_task(server.serve())
+        while not server.started:
+            if server_task.done():
+                server_task.result()
+            await asyncio.sleep(0.05)
+        url = f"ws://127.0.0.1:{port}/ws"
+
+    timings = StageTimings()
+    bytes_per_turn: List[int] = []
+    errors = 0
+    turns = 0
+
+    async def client(index: int):
+        nonlocal errors, turns
+        for round_index in range(repeat):
+            conversation = conversations[(index + round_index * clients) % len(conversations)]
+            async with websockets.connect(f"{url}?session_id=bench-{index}-{round_index}", max_size=None) as ws:
+                await ws.recv() # session message
+                for query in conversation["turns"]:
+                    started = time.perf_counter()
+                    await ws.send(json.dumps({"message": query}))
+                    first_frame = first_delta = None
+                    received = 0
+                    while True:
+                        raw = await ws.recv()
+                        received += len(raw)
+                        message = fast_json.loads(raw)
+                        now = time.perf_counter() - started
+                        if first_frame is None:
+                            first_frame = now
+                        if message["type"] == "final_response_delta" and first_delta is None:
+                            first_delta = now
+                        if message["type"] in ("final_response", "error"):
+                            break
+                    if message["type"] == "error":
+                        errors += 1
+                        continue
+                    turns += 1
+                    timings.add("first_frame", first_frame)
+                    if first_delta is not None:
+                        timings.add("first_answer_delta", first_delta)
+                    timings.add("turn_total", time.perf_counter() - started)
+                    bytes_per_turn.append(received)
+
+    rss_before = rss_bytes()
+    monitor = LoopLagMonitor()
+    monitor.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(client(i) for i in range(clients)))
+    wall = time.perf_counter() - started
+    lag = await monitor.stop()
+    sessions = clients * repeat
+    result = {
+        "clients": clients,
+        "turns": turns,
+        "errors": errors,
+        "wall_seconds": round(wall, 3),
+        "turns_per_sec": round(turns / wall, 2) if wall else 0.0,
+        "stages": timings.report(),
+        "event_loop_lag": lag,
+        "avg_bytes_per_turn": round(sum(bytes_per_turn) / len(bytes_per_turn), 1) if bytes_per_turn else 0.0,
+        "memory": {"sessions": sessions}
+    }
+    if server is not None:
+        # Server shares this process, so RSS growth is attributable to the sessions it created
+        result["memory"]["rss_delta_per_session_kb"] = round((rss_bytes() - rss_before) / 1024 / max(sessions, 1), 2)
+        server.should_exit = True
+        await server_task
+    return result
+
+
+# --- Commands ---
+def configure_backend(args):
+    if args.backend == "replay":
+        backend = llm_backends.ReplayBackend(args.streams, speed=args.speed)
+    else:
+        backend = llm_backends.create_backend(args.backend)
+    llm_backends.set_backend(backend)
+
+
+async def run_command(args):
+    configure_backend(args)
+    conversations = load_conversations(args.conversations)
+    results = {
+        "meta": {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "json_backend": fast_json.JSON_BACKEND,
+            "backend": args.backend,
+            "speed": args.speed,
+            "clients": args.clients,
+            "repeat": args.repeat,
+            "conversations": len(conversations),
+            "timestamp": time.time()
+        }
+    }
+    if args.mode in ("direct", "both"):
+        results["direct"] = await bench_direct(conversations, args.clients, args.repeat)
+    if args.mode in ("ws", "both"):
+        results["ws"] = await bench_ws(conversations, args.clients, args.repeat, args.url, args.port)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+        print(f"Bench: Results written to {args.output}")
+    print(text)
+
+
+async def record_command(args):
+    """Runs the corpus once through the direct pipeline and records every LLM stream."""
+    if os.path.exists(args.output):
+        os.remove(args.output)
+    recorder = llm_backends.RecordingBackend(llm_backends.create_backend(args.backend), args.output)
+    llm_backends.set_backend(recorder)
+    conversations = load_conversations(args.conversations)
+    timings = StageTimings()
+    static_sections = hlp.get_static_sections(hlp.user_context, hlp.business_summary, hlp.available_tools)
+
+    async def replay_conversation(conversation):
+        session = SessionState(f"record-{conversation['id']}")
+        for query in conversation["turns"]:
+            await run_turn_direct(session, query, timings, static_sections)
+
+    await asyncio.gather(*(replay_conversation(conversation) for conversation in conversations))
+    print(f"Bench: Recorded {recorder.recorded} streams to {args.output}")
+
+
+def compare_command(args):
+    """Prints relative change of turns/sec and stage percentiles between two result files."""
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(args.candidate, "r", encoding="utf-8") as f:
+        candidate = json.load(f)
+
+    def change(old, new):
+        return f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+
+    for mode in ("direct", "ws"):
+        if mode not in baseline or mode not in candidate:
+            continue
+        old, new = baseline[mode], candidate[mode]
+        print(f"[{mode}] turns/sec {old['turns_per_sec']} -> {new['turns_per_sec']} ({change(old['turns_per_sec'], new['turns_per_sec'])})")
+        for stage in sorted(set(old["stages"]) | set(new["stages"])):
+            for key in ("p50_ms", "p95_ms", "p99_ms"):
+                a = old["stages"].get(stage, {}).get(key)
+                b = new["stages"].get(stage, {}).get(key)
+                if a is not None and b is not None:
+                    print(f"  {stage:<20} {key:<7} {a:>10} -> {b:>10} ({change(a, b)})")
+        a, b = old["event_loop_lag"]["p99_ms"], new["event_loop_lag"]["p99_ms"]
+        print(f"  {'event_loop_lag':<20} p99_ms  {a:>10} -> {b:>10} ({change(a, b)})")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="Replay the corpus and report latencies")
+    run.add_argument("--mode", choices=["direct", "ws", "both"], default="direct")
+    run.add_argument("--clients", type=int, default=20, help="Concurrent simulated clients")
+    run.add_argument("--repeat", type=int, default=1, help="Conversations per client")
+    run.add_argument("--backend", default="replay", help="replay (recorded streams), fake or gemini")
+    run.add_argument("--streams", default=DEFAULT_STREAMS)
+    run.add_argument("--speed", type=float, default=1.0, help="Replay speed-up factor")
+    run.add_argument("--conversations", default=DEFAULT_CONVERSATIONS)
+    run.add_argument("--url", default=None, help="ws://host:port/ws of a running server (default: start one in-process)")
+    run.add_argument("--port", type=int, default=8765)
+    run.add_argument("--output", default=None, help="Write results JSON here")
+
+    record = commands.add_parser("record", help="Record LLM streams for the corpus")
+    record.add_argument("--backend", default="fake")
+    record.add_argument("--conversations", default=DEFAULT_CONVERSATIONS)
+    record.add_argument("--output", default=DEFAULT_STREAMS)
+
+    compare = commands.add_parser("compare", help="Diff two result files")
+    compare.add_argument("baseline")
+    compare.add_argument("candidate")
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        asyncio.run(run_command(args))
+    elif args.command == "record":
+        asyncio.run(record_command(args))
+    else:
+        compare_command(args)
+
+
+if __name__ == "__main__":
+    main()
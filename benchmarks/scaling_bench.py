@@ -0,0 +1,178 @@
+# benchmarks/scaling_bench.py
+"""
+Throughput vs. worker count for the /ws endpoint.
+
+For each worker count, starts `uvicorn main:app --workers N` on replayed LLM streams with sessions
+and caches in SQLite (SESSION_STORE=sqlite, SHARED_STORE=sqlite, fresh files per run), drives it with
+concurrent WebSocket clients and reports turns/sec and turn latency. With --reconnect every turn
+opens a new connection for the same session, so consecutive turns land on different workers.
+
+    python benchmarks/scaling_bench.py --workers 1 2 4 --clients 64 --speed 8 --reconnect
+
+The clients run in this process; at high worker counts check that it is not the bottleneck
+(event_loop_lag in the output).
+"""
+
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List, Dict, Any
+
+from pipeline_bench import (
+    ROOT, DEFAULT_CONVERSATIONS, DEFAULT_STREAMS, StageTimings, LoopLagMonitor, load_conversations, git_revision
+)
+
+
+async def wait_for_port(port: int, process: subprocess.Popen, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"Bench: Server exited with code {process.returncode} during startup.")
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise SystemExit(f"Bench: Server did not start on port {port} within {timeout}s.")
+
+
+def start_server(workers: int, port: int, args, state_dir: str) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.update({
+        "LLM_BACKEND": "replay",
+        "LLM_REPLAY_PATH": args.streams,
+        "LLM_REPLAY_SPEED": str(args.speed),
+        "SESSION_STORE": "sqlite",
+        "SESSION_DB_PATH": os.path.join(state_dir, "sessions.db"),
+        "SHARED_STORE": args.shared_store,
+        "SHARED_STORE_PATH": os.path.join(state_dir, "shared_state.db"),
+        "WORKERS": str(workers)
+    })
+    command = [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+               "--workers", str(workers), "--log-level", "warning"]
+    return subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def drive(url: str, conversations: List[Dict[str, Any]], clients: int, repeat: int, reconnect: bool, run_id: str) -> Dict[str, Any]:
+    import websockets
+
+    timings = StageTimings()
+    errors = 0
+    turns = 0
+
+    async def run_query(ws, query: str) -> bool:
+        started = time.perf_counter()
+        await ws.send(json.dumps({"message": query}))
+        while True:
+            message = json.loads(await ws.recv())
+            if message["type"] in ("final_response", "error"):
+                break
+        timings.add("turn_total", time.perf_counter() - started)
+        return message["type"] == "final_response"
+
+    async def client(index: int):
+        nonlocal errors, turns
+        for round_index in range(repeat):
+            conversation = conversations[(index + round_index * clients) % len(conversations)]
+            session_url = f"{url}?session_id={run_id}-{index}-{round_index}"
+            if reconnect:
+                for query in conversation["turns"]:
+                    async with websockets.connect(session_url, max_size=None) as ws:
+                        await ws.recv() # session message
+                        ok = await run_query(ws, query)
+                    turns += ok
+                    errors += not ok
+            else:
+                async with websockets.connect(session_url, max_size=None) as ws:
+                    await ws.recv()
+                    for query in conversation["turns"]:
+                        ok = await run_query(ws, query)
+                        turns += ok
+                        errors += not ok
+
+    monitor = LoopLagMonitor()
+    monitor.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(client(i) for i in range(clients)))
+    wall = time.perf_counter() - started
+    lag = await monitor.stop()
+    return {
+        "turns": turns,
+        "errors": errors,
+        "wall_seconds": round(wall, 3),
+        "turns_per_sec": round(turns / wall, 2) if wall else 0.0,
+        "stages": timings.report(),
+        "event_loop_lag": lag
+    }
+
+
+async def run(args):
+    if importlib.util.find_spec("websockets") is None:
+        raise SystemExit("scaling_bench requires the 'websockets' package (and uvicorn).")
+    conversations = load_conversations(args.conversations)
+    results = {
+        "meta": {
+            "revision": git_revision(),
+            "clients": args.clients,
+            "repeat": args.repeat,
+            "speed": args.speed,
+            "reconnect": args.reconnect,
+            "shared_store": args.shared_store,
+            "cpu_count": os.cpu_count(),
+            "timestamp": time.time()
+        },
+        "runs": {}
+    }
+    for workers in args.workers:
+        with tempfile.TemporaryDirectory(prefix="qb-scaling-") as state_dir:
+            process = start_server(workers, args.port, args, state_dir)
+            try:
+                await wait_for_port(args.port, process)
+                await asyncio.sleep(args.warmup) # Let every worker finish importing before load starts
+                print(f"Bench: {workers} worker(s), {args.clients} clients...")
+                result = await drive(f"ws://127.0.0.1:{args.port}/ws", conversations, args.clients, args.repeat, args.reconnect, f"w{workers}")
+            finally:
+                process.terminate()
+                try:
+                    process.wait(timeout=15)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+        results["runs"][str(workers)] = result
+        print(f"Bench: {workers} worker(s): {result['turns_per_sec']} turns/sec, p95 {result['stages']['turn_total']['p95_ms']} ms, {result['errors']} errors")
+
+    base = results["runs"].get(str(args.workers[0]), {}).get("turns_per_sec")
+    if base:
+        results["speedup"] = {workers: round(run["turns_per_sec"] / base, 2) for workers, run in results["runs"].items()}
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+        print(f"Bench: Results written to {args.output}")
+    print(text)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=64, help="Concurrent simulated clients")
+    parser.add_argument("--repeat", type=int, default=1, help="Conversations per client")
+    parser.add_argument("--speed", type=float, default=8.0, help="Replay speed-up factor")
+    parser.add_argument("--reconnect", action="store_true", help="New connection per turn (sessions move between workers)")
+    parser.add_argument("--shared-store", default="sqlite", choices=["none", "sqlite"])
+    parser.add_argument("--streams", default=DEFAULT_STREAMS)
+    parser.add_argument("--conversations", default=DEFAULT_CONVERSATIONS)
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--warmup", type=float, default=2.0, help="Seconds to wait after the port opens")
+    parser.add_argument("--output", default=None, help="Write results JSON here")
+    asyncio.run(run(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+# embeddings.py
+
+import asyncio
+import os
+from typing import List
+
+from batching import MicroBatcher, MICRO_BATCHING
+from structured_log import get_logger
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
+
+log = get_logger("Embeddings")
+
+# --- Configuration ---
+EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+
+_model = None
+
+
+def embeddings_available() -> bool:
+    """True when numpy and sentence-transformers are importable."""
+    return np is not None and SentenceTransformer is not None
+
+
+def get_embedding_model():
+    """Loads the sentence-transformers model once per process."""
+    global _model
+    if _model is None:
+        if not embeddings_available():
+            raise RuntimeError("Embeddings require numpy and sentence-transformers to be installed.")
+        log.info(f"Loading model '{EMBEDDING_MODEL_NAME}'...")
+        _model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+    return _model
+
+
+def embed_texts(texts: List[str]) -> "np.ndarray":
+    """Embeds texts into an (n, dim) float32 array of unit-length vectors (dot product == cosine)."""
+    model = get_embedding_model()
+    vectors = model.encode(texts, normalize_embeddings=True, convert_to_numpy=True, show_progress_bar=False)
+    return np.asarray(vectors, dtype="float32")
+
+
+async def embed_texts_async(texts: List[str]) -> "np.ndarray":
+    """embed_texts() off the event loop."""
+    return await asyncio.to_thread(embed_texts, texts)
+
+
+async def _embed_batch(texts: List[str]) -> list:
+    return list(await embed_texts_async(texts))
+
+
+# Shared across all sessions: concurrent single-query embeds are encoded as one batch
+embedding_batcher = MicroBatcher(_embed_batch, name="embeddings")
+
+
+async def embed_query_async(text: str) -> "np.ndarray":
+    """Embeds one text, micro-batched with other concurrent callers when MICRO_BATCHING=1."""
+    if not MICRO_BATCHING:
+        return (await embed_texts_async([text]))[0]
+    return await embedding_batcher.submit(text)
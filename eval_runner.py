@@ -0,0 +1,354 @@
+# eval_runner.py
+"""
+Offline bulk evaluation of routing (helper2.process_quickbooks_query).
+
+Replays a stream of historical questions through the planner, sharded across a process pool.
+Each worker runs its own asyncio loop with at most --concurrency queries in flight and appends
+one JSON line per finished query to <out>/results-<shard>.jsonl. Those files are the checkpoint:
+re-running with the same --out skips every id already recorded, so an interrupted run resumes.
+
+    python eval_runner.py run --input questions.jsonl --out evals/run1 --workers 4 --concurrency 16
+    python eval_runner.py report --out evals/run1
+
+Input: .jsonl (or .parquet, with pyarrow installed), one record per question:
+    {"id": "t-1", "query": "How do I run payroll?", "expected_tool": "payroll_qna_retrieval",
+     "history": [{"role": "user", "content": "..."}, ...], "sticky_hint": null}
+"message" is accepted for "query"; "expected_tool" may be a list (multi-tool plans) or omitted.
+By default every query is planned by the LLM with no plan reuse: the fast-path router is off, its
+planner decision cache is emptied (PLANNER_CACHE_MAX=0), SHARED_STORE=none and identical in-flight
+prompts are not coalesced (LLM_SINGLE_FLIGHT=0). --fast-path adds the router's rules; --use-caches
+keeps the environment's cache settings.
+The report (<out>/report.json, summary printed) has routing accuracy, a confusion matrix of
+expected vs. planned tools, and per-tool latency percentiles and histograms.
+"""
+
+import argparse
+import asyncio
+import bisect
+import json
+import multiprocessing
+import os
+import sys
+import time
+import zlib
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, Dict, Any, Iterator, Set
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None # Only required for .parquet inputs
+
+RESULTS_PREFIX = "results-"
+REPORT_FILE = "report.json"
+NO_TOOL = "none"
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0)
+
+
+# --- Input ---
+def iter_records(path: str) -> Iterator[Dict[str, Any]]:
+    """Streams input records with a stable "id" (the row number when the record has none)."""
+    if path.endswith(".parquet"):
+        if pq is None:
+            raise SystemExit("Eval ERROR: Parquet input requires pyarrow to be installed.")
+        rows = (row for batch in pq.ParquetFile(path).iter_batches(batch_size=1024) for row in batch.to_pylist())
+    else:
+        rows = _iter_jsonl(path)
+    for row_number, record in enumerate(rows):
+        record.setdefault("id", f"row-{row_number}")
+        record["id"] = str(record["id"])
+        yield record
+
+
+def _iter_jsonl(path: str) -> Iterator[Dict[str, Any]]:
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def shard_of(record_id: str, shards: int) -> int:
+    return zlib.crc32(record_id.encode("utf-8")) % shards
+
+
+def tool_label(tools) -> str:
+    """One label per plan: the tool name, tools joined with '+' for multi-tool plans, or 'none'."""
+    if not tools:
+        return NO_TOOL
+    if isinstance(tools, str):
+        return tools
+    return "+".join(sorted(set(tools)))
+
+
+# --- Checkpoint ---
+def results_files(out_dir: str) -> List[str]:
+    if not os.path.isdir(out_dir):
+        return []
+    return sorted(os.path.join(out_dir, name) for name in os.listdir(out_dir) if name.startswith(RESULTS_PREFIX) and name.endswith(".jsonl"))
+
+
+def read_results(out_dir: str) -> Iterator[Dict[str, Any]]:
+    """All recorded results; a line cut short by an interrupted run is skipped (and re-run on resume)."""
+    for path in results_files(out_dir):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+def completed_ids(out_dir: str) -> Set[str]:
+    return {result["id"] for result in read_results(out_dir) if "id" in result}
+
+
+def open_results_file(out_dir: str, shard: int):
+    """Appends to the shard's results file, first terminating a partial last line."""
+    path = os.path.join(out_dir, f"{RESULTS_PREFIX}{shard:03d}.jsonl")
+    f = open(path, "a+", encoding="utf-8")
+    if f.tell() > 0:
+        f.seek(f.tell() - 1)
+        if f.read(1) != "\n":
+            f.write("\n")
+    return f
+
+
+# --- Worker ---
+async def evaluate_query(hlp, record: Dict[str, Any], static_sections, use_fast_path: bool) -> Dict[str, Any]:
+    """Plans one query; returns the planned tools and routing/planning latency."""
+    query = record.get("query") or record.get("message") or ""
+    expected = record.get("expected_tool")
+    result = {
+        "id": record["id"],
+        "query": query,
+        "expected": tool_label(expected) if expected is not None else None,
+        "predicted": None,
+        "tools": [],
+        "route_seconds": None,
+        "seconds": None,
+        "error": None
+    }
+    started = time.perf_counter()
+    try:
+        async for item in hlp.process_quickbooks_query(
+            new_user_query=query,
+            message_history=record.get("history") or [],
+            user_context=hlp.user_context,
+            business_summary=hlp.business_summary,
+            available_tools=hlp.available_tools,
+            sticky_function_hint=record.get("sticky_hint"),
+            use_fast_path=use_fast_path,
+            static_sections=static_sections
+        ):
+            if item["type"] == "function_calls" and result["route_seconds"] is None:
+                result["tools"] = [call.get("name") for call in item["data"] or [] if call.get("name")]
+                result["route_seconds"] = round(time.perf_counter() - started, 4)
+            elif item["type"] == "error":
+                result["error"] = str(item["data"])
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["seconds"] = round(time.perf_counter() - started, 4)
+    if result["route_seconds"] is None:
+        result["route_seconds"] = result["seconds"] # Plan without function calls (explanation only)
+    result["predicted"] = tool_label(result["tools"])
+    if result["expected"] is not None:
+        result["correct"] = result["predicted"] == result["expected"]
+    return result
+
+
+async def _run_shard(shard: int, args: Dict[str, Any], done: Set[str]) -> Dict[str, Any]:
+    import helper2 as hlp
+
+    static_sections = hlp.get_static_sections(hlp.user_context, hlp.business_summary, hlp.available_tools)
+    counts = {"shard": shard, "evaluated": 0, "skipped": 0, "errors": 0}
+    in_flight = set()
+    with open_results_file(args["out"], shard) as out:
+
+        def write(task: asyncio.Task):
+            result = task.result()
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+            counts["evaluated"] += 1
+            counts["errors"] += result["error"] is not None
+
+        for position, record in enumerate(iter_records(args["input"])):
+            if args["limit"] and position >= args["limit"]:
+                break
+            if shard_of(record["id"], args["workers"]) != shard:
+                continue
+            if record["id"] in done:
+                counts["skipped"] += 1
+                continue
+            in_flight.add(asyncio.create_task(evaluate_query(hlp, record, static_sections, args["fast_path"])))
+            if len(in_flight) >= args["concurrency"]:
+                finished, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    write(task)
+        if in_flight:
+            finished, _ = await asyncio.wait(in_flight)
+            for task in finished:
+                write(task)
+    return counts
+
+
+def run_shard(shard: int, args: Dict[str, Any], done: Set[str]) -> Dict[str, Any]:
+    """Process pool entry point: configures this worker's environment, then runs its shard on a fresh event loop."""
+    os.environ.update(args["env"])
+    return asyncio.run(_run_shard(shard, args, done))
+
+
+# --- Report ---
+def _percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+def latency_summary(samples: List[float]) -> Dict[str, Any]:
+    values = sorted(samples)
+    histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+    for value in values:
+        histogram[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+    labels = [f"le_{bound}" for bound in LATENCY_BUCKETS] + ["le_inf"]
+    return {
+        "count": len(values),
+        "p50_ms": round(1000 * _percentile(values, 50), 2),
+        "p95_ms": round(1000 * _percentile(values, 95), 2),
+        "p99_ms": round(1000 * _percentile(values, 99), 2),
+        "max_ms": round(1000 * values[-1], 2) if values else 0.0,
+        "histogram": dict(zip(labels, histogram)) # Per-bucket counts (not cumulative)
+    }
+
+
+def build_report(out_dir: str) -> Dict[str, Any]:
+    results = list(read_results(out_dir))
+    labelled = [r for r in results if r.get("expected") is not None and r.get("error") is None]
+    confusion: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+    for result in labelled:
+        confusion[result["expected"]][result["predicted"]] += 1
+
+    per_tool = {}
+    for tool in sorted({label for row in confusion.values() for label in row} | set(confusion)):
+        true_positive = confusion.get(tool, {}).get(tool, 0)
+        expected_count = sum(confusion.get(tool, {}).values())
+        predicted_count = sum(row.get(tool, 0) for row in confusion.values())
+        per_tool[tool] = {
+            "expected": expected_count,
+            "predicted": predicted_count,
+            "precision": round(true_positive / predicted_count, 4) if predicted_count else None,
+            "recall": round(true_positive / expected_count, 4) if expected_count else None
+        }
+
+    route_latency = defaultdict(list)
+    total_latency = defaultdict(list)
+    for result in results:
+        if result.get("error") is None and result.get("seconds") is not None:
+            route_latency[result["predicted"]].append(result["route_seconds"])
+            total_latency[result["predicted"]].append(result["seconds"])
+
+    return {
+        "results": len(results),
+        "errors": sum(1 for r in results if r.get("error") is not None),
+        "labelled": len(labelled),
+        "accuracy": round(sum(1 for r in labelled if r.get("correct")) / len(labelled), 4) if labelled else None,
+        "confusion_matrix": {expected: dict(row) for expected, row in sorted(confusion.items())},
+        "per_tool": per_tool,
+        "route_latency": {tool: latency_summary(values) for tool, values in sorted(route_latency.items())},
+        "planning_latency": {tool: latency_summary(values) for tool, values in sorted(total_latency.items())}
+    }
+
+
+def format_confusion(confusion: Dict[str, Dict[str, int]]) -> str:
+    """Text table: one row per expected label, one column per predicted label."""
+    columns = sorted({label for row in confusion.values() for label in row})
+    width = max([len(label) for label in list(confusion) + columns] + [8]) + 2
+    lines = ["expected \\ predicted".ljust(width) + "".join(label[:width - 1].rjust(width) for label in columns)]
+    for expected, row in sorted(confusion.items()):
+        lines.append(expected[:width - 1].ljust(width) + "".join(str(row.get(label, 0)).rjust(width) for label in columns))
+    return "\n".join(lines)
+
+
+def write_report(out_dir: str) -> Dict[str, Any]:
+    report = build_report(out_dir)
+    with open(os.path.join(out_dir, REPORT_FILE), "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Eval: {report['results']} results, {report['errors']} errors, accuracy {report['accuracy']} over {report['labelled']} labelled")
+    if report["confusion_matrix"]:
+        print(format_confusion(report["confusion_matrix"]))
+    for tool, summary in report["route_latency"].items():
+        print(f"Eval: {tool}: n={summary['count']} route p50 {summary['p50_ms']} ms, p95 {summary['p95_ms']} ms, p99 {summary['p99_ms']} ms")
+    print(f"Eval: Report written to {os.path.join(out_dir, REPORT_FILE)}")
+    return report
+
+
+# --- Commands ---
+def run_command(args) -> int:
+    os.makedirs(args.out, exist_ok=True)
+    done = completed_ids(args.out)
+    if done:
+        print(f"Eval: Resuming, {len(done)} results already in {args.out}")
+    env = {"LOG_LEVEL": args.log_level, "LLM_MAX_CONCURRENCY": str(args.concurrency)}
+    if not args.use_caches:
+        # Repeated questions, and plans cached before a prompt change, must not skip the prompt under test
+        env.update({"PLANNER_CACHE_MAX": "0", "SHARED_STORE": "none", "LLM_SINGLE_FLIGHT": "0"})
+    if args.backend:
+        env["LLM_BACKEND"] = args.backend
+    shard_args = {
+        "input": args.input,
+        "out": args.out,
+        "workers": args.workers,
+        "concurrency": args.concurrency,
+        "limit": args.limit,
+        "fast_path": args.fast_path,
+        "env": env
+    }
+    started = time.perf_counter()
+    evaluated = 0
+    # spawn: each worker imports helper2 after its environment is set, and gets its own event loop
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [
+            pool.submit(run_shard, shard, shard_args, {i for i in done if shard_of(i, args.workers) == shard})
+            for shard in range(args.workers)
+        ]
+        for future in as_completed(futures):
+            counts = future.result()
+            evaluated += counts["evaluated"]
+            print(f"Eval: Shard {counts['shard']} finished: {counts['evaluated']} evaluated, {counts['skipped']} skipped, {counts['errors']} errors")
+    wall = time.perf_counter() - started
+    print(f"Eval: {evaluated} queries in {wall:.1f}s ({evaluated / wall if wall else 0.0:.1f}/s)")
+    write_report(args.out)
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="Evaluate (or resume evaluating) an input file")
+    run.add_argument("--input", required=True, help=".jsonl or .parquet questions")
+    run.add_argument("--out", required=True, help="Directory for results-<shard>.jsonl and report.json")
+    run.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Worker processes (one shard each)")
+    run.add_argument("--concurrency", type=int, default=16, help="Queries in flight per worker (also its LLM_MAX_CONCURRENCY)")
+    run.add_argument("--limit", type=int, default=0, help="Only the first N input records (0 = all)")
+    run.add_argument("--backend", default=None, help="LLM_BACKEND for the workers (default: environment)")
+    run.add_argument("--fast-path", action="store_true", help="Route through router.fast_path_router first (default: LLM planner only)")
+    run.add_argument("--use-caches", action="store_true", help="Keep planner decision caches, SHARED_STORE and single-flight from the environment")
+    run.add_argument("--log-level", default="WARNING", help="LOG_LEVEL for the workers")
+
+    report = commands.add_parser("report", help="Rebuild report.json from recorded results")
+    report.add_argument("--out", required=True)
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        return run_command(args)
+    if not results_files(args.out):
+        print(f"Eval ERROR: No results in {args.out}")
+        return 1
+    write_report(args.out)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,48 @@
+# fast_json.py
+
+import json
+import os
+from typing import Any
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# --- Configuration ---
+# "auto" uses orjson when it is installed; "json" forces the standard library
+JSON_ENCODER = os.getenv("JSON_ENCODER", "auto").lower()
+
+USE_ORJSON = orjson is not None and JSON_ENCODER in ("auto", "orjson")
+JSON_BACKEND = "orjson" if USE_ORJSON else "json"
+
+
+if USE_ORJSON:
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+    def dumps(value: Any) -> str:
+        """Compact JSON text (orjson)."""
+        return orjson.dumps(value, option=_ORJSON_OPTIONS).decode("utf-8")
+
+    def loads(text: str) -> Any:
+        """Parses JSON text (orjson); raises a json.JSONDecodeError subclass on bad input."""
+        return orjson.loads(text)
+else:
+    _encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+    def dumps(value: Any) -> str:
+        """Compact JSON text (stdlib)."""
+        return _encoder.encode(value)
+
+    loads = json.loads
+
+
+async def send_frame(websocket, message: Any):
+    """Sends one JSON message as a text frame; replaces websocket.send_json, which always uses stdlib json."""
+    await websocket.send_text(dumps(message))
+
+
+# Last: the JSON log formatter needs dumps() defined
+if JSON_ENCODER == "orjson" and orjson is None:
+    from structured_log import get_logger
+    get_logger("Fast JSON").warning("JSON_ENCODER=orjson but orjson is not installed; using the json module.")
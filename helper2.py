@@ -1,42 +1,66 @@
 # helper2.py
 
-import google.generativeai as genai
+try:
+    import google.generativeai as genai
+except ImportError:
+    genai = None # Only required when LLM_BACKEND=gemini
 import json
 import os
 import re
 from typing import List, Dict, Any, Tuple, Optional, Union, AsyncGenerator
 import copy
 import asyncio
+import hashlib
+
+import llm_backends
+from response_assembly import assemble_response
+from llm_scheduler import llm_scheduler
+from json_stream import IncrementalStringFieldParser, JsonLinesSplitter
+import fast_json
+from retrieval_cache import retrieval_cache
+from vector_store import vector_store, use_vector_retrieval
+import router
+from history import compact_json, prompt_stats
+import metrics
+from structured_log import get_logger
+
+log = get_logger("Helper")
+stub_log = get_logger("Helper Stub")
 
 # --- Configuration ---
 # ... (Same as before) ...
-try:
-    # Assuming keys.py exists and has google_api_key defined
-    import keys
-    google_api_key = keys.google_api_key
-    genai.configure(api_key=google_api_key)
-    print("Helper: Google API Key configured successfully.")
-except ImportError:
-    print("Helper Warning: 'keys.py' not found. Attempting manual configuration.")
-    google_api_key = "YOUR_GOOGLE_API_KEY" # <--- PASTE YOUR KEY HERE IF keys.py IS NOT USED
-    if google_api_key == "YOUR_GOOGLE_API_KEY":
-        print("Helper ERROR: You must provide your Google API Key.")
-        raise ValueError("Google API Key not configured.")
-    else:
-        genai.configure(api_key=google_api_key)
-        print("Helper: Google API Key configured manually.")
-except AttributeError:
-    print("Helper Warning: 'google_api_key' not found in 'keys.py'. Attempting manual configuration.")
-    google_api_key = "YOUR_GOOGLE_API_KEY" # <--- PASTE YOUR KEY HERE IF keys.py IS NOT USED
-    if google_api_key == "YOUR_GOOGLE_API_KEY":
-        print("Helper ERROR: You must provide your Google API Key.")
-        raise ValueError("Google API Key not configured.")
-    else:
+# Tools eligible for the fused pipeline (comma-separated; empty disables it), see process_fused_query
+FUSED_TOOLS = {name.strip() for name in os.getenv("FUSED_TOOLS", "").split(",") if name.strip()}
+if llm_backends.LLM_BACKEND != "gemini":
+    log.info(f"Using '{llm_backends.LLM_BACKEND}' LLM backend, skipping Google API key configuration.")
+else:
+    try:
+        # Assuming keys.py exists and has google_api_key defined
+        import keys
+        google_api_key = keys.google_api_key
         genai.configure(api_key=google_api_key)
-        print("Helper: Google API Key configured manually.")
-except Exception as e:
-     print(f"Helper Warning: API Key configuration might be missing or invalid: {e}")
-     pass
+        log.info("Google API Key configured successfully.")
+    except ImportError:
+        log.warning("'keys.py' not found. Attempting manual configuration.")
+        google_api_key = "YOUR_GOOGLE_API_KEY" # <--- PASTE YOUR KEY HERE IF keys.py IS NOT USED
+        if google_api_key == "YOUR_GOOGLE_API_KEY":
+            log.error("You must provide your Google API Key.")
+            raise ValueError("Google API Key not configured.")
+        else:
+            genai.configure(api_key=google_api_key)
+            log.info("Google API Key configured manually.")
+    except AttributeError:
+        log.warning("'google_api_key' not found in 'keys.py'. Attempting manual configuration.")
+        google_api_key = "YOUR_GOOGLE_API_KEY" # <--- PASTE YOUR KEY HERE IF keys.py IS NOT USED
+        if google_api_key == "YOUR_GOOGLE_API_KEY":
+            log.error("You must provide your Google API Key.")
+            raise ValueError("Google API Key not configured.")
+        else:
+            genai.configure(api_key=google_api_key)
+            log.info("Google API Key configured manually.")
+    except Exception as e:
+         log.warning(f"API Key configuration might be missing or invalid: {e}")
+         pass
 
 
 # --- Example Data Setup ---
@@ -97,102 +121,173 @@ available_tools = [
 ]
 
 
-# --- Core LLM Interaction Function (Async Yielding - NO CHANGE) ---
+# --- Core LLM Interaction Function (Async Yielding) ---
 async def _execute_llm_json_lines(
     prompt: str,
     expected_keys: List[str],
     model_name: str = 'gemini-1.5-flash-001',
-    temperature: float = 0.2
+    temperature: float = 0.2,
+    stream_keys: Optional[List[str]] = None,
+    static_prefix: Optional[str] = None
 ) -> AsyncGenerator[Dict[str, Any], None]:
     """
-    Core async generator executing Gemini call, parsing and yielding JSON Lines.
-    (Implementation remains the same)
+    Core async generator executing the LLM call via the configured backend
+    (see llm_backends.py), parsing and yielding JSON Lines.
+    For keys in stream_keys whose value is a string, partial values are also yielded as
+    '<key>_delta' items while the line is still arriving; the complete '<key>' item follows as usual.
+    static_prefix (the prompt's leading static part) lets the backend use its context cache.
     """
-    # ... (Implementation is identical to the previous correct version) ...
-    print(f"\n--- Helper: Executing LLM Call (Expecting: {', '.join(expected_keys)}) ---") # Verbose
-    model = genai.GenerativeModel(model_name)
-    buffer = "" # Buffer for incomplete lines
+    log.debug(f"Executing LLM call (expecting: {', '.join(expected_keys)})")
+    splitter = JsonLinesSplitter() # Linear-time line splitting of the streamed text
     found_non_thought_keys = {key: False for key in expected_keys if key != 'thought'}
     line_counter = 0 # For error reporting
+    field_streamer = IncrementalStringFieldParser(stream_keys) if stream_keys else None
+
+    def parse_line(line: str) -> List[Dict[str, Any]]:
+        """Items for one complete line (none for blanks, code fences and non-JSON text)."""
+        line = line.strip()
+        if not line or line == '```json' or line == '```':
+            return []
+        items = []
+        try:
+            if (line.startswith('{') and line.endswith('}')) or \
+               (line.startswith('[') and line.endswith(']')):
+                parsed_json = fast_json.loads(line)
+                for key in expected_keys:
+                    if key in parsed_json:
+                        if key == 'thought' and isinstance(parsed_json[key], str):
+                            log.debug(f"Thought: {parsed_json[key]}", extra={"sample": "thought"})
+                            items.append({"type": "thought", "data": parsed_json[key]})
+                        elif key != 'thought' and not found_non_thought_keys[key]:
+                            # Yield the specific key and its data
+                            items.append({"type": key, "data": parsed_json[key]})
+                            found_non_thought_keys[key] = True
+                        break
+        except json.JSONDecodeError:
+            log.warning(f"JSONDecodeError on presumed complete line {line_counter}. Content: {line}", extra={"sample": "parse_warning"})
+        except Exception as e:
+            log.error(f"Processing line {line_counter} failed: {e}. Content: {line}")
+            items.append({"type": "error", "data": f"Unexpected processing error on line {line_counter}: {e}"})
+        return items
 
     try:
-        response = await model.generate_content_async(
-            prompt,
-            stream=True,
-            generation_config=genai.types.GenerationConfig(temperature=temperature)
-        )
-
-        async for chunk in response:
-            if not chunk.parts:
-                 continue
-
-            buffer += chunk.text
-            while '\n' in buffer:
-                line, buffer = buffer.split('\n', 1)
-                line = line.strip()
+        async for chunk_text in llm_scheduler.stream(prompt, model_name=model_name, temperature=temperature, static_prefix=static_prefix):
+            lines = splitter.feed(chunk_text)
+            for line in lines:
                 line_counter += 1
-
-                if not line or line == '```json' or line == '```':
-                    continue
-
-                try:
-                    if (line.startswith('{') and line.endswith('}')) or \
-                       (line.startswith('[') and line.endswith(']')):
-                        parsed_json = json.loads(line)
-                        found_key_in_line = False
-                        for key in expected_keys:
-                            if key in parsed_json:
-                                found_key_in_line = True
-                                if key == 'thought' and isinstance(parsed_json[key], str):
-                                    yield {"type": "thought", "data": parsed_json[key]}
-                                elif key != 'thought' and not found_non_thought_keys[key]:
-                                    # Yield the specific key and its data
-                                    yield {"type": key, "data": parsed_json[key]}
-                                    found_non_thought_keys[key] = True
-                                break
-                except json.JSONDecodeError:
-                    print(f"\nHelper WARNING: JSONDecodeError on presumed complete line {line_counter}. Content: {line}")
-                except Exception as e:
-                    print(f"\nHelper ERROR processing Line {line_counter}: {e}")
-                    print(f"Helper Problematic line content: {line}")
-                    yield {"type": "error", "data": f"Unexpected processing error on line {line_counter}: {e}"}
+                for item in parse_line(line):
+                    yield item
+
+            # Stream the partial value of the line still in progress
+            if field_streamer:
+                if lines:
+                    field_streamer.reset()
+                    new_text = chunk_text[chunk_text.rfind('\n') + 1:]
+                else:
+                    new_text = chunk_text
+                partial = field_streamer.feed_delta(new_text)
+                if partial and not found_non_thought_keys.get(partial[0]):
+                    yield {"type": f"{partial[0]}_delta", "data": partial[1]}
 
         # Process any remaining data in the buffer
-        if buffer.strip():
-            line = buffer.strip()
-            line_counter +=1
-            if line == '```json' or line == '```':
-                 pass
-            else:
-                try:
-                    if (line.startswith('{') and line.endswith('}')) or \
-                       (line.startswith('[') and line.endswith(']')):
-                        parsed_json = json.loads(line)
-                        found_key_in_line = False
-                        for key in expected_keys:
-                             if key in parsed_json:
-                                found_key_in_line = True
-                                if key == 'thought' and isinstance(parsed_json[key], str):
-                                    yield {"type": "thought", "data": parsed_json[key]}
-                                elif key != 'thought' and not found_non_thought_keys[key]:
-                                    yield {"type": key, "data": parsed_json[key]}
-                                    found_non_thought_keys[key] = True
-                                break
-                except json.JSONDecodeError:
-                     print(f"\nHelper WARNING: JSONDecodeError on final buffer content. Content: {line}")
-                except Exception as e:
-                    print(f"\nHelper ERROR processing final buffer: {e}")
-                    print(f"Helper Problematic final buffer content: {line}")
-                    yield {"type": "error", "data": f"Unexpected processing error on final buffer: {e}"}
+        final_line = splitter.close()
+        if final_line.strip():
+            line_counter += 1
+            for item in parse_line(final_line):
+                yield item
 
     except Exception as e:
-        print(f"\n--- Helper ERROR during API call ---")
-        print(e)
+        log.error(f"API call failed: {e}")
+        metrics.llm_errors_total.inc(stage=llm_backends.detect_prompt_stage(prompt))
         yield {"type": "error", "data": f"API call failed - {e}"}
         return
 
 
-# --- Planning/Routing Function (NO CHANGE from previous) ---
+# --- Static Prompt Sections (rendered once per content hash) ---
+PLANNING_INSTRUCTIONS = """You are an AI assistant for QuickBooks. Your task is to analyze the user's query, chat history, user context, and business summary to determine the best way to route the query using the available tools.
+
+Follow these steps precisely:
+
+1.  **Chain of Thought (CoT):** First, perform a chain of thought analysis. Output this reasoning process as 2-4 separate JSON Lines payloads. Each payload must be a valid JSON object containing a single key "thought" with the reasoning step as its string value. Consider the hint if provided.
+
+2.  **Function Call Selection:** After the CoT JSON Lines, output a *single* JSON Line payload. This payload must be a valid JSON object containing a single key "function_calls". The value of "function_calls" must be a *list* of JSON objects, each containing "name" and "arguments". If no function call is needed, output an empty list: {"function_calls": []}.
+
+3.  **Final Explanation:** If and only if *no* function calls are selected (i.e., "function_calls" is an empty list), output one *last* JSON Line payload containing a single key "explanation". The value should be a brief string explaining *why* no tool was needed and potentially providing a direct answer if possible. Do *not* output an "explanation" if function calls are made.
+"""
+
+SYNTHESIS_INSTRUCTIONS = """You are an AI assistant for QuickBooks. Your task is to synthesize a helpful and concise final response. Start with any standard warnings provided. Then, incorporate information from the successful sources, citing them accurately using bracketed numerical IDs `[id]`. Also consider mentioning limitations based on rejected parts of the query.
+
+Follow these steps precisely:
+
+1.  **Standard Warnings First:** Check the 'Standard Warnings' section below. If it contains text, begin your final response *exactly* with that text, followed by two newlines.
+2.  **Chain of Thought (CoT):** Perform a chain of thought analysis (output as JSON Lines with key "thought"). Consider:
+    *   The user's original query and the conversation history (given below).
+    *   Standard Warnings (already handled in step 1).
+    *   'Content to Present Verbatim' (from successful sources): Plan inclusion with citation `[id]`.
+    *   'Content to Summarize' (from successful sources): Plan synthesis, citing *all* used info with `[id]`. Use `[1][2]` if needed.
+    *   'Rejected Query Parts': Decide if/how to briefly mention this limitation *after* presenting the successful information.
+    *   Drafting the core message (after any standard warning), ensuring correct citations for successful content.
+    *   Refining the final response for clarity, conciseness, tone.
+
+3.  **Cited Response Generation:** After CoT, output a *single* JSON Line (key "final_response_text"). The value is the complete response string: Standard Warnings (if any) + Synthesized/Cited Answer + Optional Rejection Note. Include bracketed citations `[id]` for successful content.
+
+4.  **Citation Map Generation:** Immediately after "final_response_text", output *one more* JSON Line (key "citation_map"). Value is a JSON object mapping string IDs used in the text (only from successful sources) to their {"title": ..., "link": ...}. Example: { "1": { "title": "A", "link": "..." }, "3": { "title": "B", "link": "..." } }
+"""
+
+_STATIC_SECTIONS_MAX = 64
+
+
+class StaticPromptSections:
+    """
+    Serialized tools / user context / business summary plus the static prompt prefixes built from them.
+    Prefixes come first in every prompt so they can be registered with a provider context cache.
+    """
+
+    def __init__(self, user_context: Dict[str, Any], business_summary: Dict[str, Any], available_tools: List[Dict[str, Any]], content_hash: str):
+        self.content_hash = content_hash
+        self.tools_str = compact_json(available_tools)
+        self.context_str = compact_json(user_context)
+        self.business_str = compact_json(business_summary)
+        self.planning_prefix = f"""{PLANNING_INSTRUCTIONS}
+**Available Tools:**
+{self.tools_str}
+
+User Context:
+{self.context_str}
+
+Business Summary:
+{self.business_str}
+"""
+        self.synthesis_prefix = f"""{SYNTHESIS_INSTRUCTIONS}
+**Context:**
+*   User Context: {self.context_str}.
+*   Business Summary: {self.business_str}.
+"""
+
+
+_static_sections_cache: Dict[str, StaticPromptSections] = {}
+
+
+def get_static_sections(
+    user_context: Dict[str, Any],
+    business_summary: Dict[str, Any],
+    available_tools: List[Dict[str, Any]]
+) -> StaticPromptSections:
+    """
+    Returns the rendered static sections for this content, memoized by content hash.
+    Callers with long-lived inputs (main.py) should hold on to the result and pass it in directly.
+    """
+    content_hash = hashlib.sha256(compact_json([available_tools, user_context, business_summary]).encode("utf-8")).hexdigest()
+    sections = _static_sections_cache.get(content_hash)
+    if sections is None:
+        sections = StaticPromptSections(user_context, business_summary, available_tools, content_hash)
+        if len(_static_sections_cache) >= _STATIC_SECTIONS_MAX:
+            _static_sections_cache.pop(next(iter(_static_sections_cache)))
+        _static_sections_cache[content_hash] = sections
+    return sections
+
+
+# --- Planning/Routing Function ---
 async def process_quickbooks_query(
     new_user_query: str,
     message_history: List[Dict[str, str]],
@@ -201,66 +296,74 @@ async def process_quickbooks_query(
     available_tools: List[Dict[str, Any]],
     sticky_function_hint: Optional[str] = None,
     model_name: str = 'gemini-1.5-flash-001',
-    temperature: float = 0.2
+    temperature: float = 0.2,
+    use_fast_path: bool = router.FAST_PATH_ROUTING,
+    static_sections: Optional[StaticPromptSections] = None
 ) -> AsyncGenerator[Dict[str, Any], None]:
     """
     Async generator processing a user query for routing. Includes sticky function hint.
-    (Implementation remains the same as previous correct version)
+    Obvious queries are routed by router.fast_path_router without an LLM call; the yielded
+    items have the same shape either way. LLM plans are preceded by a 'prompt_stats' item.
     """
-    # ... (Implementation is identical to the previous correct version) ...
+    if use_fast_path:
+        decision = await router.fast_path_router.route(new_user_query, message_history, available_tools, sticky_function_hint)
+        if decision is not None:
+            log.info(f"Fast-path routed via {decision.source} (confidence {decision.confidence:.2f})")
+            for item in decision.as_events():
+                yield item
+            return
+
+    static_sections = static_sections or get_static_sections(user_context, business_summary, available_tools)
     history_for_prompt = message_history + [{"role": "user", "content": new_user_query}]
-    history_str = json.dumps(history_for_prompt, indent=2)
-    context_str = json.dumps(user_context, indent=2)
-    business_str = json.dumps(business_summary, indent=2)
-    tools_str = json.dumps(available_tools, indent=2)
+    history_str = compact_json(history_for_prompt)
 
     hint_text = ""
     if sticky_function_hint:
-        hint_text = f"\nHint: The previous turn involved a follow-up question from the function: '{sticky_function_hint}'. Consider routing back to this function if the user's current query seems to answer that question or is directly related, unless the query is clearly about a different topic."
-
-    system_prompt = f"""You are an AI assistant for QuickBooks. Your task is to analyze the user's query, chat history, user context, and business summary to determine the best way to route the query using the available tools.
-{hint_text}
-
-Follow these steps precisely:
-
-1.  **Chain of Thought (CoT):** First, perform a chain of thought analysis. Output this reasoning process as 2-4 separate JSON Lines payloads. Each payload must be a valid JSON object containing a single key "thought" with the reasoning step as its string value. Consider the hint if provided.
-
-2.  **Function Call Selection:** After the CoT JSON Lines, output a *single* JSON Line payload. This payload must be a valid JSON object containing a single key "function_calls". The value of "function_calls" must be a *list* of JSON objects, each containing "name" and "arguments". If no function call is needed, output an empty list: {{"function_calls": []}}.
-
-3.  **Final Explanation:** If and only if *no* function calls are selected (i.e., "function_calls" is an empty list), output one *last* JSON Line payload containing a single key "explanation". The value should be a brief string explaining *why* no tool was needed and potentially providing a direct answer if possible. Do *not* output an "explanation" if function calls are made.
-
-**Available Tools:**
-{tools_str}
-
-User's Last Query:
-"{new_user_query}"
+        hint_text = f"\nHint: The previous turn involved a follow-up question from the function: '{sticky_function_hint}'. Consider routing back to this function if the user's current query seems to answer that question or is directly related, unless the query is clearly about a different topic.\n"
 
+    # Static prefix first (cacheable), per-turn content after it
+    system_prompt = static_sections.planning_prefix + f"""{hint_text}
 Chat History:
 {history_str}
 
-User Context:
-{context_str}
-
-Business Summary:
-{business_str}
+User's Last Query:
+"{new_user_query}"
 
 Output Format Reminder:
 Your entire output must be a sequence of valid JSON Lines. Start with the 'thought' lines, then the 'function_calls' line. Only include the 'explanation' line if 'function_calls' was empty. Do not include any text outside of these JSON Line payloads. No markdown formatting.
 """
     expected_keys = ['thought', 'function_calls', 'explanation']
+    yield {"type": "prompt_stats", "data": prompt_stats("planning", system_prompt, {
+        "static_prefix": static_sections.planning_prefix, "history": history_str
+    })}
     try:
         async for item in _execute_llm_json_lines(
             prompt=system_prompt,
             expected_keys=expected_keys,
             model_name=model_name,
-            temperature=temperature
+            temperature=temperature,
+            static_prefix=static_sections.planning_prefix
         ):
+            if use_fast_path and item.get("type") == "function_calls":
+                await router.fast_path_router.remember(new_user_query, message_history, available_tools, sticky_function_hint, item.get("data"))
             yield item
     except Exception as e:
-        print(f"Helper ERROR in process_quickbooks_query calling core LLM: {e}")
+        log.error(f"process_quickbooks_query failed calling core LLM: {e}")
         yield {"type": "error", "data": f"Core LLM error during planning: {e}"}
 
 
+# --- Cheap Keyword Classifier (used for speculative retrieval) ---
+def classify_query_tool(query: str, available_tools: List[Dict[str, Any]]) -> Optional[str]:
+    """
+    Returns the highest-confidence tool matched by the router's keyword rules, or None.
+    Cheap (regex only) - good enough to pick a speculative retrieval target, not to replace planning.
+    """
+    matches = router.rule_matches(query, {tool.get("name") for tool in available_tools})
+    if not matches:
+        return None
+    return max(matches, key=lambda match: match[1])[0]
+
+
 # --- LLM Simulation Stub Function (MODIFIED for Legal Logic) ---
 async def simulate_retrieval_stub(
     function_name: str,
@@ -274,7 +377,7 @@ async def simulate_retrieval_stub(
     Returns a dict with: function_name, retrieved_chunks, present_as_is,
                          follow_up_question, asked_for_sticky, rejected, rejection_reason, error
     """
-    print(f"\n--- Helper: Simulating Retrieval for Tool: '{function_name}' (Async w/ Flags) ---")
+    stub_log.debug(f"Simulating retrieval for tool '{function_name}'")
     query = queries[0] if queries else "" # Get the single query
 
     # Default return values
@@ -291,7 +394,7 @@ async def simulate_retrieval_stub(
 
     # --- MODIFIED: Legal Specific Logic (Standard Response) ---
     if function_name == "legal_compliance_retrieval":
-        print(f"Helper Stub: Handling legal query with standard response: '{query}'")
+        stub_log.info(f"Handling legal query with standard response: '{query}'")
         standard_legal_warning = "I cannot process requests related to potentially illegal activities or provide guidance on circumventing laws or regulations. Also, I cannot address any questions about credit worthiness or why somebody was rejected for an application. Please ensure your questions comply with legal and ethical standards."
         result["retrieved_chunks"] = [
             {
@@ -309,7 +412,7 @@ async def simulate_retrieval_stub(
     if function_name == "payroll_qna_retrieval":
         has_contribution = "contribution" in query.lower()
         if has_contribution:
-            print(f"Helper Stub: Payroll query is about contribution: '{query}'. Asking follow-up.")
+            stub_log.info(f"Payroll query is about contribution: '{query}'. Asking follow-up.")
             result["follow_up_question"] = "I see you want to know about payroll, but I can't answer questions about contributions. Did you want to know about W2s?"
             result["asked_for_sticky"] = True
             return result # Return immediately
@@ -318,22 +421,42 @@ async def simulate_retrieval_stub(
     if function_name == "general_product_support_retrieval":
         # Reject if query is clearly about payroll or legal (including contributions)
         if re.search(r'\b(payroll|tax advice|legal|w2|1099|contribution)\b', query, re.IGNORECASE):
-            print(f"Helper Stub: Rejecting general support query about payroll/legal: '{query}'")
+            stub_log.info(f"Rejecting general support query about payroll/legal: '{query}'")
             result["rejected"] = True
             result["rejection_reason"] = "This question seems related to payroll or legal matters. Please try asking the specific payroll or legal tool."
             return result
 
+    # --- Retrieval Cache (exact, then optional semantic match) ---
+    if retrieval_cache is not None:
+        cached_result = await retrieval_cache.get(function_name, query, top_k)
+        if cached_result is not None:
+            stub_log.info(f"Retrieval cache hit for '{function_name}'", extra={"sample": "stub"})
+            return cached_result
+
+    # --- Local Vector Index (when this tool has an ingested namespace) ---
+    if use_vector_retrieval(function_name):
+        stub_log.info(f"Searching local vector index for '{function_name}'", extra={"sample": "stub"})
+        try:
+            retrieved_chunks = await vector_store.search(function_name, query, top_k)
+        except Exception as e:
+            stub_log.error(f"Vector search failed for query '{query}': {e}")
+            result["error"] = f"Vector search failed: {e}"
+            result["rejected"] = True
+            result["rejection_reason"] = "Internal error during tool execution."
+            return result
+        if retrieved_chunks:
+            result["retrieved_chunks"] = retrieved_chunks
+            result["present_as_is"] = bool(re.search(r'compliance', function_name, re.IGNORECASE))
+            if retrieval_cache is not None:
+                await retrieval_cache.put(function_name, query, top_k, result)
+        else:
+            result["rejected"] = True
+            result["rejection_reason"] = "Could not find relevant information for this query."
+        return result
+
     # --- Proceed with Normal Simulation (Only if not handled above) ---
-    print(f"Helper Stub: Proceeding with normal simulation for '{function_name}'")
+    stub_log.info(f"Proceeding with normal simulation for '{function_name}'", extra={"sample": "stub"})
     all_generated_chunks = {}
-    try:
-        model = genai.GenerativeModel(model_name)
-    except Exception as e:
-        print(f"Helper ERROR initializing simulation model '{model_name}': {e}")
-        result["error"] = f"Model init failed: {e}"
-        result["rejected"] = True # Mark as rejected due to error
-        result["rejection_reason"] = "Internal error during tool initialization."
-        return result
 
     simulation_prompt = f"""
     You are simulating a QuickBooks knowledge base retrieval system.
@@ -350,12 +473,14 @@ async def simulate_retrieval_stub(
 
     JSON response:
     """
+    prompt_stats("retrieval", simulation_prompt)
     try:
-        response = await model.generate_content_async(
+        raw_llm_output = await llm_scheduler.generate(
             simulation_prompt,
-            generation_config=genai.types.GenerationConfig(temperature=0.6)
+            model_name=model_name,
+            temperature=0.6,
+            stage="retrieval"
         )
-        raw_llm_output = response.text
         json_match = re.search(r'```json\s*({.*?})\s*```', raw_llm_output, re.DOTALL | re.IGNORECASE)
         if not json_match:
              json_match = re.search(r'({.*?})', raw_llm_output, re.DOTALL)
@@ -371,15 +496,16 @@ async def simulate_retrieval_stub(
                         if link not in all_generated_chunks:
                             all_generated_chunks[link] = chunk
         # else:
-        #     print(f"  Helper Stub Warning: Could not extract JSON for query '{query}'. Output: {raw_llm_output[:200]}...")
+        #     stub_log.warning(f"Could not extract JSON for query '{query}'. Output: {raw_llm_output[:200]}...")
 
     except json.JSONDecodeError as e:
-        print(f"  Helper Stub Error: Failed to parse JSON from LLM simulation response: {e}")
+        stub_log.error(f"Failed to parse JSON from LLM simulation response: {e}")
         result["error"] = f"JSON parsing failed: {e}"
         result["rejected"] = True # Mark as rejected due to error
         result["rejection_reason"] = "Internal error processing tool results."
     except Exception as e:
-        print(f"  Helper Stub Error during async LLM simulation call or processing for query '{query}': {e}")
+        stub_log.error(f"Async LLM simulation failed for query '{query}': {e}")
+        metrics.llm_errors_total.inc(stage="retrieval")
         result["error"] = f"LLM call failed: {e}"
         result["rejected"] = True # Mark as rejected due to error
         result["rejection_reason"] = "Internal error during tool execution."
@@ -391,14 +517,76 @@ async def simulate_retrieval_stub(
          # Determine present_as_is based on function name (already done for legal)
          result["present_as_is"] = bool(re.search(r'compliance', function_name, re.IGNORECASE)) # Example: only legal/compliance is as-is by default
     elif not result["error"] and not result["rejected"]: # No chunks but no specific error reported
-        print(f"  Helper Stub Warning: No chunks generated for query '{query}' but no error reported.")
+        stub_log.warning(f"No chunks generated for query '{query}' but no error reported.")
         # Optionally mark as rejected if no content found is considered a rejection
         result["rejected"] = True
         result["rejection_reason"] = "Could not find relevant information for this query."
 
+    # Only successful retrievals are cached; errors should be retried on the next call
+    if retrieval_cache is not None and result["retrieved_chunks"] and not result["error"]:
+        await retrieval_cache.put(function_name, query, top_k, result)
+
     return result
 
 
+# --- Fused Pipeline (retrieval inline, one LLM call) ---
+def select_fused_tool(
+    query: str,
+    message_history: List[Dict[str, str]],
+    available_tools: List[Dict[str, Any]],
+    sticky_function_hint: Optional[str] = None
+) -> Optional[str]:
+    """The tool for a fused turn: the keyword rules' only match, if it is listed in FUSED_TOOLS. None otherwise."""
+    if not FUSED_TOOLS or sticky_function_hint:
+        return None
+    matched = {tool_name for tool_name, _ in router.rule_matches(query, {tool.get("name") for tool in available_tools})}
+    if len(matched) != 1:
+        return None
+    tool_name = matched.pop()
+    return tool_name if tool_name in FUSED_TOOLS else None
+
+
+async def process_fused_query(
+    new_user_query: str,
+    message_history: List[Dict[str, str]],
+    user_context: Dict[str, Any],
+    business_summary: Dict[str, Any],
+    available_tools: List[Dict[str, Any]],
+    tool_name: str,
+    top_k: int = 2,
+    static_sections: Optional[StaticPromptSections] = None
+) -> AsyncGenerator[Dict[str, Any], None]:
+    """
+    Fused turn for a tool with a fast retriever: no planning call, retrieval runs inline, and a single
+    synthesis call both checks the routing and writes the cited answer.
+    Yields 'fused_retrieval' ({"call", "result"}) first, then the generate_final_response items.
+    Yields 'fused_fallback' (before any answer text) when the turn needs the three-phase pipeline instead:
+    the retrieval asked a follow-up, was rejected or came back empty, or the model found the sources off-topic.
+    """
+    tool = next(tool for tool in available_tools if tool.get("name") == tool_name)
+    call = router.build_tool_call(tool, new_user_query)
+    result = await simulate_retrieval_stub(function_name=tool_name, queries=[new_user_query], top_k=top_k)
+    yield {"type": "fused_retrieval", "data": {"call": call, "result": result}}
+
+    if result.get("follow_up_question") or result.get("rejected") or result.get("error") or not result.get("retrieved_chunks"):
+        yield {"type": "fused_fallback", "data": "Retrieval result needs the full pipeline."}
+        return
+
+    async for item in generate_final_response(
+        original_user_query=new_user_query,
+        message_history=message_history + [{"role": "user", "content": new_user_query}],
+        user_context=user_context,
+        business_summary=business_summary,
+        all_retrieval_results=[result],
+        static_sections=static_sections,
+        available_tools=available_tools,
+        fused_tool=tool_name
+    ):
+        yield item
+        if item.get("type") == "fused_fallback":
+            return
+
+
 # --- Final Response Generation Function (MODIFIED to handle present_as_is from rejected) ---
 async def generate_final_response(
     original_user_query: str,
@@ -407,14 +595,27 @@ async def generate_final_response(
     business_summary: Dict[str, Any],
     all_retrieval_results: List[Dict[str, Any]], # Contains full stub result dicts
     model_name: str = 'gemini-1.5-flash-001',
-    temperature: float = 0.3
+    temperature: float = 0.3,
+    static_sections: Optional[StaticPromptSections] = None,
+    available_tools: Optional[List[Dict[str, Any]]] = None,
+    fused_tool: Optional[str] = None
 ) -> AsyncGenerator[Dict[str, Any], None]:
     """
     Async generator for final response synthesis with citations.
     Handles rejected results and ensures 'present_as_is' chunks from rejected tools are handled.
-    Yields dicts for 'thought', 'final_response_text', 'citation_map', or 'error'.
+    Yields dicts for 'prompt_stats', 'thought', 'final_response_text_delta', 'final_response_text', 'citation_map', or 'error'.
+    With fused_tool set (no planning step ran), the model may instead yield 'fused_fallback' if the sources don't fit the query.
     """
-    print(f"\n--- Helper: Generating Final Response w/ Citations & Rejection Handling ---")
+    log.debug("Generating final response with citations and rejection handling")
+
+    # 0. Fully determined outcomes (verbatim-only, rejection-only, follow-up, empty) skip the LLM
+    # Not recorded in bypass_stats here: callers record once per turn (a fused fallback calls this twice)
+    assembled = assemble_response(all_retrieval_results)
+    if assembled is not None:
+        log.info(f"Deterministic '{assembled.outcome}' response, no LLM call.")
+        for item in assembled.as_events():
+            yield item
+        return
 
     # 1. Process Retrieval Results for Citation, Rejection, and Present As Is
     processed_chunks_for_citation = []
@@ -458,38 +659,6 @@ async def generate_final_response(
                     source_details_for_prompt.append(f"[{chunk_id}] Title: {article} | URL: {link}")
                     citation_id_counter += 1
 
-    # --- Handle cases based on results ---
-    if not successful_results_chunks and rejected_results:
-        # ALL results were rejected OR had errors preventing chunk retrieval
-        print("Helper: All function calls resulted in rejection or error.")
-        yield {"type": "thought", "data": "All tools rejected the request or could not provide data."}
-
-        # Combine standard rejection messages and specific reasons
-        final_rejection_message = ""
-        if present_as_is_from_rejected:
-            # If we have a standard warning (like legal), use that primarily
-            final_rejection_message = "\n".join(present_as_is_from_rejected)
-        else:
-            # Otherwise, summarize rejection reasons
-            reasons = [r.get('rejection_reason', 'No specific reason provided.') for r in rejected_results if r.get('rejection_reason')]
-            if reasons:
-                rejection_summary = "I couldn't process your request fully because: " + " ".join(reasons)
-            else:
-                rejection_summary = "I was unable to process your request with the available tools."
-            final_rejection_message = rejection_summary
-
-        yield {"type": "final_response_text", "data": final_rejection_message}
-        yield {"type": "citation_map", "data": {}} # No citations for rejected-only path
-        return
-
-    if not successful_results_chunks and not rejected_results:
-         # No successful results, no rejections (e.g., planning failed before execution)
-        print("Helper Warning: No successful or rejected results found for summarization.")
-        yield {"type": "thought", "data": "No usable information retrieved from functions."}
-        yield {"type": "final_response_text", "data": "I couldn't find specific information to answer your question based on the search results."}
-        yield {"type": "citation_map", "data": {}}
-        return
-
     # --- Proceed with summarization using successful results ---
     # Prepare chunks based on 'present_as_is' flag ONLY from successful results
     present_as_is_chunks_prompt = "\n".join([f"[{c['id']}] {c['content']}" for c in processed_chunks_for_citation if c['present_as_is']]) or "None"
@@ -508,34 +677,12 @@ async def generate_final_response(
         standard_warnings_prompt = "\n".join(present_as_is_from_rejected) + "\n\n" # Add spacing
 
 
-    # 2. Construct Prompt
-    history_str = json.dumps(message_history, indent=2)
-    context_str = json.dumps(user_context, indent=2)
-    business_str = json.dumps(business_summary, indent=2)
-
-    system_prompt = f"""You are an AI assistant for QuickBooks. Your task is to synthesize a helpful and concise final response. Start with any standard warnings provided. Then, incorporate information from the successful sources, citing them accurately using bracketed numerical IDs `[id]`. Also consider mentioning limitations based on rejected parts of the query.
+    # 2. Construct Prompt (static prefix first, per-turn content after it)
+    static_sections = static_sections or get_static_sections(user_context, business_summary, available_tools or [])
+    history_str = compact_json(message_history)
 
-Follow these steps precisely:
-
-1.  **Standard Warnings First:** Check the 'Standard Warnings' section below. If it contains text, begin your final response *exactly* with that text, followed by two newlines.
-2.  **Chain of Thought (CoT):** Perform a chain of thought analysis (output as JSON Lines with key "thought"). Consider:
-    *   User's query: "{original_user_query}" and history: {history_str}.
-    *   Standard Warnings (already handled in step 1).
-    *   'Content to Present Verbatim' (from successful sources): Plan inclusion with citation `[id]`.
-    *   'Content to Summarize' (from successful sources): Plan synthesis, citing *all* used info with `[id]`. Use `[1][2]` if needed.
-    *   'Rejected Query Parts': Decide if/how to briefly mention this limitation *after* presenting the successful information.
-    *   Drafting the core message (after any standard warning), ensuring correct citations for successful content.
-    *   Refining the final response for clarity, conciseness, tone.
-
-3.  **Cited Response Generation:** After CoT, output a *single* JSON Line (key "final_response_text"). The value is the complete response string: Standard Warnings (if any) + Synthesized/Cited Answer + Optional Rejection Note. Include bracketed citations `[id]` for successful content.
-
-4.  **Citation Map Generation:** Immediately after "final_response_text", output *one more* JSON Line (key "citation_map"). Value is a JSON object mapping string IDs used in the text (only from successful sources) to their {{"title": ..., "link": ...}}. Example: {{ "1": {{ "title": "A", "link": "..." }}, "3": {{ "title": "B", "link": "..." }} }}
-
-**Context:**
+    system_prompt = static_sections.synthesis_prefix + f"""*   Conversation History: {history_str}.
 *   User's Original Query: "{original_user_query}"
-*   Conversation History: {history_str}.
-*   User Context: {context_str}.
-*   Business Summary: {business_str}.
 
 **Standard Warnings (Start response with this text if present):**
 {standard_warnings_prompt}
@@ -554,22 +701,33 @@ Follow these steps precisely:
 
 Output Format Reminder:
 Sequence of JSON Lines: 'thought' lines, then 'final_response_text', then 'citation_map'. No markdown formatting outside JSON Lines. Ensure all cited IDs exist in the citation map and correspond to successful sources.
+"""
+    if fused_tool:
+        system_prompt += f"""
+Routing Check:
+No planning step ran. The sources above come from '{fused_tool}', picked by keyword match. First decide in your 'thought' lines whether they address the user's query. If they do not, output only {{"fused_fallback": true}} after your thoughts and stop.
 """
 
     # 3. Define expected keys
-    expected_keys = ['thought', 'final_response_text', 'citation_map']
+    expected_keys = ['thought', 'final_response_text', 'citation_map'] + (['fused_fallback'] if fused_tool else [])
+    yield {"type": "prompt_stats", "data": prompt_stats("synthesis", system_prompt, {
+        "static_prefix": static_sections.synthesis_prefix, "history": history_str,
+        "retrieved_content": present_as_is_chunks_prompt + summarizable_chunks_prompt + all_sources_prompt
+    })}
 
-    # 4. Call the core LLM async generator
+    # 4. Call the core LLM async generator (answer text is also streamed as 'final_response_text_delta')
     try:
         async for item in _execute_llm_json_lines(
             prompt=system_prompt,
             expected_keys=expected_keys,
             model_name=model_name,
-            temperature=temperature
+            temperature=temperature,
+            stream_keys=['final_response_text'],
+            static_prefix=static_sections.synthesis_prefix
         ):
             yield item
     except Exception as e:
-        print(f"Helper ERROR in generate_final_response calling core LLM: {e}")
+        log.error(f"generate_final_response failed calling core LLM: {e}")
         yield {"type": "error", "data": f"Core LLM error during citation/rejection response generation: {e}"}
 
-    print("\n--- Helper: Finished Generating Final Response w/ Citations & Rejection Handling ---")
\ No newline at end of file
+    log.debug("Finished generating final response")
\ No newline at end of file
@@ -0,0 +1,168 @@
+# history.py
+
+import json
+import math
+import os
+import re
+from collections import defaultdict
+from typing import List, Dict, Any, Optional, Tuple
+
+from llm_scheduler import llm_scheduler
+import metrics
+from structured_log import get_logger
+
+log = get_logger("History")
+
+# --- Configuration ---
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1500"))
+HISTORY_SUMMARY_TOKENS = int(os.getenv("HISTORY_SUMMARY_TOKENS", "300"))
+HISTORY_SUMMARY_MODE = os.getenv("HISTORY_SUMMARY_MODE", "extractive").lower() # "extractive" or "llm"
+HISTORY_SUMMARY_MODEL = os.getenv("HISTORY_SUMMARY_MODEL", "gemini-1.5-flash-001")
+
+SUMMARY_ROLE = "system"
+SUMMARY_PREFIX = "Summary of earlier conversation: "
+
+
+# --- Token Accounting ---
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 characters per token) - close enough for budgeting."""
+    return math.ceil(len(text) / 4) if text else 0
+
+
+def compact_json(value: Any) -> str:
+    """Non-indented JSON for prompts; indentation alone adds ~30% tokens to nested structures."""
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False)
+
+
+# Cumulative prompt tokens per stage for this process
+prompt_token_totals: Dict[str, int] = defaultdict(int)
+prompt_call_counts: Dict[str, int] = defaultdict(int)
+
+
+def prompt_stats(stage: str, prompt: str, sections: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    """Records and returns the estimated prompt size of one LLM call, with a per-section breakdown."""
+    total = estimate_tokens(prompt)
+    prompt_token_totals[stage] += total
+    prompt_call_counts[stage] += 1
+    return {
+        "stage": stage,
+        "prompt_tokens": total,
+        "sections": {name: estimate_tokens(text) for name, text in (sections or {}).items()}
+    }
+
+
+def prompt_token_report() -> Dict[str, Dict[str, float]]:
+    return {
+        stage: {"calls": prompt_call_counts[stage], "prompt_tokens": total, "avg_prompt_tokens": total / max(prompt_call_counts[stage], 1)}
+        for stage, total in prompt_token_totals.items()
+    }
+
+
+# --- Rolling Summaries ---
+def _first_sentence(text: str, limit: int = 160) -> str:
+    text = re.sub(r"\s+", " ", text).strip()
+    match = re.match(r"(.+?[.!?])(\s|$)", text)
+    sentence = match.group(1) if match else text
+    return sentence if len(sentence) <= limit else sentence[:limit - 3].rstrip() + "..."
+
+
+def _trim_to_tokens(text: str, max_tokens: int) -> str:
+    """Keeps the most recent part of the summary when it outgrows its budget."""
+    max_chars = max_tokens * 4
+    if len(text) <= max_chars:
+        return text
+    trimmed = text[-max_chars:]
+    line_break = trimmed.find("\n")
+    return trimmed[line_break + 1:] if 0 <= line_break < len(trimmed) - 1 else trimmed
+
+
+def extractive_summary(previous_summary: str, new_messages: List[Dict[str, str]], max_tokens: int) -> str:
+    """Folds new messages into the summary as one short line each (no LLM call)."""
+    lines = [previous_summary] if previous_summary else []
+    for message in new_messages:
+        role = "User" if message.get("role") == "user" else "Assistant"
+        lines.append(f"{role}: {_first_sentence(message.get('content', ''))}")
+    return _trim_to_tokens("\n".join(lines), max_tokens)
+
+
+async def llm_summary(previous_summary: str, new_messages: List[Dict[str, str]], max_tokens: int) -> str:
+    """Asks the LLM backend to update the running summary; falls back to the extractive summary on error."""
+    prompt = f"""You maintain a running conversation summary for a QuickBooks support assistant.
+Update the summary with the new messages. Keep facts the assistant may need later (user goals, account details, open questions).
+Respond with the updated summary text only, at most {max_tokens * 3 // 4} words.
+
+Current Summary:
+{previous_summary or "(empty)"}
+
+New Messages:
+{compact_json(new_messages)}
+"""
+    try:
+        text = await llm_scheduler.generate(prompt, model_name=HISTORY_SUMMARY_MODEL, temperature=0.1, stage="summary")
+        return _trim_to_tokens(text.strip(), max_tokens)
+    except Exception as e:
+        log.warning(f"LLM summary failed ({e}); using extractive summary.")
+        metrics.llm_errors_total.inc(stage="summary")
+        return extractive_summary(previous_summary, new_messages, max_tokens)
+
+
+# --- Compaction ---
+class HistoryCompactor:
+    """
+    Fits conversation history into a token budget: the most recent messages are kept verbatim and
+    everything older is folded into a rolling summary. The summary is cached by the caller (e.g. on the
+    session) together with how many messages it covers, so each turn only summarizes newly evicted messages.
+    """
+
+    def __init__(
+        self,
+        budget_tokens: int = HISTORY_TOKEN_BUDGET,
+        summary_tokens: int = HISTORY_SUMMARY_TOKENS,
+        mode: str = HISTORY_SUMMARY_MODE
+    ):
+        self.budget_tokens = budget_tokens
+        self.summary_tokens = summary_tokens
+        self.mode = mode
+
+    def _window_start(self, messages: List[Dict[str, str]]) -> int:
+        """Index of the oldest message that still fits in the verbatim window."""
+        available = max(self.budget_tokens - self.summary_tokens, 0)
+        used = 0
+        start = len(messages)
+        for index in range(len(messages) - 1, -1, -1):
+            cost = estimate_tokens(messages[index].get("content", "")) + 4 # Role/markup overhead
+            if used + cost > available and start < len(messages):
+                break
+            used += cost
+            start = index
+        return start
+
+    async def compact(
+        self,
+        messages: List[Dict[str, str]],
+        summary: str = "",
+        summarized_upto: int = 0
+    ) -> Tuple[List[Dict[str, str]], str, int]:
+        """
+        Returns (messages_for_prompt, summary, summarized_upto).
+        messages_for_prompt starts with a summary message when older turns were folded away.
+        """
+        if summarized_upto > len(messages): # History was reset or replaced
+            summary, summarized_upto = "", 0
+
+        start = max(self._window_start(messages), summarized_upto if summary else 0)
+        if start > summarized_upto:
+            newly_evicted = messages[summarized_upto:start]
+            if self.mode == "llm":
+                summary = await llm_summary(summary, newly_evicted, self.summary_tokens)
+            else:
+                summary = extractive_summary(summary, newly_evicted, self.summary_tokens)
+            summarized_upto = start
+
+        window = list(messages[start:])
+        if summary:
+            window.insert(0, {"role": SUMMARY_ROLE, "content": SUMMARY_PREFIX + summary})
+        return window, summary, summarized_upto
+
+
+history_compactor = HistoryCompactor()
@@ -0,0 +1,226 @@
+# ingest.py
+"""
+Offline ingestion for the local retrieval engine (vector_store.py).
+
+Chunks help articles and embeds them into one faiss index per tool namespace:
+
+    python ingest.py --namespace payroll_qna_retrieval --input articles/payroll/
+    python ingest.py --namespace general_product_support_retrieval --input support.jsonl
+
+Inputs are directories of .md/.txt/.html files or .jsonl files with one
+{"title", "url", "content"} object per line. Markdown/text files may start with
+"Title: ..." and "URL: ..." header lines; otherwise the first heading and the file path are used.
+"""
+
+import argparse
+import html
+import json
+import os
+import re
+import shutil
+import sys
+import time
+from typing import List, Dict, Iterator
+
+import embeddings
+from vector_store import RETRIEVAL_INDEX_DIR, INDEX_FILE, CHUNKS_FILE, META_FILE, faiss, namespace_dir
+
+DEFAULT_CHUNK_CHARS = 1200
+DEFAULT_OVERLAP_CHARS = 200
+ARTICLE_EXTENSIONS = (".md", ".txt", ".html", ".htm")
+
+
+# --- Article Loading ---
+def _html_to_text(raw: str) -> str:
+    try:
+        from bs4 import BeautifulSoup
+        return BeautifulSoup(raw, "html.parser").get_text("\n")
+    except ImportError:
+        text = re.sub(r"(?is)<(script|style).*?</\1>", " ", raw)
+        text = re.sub(r"(?i)<br\s*/?>|</p>|</h\d>|</li>", "\n", text)
+        return html.unescape(re.sub(r"<[^>]+>", " ", text))
+
+
+def _load_article_file(path: str) -> Dict[str, str]:
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        raw = f.read()
+    title, url = None, None
+    if path.lower().endswith((".html", ".htm")):
+        title_match = re.search(r"(?is)<title>(.*?)</title>", raw)
+        canonical_match = re.search(r'(?i)<link[^>]+rel="canonical"[^>]+href="([^"]+)"', raw)
+        title = html.unescape(title_match.group(1).strip()) if title_match else None
+        url = canonical_match.group(1) if canonical_match else None
+        body = _html_to_text(raw)
+    else:
+        body_lines = []
+        for line in raw.splitlines():
+            header = re.match(r"^(title|url):\s*(.+)$", line.strip(), re.IGNORECASE)
+            if header and not body_lines:
+                if header.group(1).lower() == "title":
+                    title = header.group(2).strip()
+                else:
+                    url = header.group(2).strip()
+                continue
+            body_lines.append(line)
+        body = "\n".join(body_lines)
+        heading = re.search(r"^#+\s+(.+)$", body, re.MULTILINE)
+        if title is None and heading:
+            title = heading.group(1).strip()
+    return {
+        "title": title or os.path.splitext(os.path.basename(path))[0].replace("-", " ").replace("_", " "),
+        "url": url or "file://" + os.path.abspath(path),
+        "content": body
+    }
+
+
+def iter_articles(inputs: List[str]) -> Iterator[Dict[str, str]]:
+    for input_path in inputs:
+        if os.path.isdir(input_path):
+            for root, _, files in os.walk(input_path):
+                for name in sorted(files):
+                    if name.lower().endswith(ARTICLE_EXTENSIONS):
+                        yield _load_article_file(os.path.join(root, name))
+        elif input_path.lower().endswith(".jsonl"):
+            with open(input_path, "r", encoding="utf-8") as f:
+                for line_number, line in enumerate(f, 1):
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    content = record.get("content") or record.get("body") or ""
+                    if not content:
+                        print(f"Ingest Warning: {input_path}:{line_number} has no content, skipping.")
+                        continue
+                    yield {
+                        "title": record.get("title") or f"Article {line_number}",
+                        "url": record.get("url") or record.get("source_link") or f"{input_path}#{line_number}",
+                        "content": content
+                    }
+        else:
+            yield _load_article_file(input_path)
+
+
+# --- Chunking ---
+def _split_long(paragraph: str, max_chars: int) -> List[str]:
+    """Splits an oversized paragraph on sentence boundaries (then words) to fit max_chars."""
+    pieces, current = [], ""
+    for sentence in re.split(r"(?<=[.!?])\s+", paragraph):
+        while len(sentence) > max_chars:
+            cut = sentence.rfind(" ", 0, max_chars)
+            cut = cut if cut > 0 else max_chars
+            if current:
+                pieces.append(current)
+                current = ""
+            pieces.append(sentence[:cut].strip())
+            sentence = sentence[cut:].strip()
+        if current and len(current) + len(sentence) + 1 > max_chars:
+            pieces.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}".strip()
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def chunk_text(text: str, max_chars: int = DEFAULT_CHUNK_CHARS, overlap_chars: int = DEFAULT_OVERLAP_CHARS) -> List[str]:
+    """Packs paragraphs into chunks of at most ~max_chars; each chunk repeats the tail of the previous one."""
+    paragraphs = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = re.sub(r"\s+", " ", paragraph).strip()
+        if paragraph:
+            paragraphs.extend(_split_long(paragraph, max_chars))
+
+    chunks, current = [], ""
+    for paragraph in paragraphs:
+        if current and len(current) + len(paragraph) + 2 > max_chars:
+            chunks.append(current)
+            tail = current[-overlap_chars:] if overlap_chars > 0 else ""
+            space = tail.find(" ")
+            tail = tail[space + 1:] if space >= 0 and len(current) > overlap_chars else tail
+            current = f"{tail}\n\n{paragraph}" if tail else paragraph
+        else:
+            current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+# --- Index Building ---
+def build_namespace(
+    namespace: str,
+    inputs: List[str],
+    index_dir: str = RETRIEVAL_INDEX_DIR,
+    max_chars: int = DEFAULT_CHUNK_CHARS,
+    overlap_chars: int = DEFAULT_OVERLAP_CHARS,
+    batch_size: int = 64
+) -> Dict[str, int]:
+    """Chunks and embeds every article, then atomically replaces <index_dir>/<namespace>."""
+    if faiss is None or not embeddings.embeddings_available():
+        raise RuntimeError("Ingestion requires faiss, numpy and sentence-transformers to be installed.")
+    target_dir = namespace_dir(index_dir, namespace)
+
+    chunks = []
+    article_count = 0
+    for article in iter_articles(inputs):
+        article_count += 1
+        for chunk in chunk_text(article["content"], max_chars, overlap_chars):
+            chunks.append({"chunk_content": chunk, "source_article": article["title"], "source_link": article["url"]})
+    if not chunks:
+        raise RuntimeError(f"No article content found in {inputs}")
+    print(f"Ingest: {article_count} articles -> {len(chunks)} chunks for '{namespace}'.")
+
+    start = time.perf_counter()
+    index = None
+    for offset in range(0, len(chunks), batch_size):
+        vectors = embeddings.embed_texts([c["chunk_content"] for c in chunks[offset:offset + batch_size]])
+        if index is None:
+            index = faiss.IndexFlatIP(vectors.shape[1]) # Vectors are normalized: inner product == cosine
+        index.add(vectors)
+    print(f"Ingest: Embedded {len(chunks)} chunks in {time.perf_counter() - start:.1f}s.")
+
+    # Write to a staging directory and swap it in, so a running server never sees a half-written index
+    staging_dir = target_dir + ".staging"
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    os.makedirs(staging_dir)
+    faiss.write_index(index, os.path.join(staging_dir, INDEX_FILE))
+    with open(os.path.join(staging_dir, CHUNKS_FILE), "w", encoding="utf-8") as f:
+        for chunk in chunks:
+            f.write(json.dumps(chunk, ensure_ascii=False) + "\n")
+    with open(os.path.join(staging_dir, META_FILE), "w", encoding="utf-8") as f:
+        json.dump({
+            "namespace": namespace,
+            "embedding_model": embeddings.EMBEDDING_MODEL_NAME,
+            "dim": index.d,
+            "articles": article_count,
+            "chunks": len(chunks),
+            "created_at": time.time()
+        }, f, indent=2)
+    old_dir = target_dir + ".old"
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(target_dir):
+        os.replace(target_dir, old_dir)
+    os.replace(staging_dir, target_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    print(f"Ingest: Wrote index to '{target_dir}'.")
+    return {"articles": article_count, "chunks": len(chunks)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build a local retrieval index for one tool namespace.")
+    parser.add_argument("--namespace", required=True, help="Tool name, e.g. payroll_qna_retrieval")
+    parser.add_argument("--input", required=True, action="append", help="Article directory, file or .jsonl (repeatable)")
+    parser.add_argument("--index-dir", default=RETRIEVAL_INDEX_DIR)
+    parser.add_argument("--chunk-chars", type=int, default=DEFAULT_CHUNK_CHARS)
+    parser.add_argument("--overlap-chars", type=int, default=DEFAULT_OVERLAP_CHARS)
+    parser.add_argument("--batch-size", type=int, default=64)
+    args = parser.parse_args(argv)
+    try:
+        build_namespace(args.namespace, args.input, args.index_dir, args.chunk_chars, args.overlap_chars, args.batch_size)
+    except (RuntimeError, ValueError) as e:
+        print(f"Ingest ERROR: {e}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,155 @@
+# json_stream.py
+
+import json
+import re
+from typing import List, Optional, Tuple
+
+_FIELD_PREFIX = re.compile(r'\s*\{\s*"([A-Za-z0-9_]+)"\s*:\s*"')
+_STRING_SPECIAL = re.compile(r'[\\"]')
+_MAX_PREFIX_SCAN = 128 # A prefix that hasn't matched by now never will
+
+
+# --- Incremental JSON String Decoding ---
+class IncrementalStringFieldParser:
+    """
+    Incrementally decodes the string value of a JSON Lines object whose first key is one of `keys`,
+    e.g. '{"final_response_text": "Hello wor' -> 'Hello wor'.
+
+    feed() receives the whole partial line seen so far and returns (key, newly_decoded_text) or None.
+    Escape sequences (including surrogate pairs) split across chunks are held back until complete.
+    Call reset() whenever a new line starts.
+    """
+
+    def __init__(self, keys: List[str]):
+        self.keys = set(keys)
+        self.reset()
+
+    def reset(self):
+        self.key: Optional[str] = None
+        self.complete = False
+        self._pos: Optional[int] = None # Index of the first undecoded character of the value
+        self._rejected = False
+        self._tail = "" # Undecoded text for feed_delta()
+
+    def _match_prefix(self, partial_line: str) -> bool:
+        stripped = partial_line.lstrip()
+        if stripped and not stripped.startswith('{'):
+            self._rejected = True
+            return False
+        match = _FIELD_PREFIX.match(partial_line)
+        if not match:
+            if len(stripped) > _MAX_PREFIX_SCAN:
+                self._rejected = True
+            return False
+        if match.group(1) not in self.keys:
+            self._rejected = True
+            return False
+        self.key = match.group(1)
+        self._pos = match.end()
+        return True
+
+    def feed(self, partial_line: str) -> Optional[Tuple[str, str]]:
+        if self.complete or self._rejected:
+            return None
+        if self._pos is None and not self._match_prefix(partial_line):
+            return None
+
+        start = self._pos
+        end = len(partial_line)
+        i = start
+        safe = start
+        while i < end:
+            special = _STRING_SPECIAL.search(partial_line, i)
+            if special is None:
+                safe = end
+                break
+            i = special.start()
+            safe = i
+            if partial_line[i] == '"':
+                self.complete = True
+                break
+            # Backslash escape: only consume it once it is fully present
+            if i + 1 >= end:
+                break
+            if partial_line[i + 1] != 'u':
+                i += 2
+                safe = i
+                continue
+            if i + 6 > end:
+                break
+            try:
+                code_unit = int(partial_line[i + 2:i + 6], 16)
+            except ValueError:
+                self._rejected = True
+                break
+            if 0xD800 <= code_unit <= 0xDBFF and partial_line[i + 6:i + 8] in ('\\u', '\\', ''):
+                # High surrogate: wait for (and consume) the paired low surrogate
+                if i + 12 > end:
+                    break
+                i += 12
+            else:
+                i += 6
+            safe = i
+
+        if safe <= start:
+            return None
+        segment = partial_line[start:safe]
+        self._pos = safe
+        if '\\' not in segment:
+            return self.key, segment # No escapes: the raw text is the decoded text
+        try:
+            decoded = json.loads('"' + segment + '"', strict=False)
+        except json.JSONDecodeError:
+            self._rejected = True
+            return None
+        return self.key, decoded
+
+    def feed_delta(self, new_text: str) -> Optional[Tuple[str, str]]:
+        """
+        Like feed(), but takes only the text appended to the line since the last call.
+        Keeps just the undecoded tail (the key prefix or an incomplete escape), so cost is
+        linear in the line length no matter how many chunks it arrives in.
+        """
+        if self.complete or self._rejected or not new_text:
+            return None
+        self._tail += new_text
+        result = self.feed(self._tail)
+        if self._pos is not None:
+            self._tail = self._tail[self._pos:]
+            self._pos = 0
+        return result
+
+
+# --- JSON Lines Splitting ---
+class JsonLinesSplitter:
+    """
+    Splits streamed text into lines in linear time. Chunks of an unfinished line are kept in a list
+    and joined once when its newline arrives, instead of re-concatenating and re-splitting a growing buffer.
+    """
+
+    def __init__(self):
+        self._parts: List[str] = []
+
+    def feed(self, chunk: str) -> List[str]:
+        """Returns the lines completed by this chunk (without the newline)."""
+        lines = []
+        start = 0
+        newline = chunk.find("\n")
+        while newline >= 0:
+            if self._parts:
+                self._parts.append(chunk[start:newline])
+                lines.append("".join(self._parts))
+                self._parts = []
+            else:
+                lines.append(chunk[start:newline])
+            start = newline + 1
+            newline = chunk.find("\n", start)
+        if start < len(chunk):
+            self._parts.append(chunk[start:])
+        return lines
+
+    def close(self) -> str:
+        """Returns the unterminated last line (possibly empty) and clears the splitter."""
+        rest = "".join(self._parts)
+        self._parts = []
+        return rest
@@ -0,0 +1,512 @@
+# llm_scheduler.py
+
+import asyncio
+import contextvars
+import hashlib
+import heapq
+import itertools
+import os
+import random
+import time
+from collections import deque
+from typing import List, Dict, Any, Optional, AsyncIterator
+
+import llm_backends
+import metrics
+from structured_log import get_logger
+
+log = get_logger("LLM Scheduler")
+
+# --- Configuration ---
+LLM_SCHEDULER = os.getenv("LLM_SCHEDULER", "1") == "1"
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+# Per-stage caps, e.g. "planning=8,retrieval=8,synthesis=8,summary=2" (unlisted stages share the global cap)
+LLM_STAGE_CONCURRENCY = os.getenv("LLM_STAGE_CONCURRENCY", "summary=2")
+LLM_RATE_LIMIT_RPS = float(os.getenv("LLM_RATE_LIMIT_RPS", "0")) # Requests/second token bucket; 0 = unlimited
+LLM_RATE_BURST = int(os.getenv("LLM_RATE_BURST", "10"))
+LLM_SINGLE_FLIGHT = os.getenv("LLM_SINGLE_FLIGHT", "1") == "1"
+# Deadlines and stall detection (seconds); a stream that exceeds either fails with LLMTimeoutError
+LLM_STAGE_DEADLINES = os.getenv("LLM_STAGE_DEADLINES", "planning=30,retrieval=20,synthesis=60,summary=30")
+LLM_DEFAULT_DEADLINE = float(os.getenv("LLM_DEFAULT_DEADLINE", "60"))
+LLM_STALL_SECONDS = float(os.getenv("LLM_STALL_SECONDS", "15")) # Max gap before the first chunk and between chunks
+# Hedging: if the first chunk hasn't arrived by the stage's recent TTFT percentile, start a duplicate call
+LLM_HEDGING = os.getenv("LLM_HEDGING", "1") == "1"
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_HEDGE_MIN_SECONDS = float(os.getenv("LLM_HEDGE_MIN_SECONDS", "0.5"))
+# Retries (only before the first chunk, so output is never duplicated) and the shared retry budget
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_RETRY_BACKOFF_SECONDS = float(os.getenv("LLM_RETRY_BACKOFF_SECONDS", "0.25"))
+LLM_RETRY_BUDGET_RATIO = float(os.getenv("LLM_RETRY_BUDGET_RATIO", "0.1")) # Retry/hedge credit earned per successful call
+LLM_RETRY_BUDGET_MAX = float(os.getenv("LLM_RETRY_BUDGET_MAX", "10"))
+
+# Lower runs first: interactive planning ahead of retrieval and synthesis, background work last
+# ("batch" is every call of a /v1/batch turn, so bulk jobs yield to interactive sessions)
+PRIORITIES = {"planning": 0, "retrieval": 1, "synthesis": 2, "summary": 3, "unknown": 3, "speculative": 4, "batch": 5}
+
+# Set inside a task (see run_with_priority) to override the stage-derived priority of its LLM calls
+current_priority: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("llm_priority", default=None)
+
+
+class LLMTimeoutError(TimeoutError):
+    """Raised when an LLM stream misses its stage deadline or stalls between chunks."""
+
+
+def parse_stage_limits(spec: str, cast=int) -> Dict[str, Any]:
+    limits = {}
+    for part in spec.split(","):
+        if "=" in part:
+            stage, value = part.split("=", 1)
+            limits[stage.strip()] = cast(value)
+    return limits
+
+
+async def run_with_priority(priority: str, coro):
+    """Awaits coro with every LLM call it makes scheduled at the given priority (e.g. 'speculative')."""
+    current_priority.set(priority)
+    return await coro
+
+
+# --- Shared Stream (single-flight) ---
+class _SharedStream:
+    """
+    Output of one provider stream, fanned out to every consumer that asked for the same prompt.
+    The producer runs in its own task and is cancelled if all consumers go away.
+    """
+
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.consumers = 0
+        self.producer: Optional[asyncio.Task] = None
+        self._update = asyncio.get_running_loop().create_future()
+
+    def _notify(self):
+        if not self._update.done():
+            self._update.set_result(None)
+        self._update = asyncio.get_running_loop().create_future()
+
+    def append(self, text: str):
+        self.chunks.append(text)
+        self._notify()
+
+    def finish(self, error: Optional[BaseException] = None):
+        self.done = True
+        self.error = error
+        self._notify()
+
+    async def consume(self) -> AsyncIterator[str]:
+        index = 0
+        while True:
+            while index < len(self.chunks):
+                yield self.chunks[index]
+                index += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await asyncio.shield(self._update)
+
+
+# --- Retry Budget ---
+class RetryBudget:
+    """
+    Caps retries and hedges to a fraction of successful traffic: every success deposits `ratio`
+    tokens (up to `max_tokens`), every retry or hedge withdraws one. Stops retry storms when the
+    provider is down.
+    """
+
+    def __init__(self, ratio: float = LLM_RETRY_BUDGET_RATIO, max_tokens: float = LLM_RETRY_BUDGET_MAX):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.exhausted = 0
+
+    def deposit(self):
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def try_withdraw(self) -> bool:
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        self.exhausted += 1
+        return False
+
+
+class _Attempt:
+    """One provider call, pumped into the shared queue as (attempt, kind, payload) tuples."""
+
+    def __init__(self, queue: asyncio.Queue, stream: AsyncIterator[str]):
+        self.task = asyncio.create_task(self._pump(queue, stream))
+
+    async def _pump(self, queue: asyncio.Queue, stream: AsyncIterator[str]):
+        try:
+            async for text in stream:
+                queue.put_nowait((self, "chunk", text))
+            queue.put_nowait((self, "end", None))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            queue.put_nowait((self, "error", e))
+
+
+# --- Scheduler ---
+class LLMScheduler:
+    """
+    Central admission control for LLM calls:
+      - a global concurrency cap and optional per-stage caps
+      - a token-bucket rate limit on call starts
+      - priority ordering of waiting calls (PRIORITIES; lower first, FIFO within a priority)
+      - single-flight: identical in-flight prompts (same model/temperature) share one provider stream
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = LLM_MAX_CONCURRENCY,
+        stage_limits: Optional[Dict[str, int]] = None,
+        rate_per_second: float = LLM_RATE_LIMIT_RPS,
+        burst: int = LLM_RATE_BURST,
+        single_flight: bool = LLM_SINGLE_FLIGHT
+    ):
+        self.max_concurrency = max(1, max_concurrency)
+        self.stage_limits = stage_limits if stage_limits is not None else parse_stage_limits(LLM_STAGE_CONCURRENCY)
+        self.rate_per_second = rate_per_second
+        self.burst = max(1, burst)
+        self.single_flight = single_flight
+        self._tokens = float(self.burst)
+        self._tokens_updated = time.monotonic()
+        self._refill_timer: Optional[asyncio.TimerHandle] = None
+        self._in_flight = 0
+        self._stage_in_flight: Dict[str, int] = {}
+        self._waiters: List[Any] = [] # Heap of (priority, sequence, stage, future)
+        self._sequence = itertools.count()
+        self._shared: Dict[str, _SharedStream] = {}
+        self.deadlines = parse_stage_limits(LLM_STAGE_DEADLINES, float)
+        self.retry_budget = RetryBudget()
+        self._ttft_samples: Dict[str, deque] = {}
+        self.started = 0
+        self.coalesced = 0
+        self.rate_limited_waits = 0
+        self.max_queue_depth = 0
+        self.total_queue_wait = 0.0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.hedges_skipped = 0
+        self.timeouts = 0
+        self.cancelled = 0
+
+    # --- Admission ---
+    def _refill(self):
+        if self.rate_per_second <= 0:
+            return
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._tokens_updated) * self.rate_per_second)
+        self._tokens_updated = now
+
+    def _stage_has_room(self, stage: str) -> bool:
+        limit = self.stage_limits.get(stage)
+        return limit is None or self._stage_in_flight.get(stage, 0) < limit
+
+    def _take_slot(self, stage: str):
+        self._in_flight += 1
+        self._stage_in_flight[stage] = self._stage_in_flight.get(stage, 0) + 1
+        if self.rate_per_second > 0:
+            self._tokens -= 1
+        self.started += 1
+
+    def _release(self, stage: str):
+        self._in_flight -= 1
+        self._stage_in_flight[stage] -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        """Grants waiting calls in priority order while capacity and rate tokens allow."""
+        self._refill()
+        skipped = []
+        while self._waiters and self._in_flight < self.max_concurrency:
+            entry = heapq.heappop(self._waiters)
+            _, _, stage, future = entry
+            if future.done(): # Cancelled while waiting
+                continue
+            if not self._stage_has_room(stage):
+                skipped.append(entry) # Stage is full; lower-priority calls of other stages may go
+                continue
+            if self.rate_per_second > 0 and self._tokens < 1:
+                skipped.append(entry)
+                self._schedule_refill()
+                break
+            self._take_slot(stage)
+            future.set_result(None)
+        for entry in skipped:
+            heapq.heappush(self._waiters, entry)
+
+    def _schedule_refill(self):
+        if self._refill_timer is None:
+            delay = (1 - self._tokens) / self.rate_per_second
+            loop = asyncio.get_running_loop()
+
+            def refill():
+                self._refill_timer = None
+                self._dispatch()
+
+            self._refill_timer = loop.call_later(max(delay, 0.001), refill)
+
+    def _try_acquire(self, stage: str) -> bool:
+        """Takes a slot only if one is free right now and no call is waiting for it."""
+        self._refill()
+        if (not self._waiters and self._in_flight < self.max_concurrency and self._stage_has_room(stage)
+                and (self.rate_per_second <= 0 or self._tokens >= 1)):
+            self._take_slot(stage)
+            return True
+        return False
+
+    async def _acquire(self, stage: str, priority: int):
+        if self._try_acquire(stage):
+            return
+        if self.rate_per_second > 0 and self._tokens < 1:
+            self.rate_limited_waits += 1
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), stage, future))
+        self.max_queue_depth = max(self.max_queue_depth, len(self._waiters))
+        queued_at = time.perf_counter()
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release(stage) # Granted just as we were cancelled
+            raise
+        finally:
+            waited = time.perf_counter() - queued_at
+            self.total_queue_wait += waited
+            metrics.llm_queue_wait_seconds.observe(waited, stage=stage)
+
+    # --- Calls ---
+    async def _produce(self, shared: _SharedStream, key: str, prompt: str, model_name: str, temperature: float,
+                       static_prefix: Optional[str], stage: str, priority: int):
+        try:
+            await self._acquire(stage, priority)
+            try:
+                async for text in self._resilient_stream(prompt, model_name, temperature, static_prefix, stage):
+                    shared.append(text)
+            finally:
+                self._release(stage)
+            shared.finish()
+        except asyncio.CancelledError:
+            shared.finish(asyncio.CancelledError())
+            raise
+        except Exception as e:
+            shared.finish(e)
+        finally:
+            if self._shared.get(key) is shared:
+                del self._shared[key]
+
+    # --- Deadlines, Hedging and Retries ---
+    def _hedge_delay(self, stage: str) -> Optional[float]:
+        samples = self._ttft_samples.get(stage)
+        if not LLM_HEDGING or samples is None or len(samples) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(len(ordered) * LLM_HEDGE_PERCENTILE / 100))
+        return max(LLM_HEDGE_MIN_SECONDS, ordered[index])
+
+    def _record_ttft(self, stage: str, seconds: float):
+        self._ttft_samples.setdefault(stage, deque(maxlen=200)).append(seconds)
+
+    async def _resilient_stream(self, prompt: str, model_name: str, temperature: float,
+                                static_prefix: Optional[str], stage: str) -> AsyncIterator[str]:
+        """
+        Provider stream with a stage deadline and stall detection. Before the first chunk, a slow call
+        is hedged with a duplicate (first to produce a chunk wins, the other is cancelled) and a failed
+        or stalled call is retried with jittered backoff; both draw on the retry budget. The hedge takes
+        its own concurrency slot, released when it finishes or is cancelled, and is skipped if none is
+        free. Once output has been yielded, failures are raised as-is.
+        """
+        loop = asyncio.get_running_loop()
+        backend = llm_backends.get_backend()
+        started = loop.time()
+        deadline = started + self.deadlines.get(stage, LLM_DEFAULT_DEADLINE)
+        queue: asyncio.Queue = asyncio.Queue()
+        attempts: List[_Attempt] = []
+
+        def launch() -> _Attempt:
+            attempt = _Attempt(queue, backend.stream_text(
+                prompt, model_name=model_name, temperature=temperature, static_prefix=static_prefix))
+            attempts.append(attempt)
+            return attempt
+
+        def timeout(kind: str) -> LLMTimeoutError:
+            self.timeouts += 1
+            metrics.llm_timeouts_total.inc(stage=stage, kind=kind)
+            return LLMTimeoutError(f"LLM {stage} call {'missed its deadline' if kind == 'deadline' else 'stalled'} after {loop.time() - started:.1f}s")
+
+        retries = 0
+        winner: Optional[_Attempt] = None
+        try:
+            while True:
+                # (Re)start a call; everything below runs until it succeeds, fails for good, or a retry is due
+                launch()
+                attempt_started = last_activity = loop.time()
+                hedge_delay = self._hedge_delay(stage)
+                hedge: Optional[_Attempt] = None
+                failure: Optional[BaseException] = None
+                while True:
+                    now = loop.time()
+                    waits = [deadline - now, last_activity + LLM_STALL_SECONDS - now]
+                    if winner is None and hedge_delay is not None:
+                        waits.append(attempt_started + hedge_delay - now)
+                    try:
+                        attempt, kind, payload = await asyncio.wait_for(queue.get(), max(0.0, min(waits)))
+                    except asyncio.TimeoutError:
+                        now = loop.time()
+                        if now >= deadline:
+                            raise timeout("deadline")
+                        if winner is None and hedge_delay is not None and now >= attempt_started + hedge_delay:
+                            hedge_delay = None # At most one hedge per call
+                            if not self._try_acquire(stage):
+                                self.hedges_skipped += 1 # Caps are full (or calls are queued): don't add load
+                            elif not self.retry_budget.try_withdraw():
+                                self._release(stage)
+                            else:
+                                self.hedges += 1
+                                metrics.llm_hedges_total.inc(stage=stage)
+                                hedge = launch()
+                                # Done callbacks run even if the task is cancelled before it starts
+                                hedge.task.add_done_callback(lambda _: self._release(stage))
+                            continue
+                        if now >= last_activity + LLM_STALL_SECONDS:
+                            if winner is not None:
+                                raise timeout("stall")
+                            failure = timeout("stall")
+                            break
+                        continue
+
+                    if attempt not in attempts or (winner is not None and attempt is not winner):
+                        continue # Leftovers from a cancelled loser or an earlier try
+                    if kind == "error":
+                        if winner is not None:
+                            raise payload
+                        attempts.remove(attempt)
+                        if attempts:
+                            continue # A hedge is still running
+                        failure = payload
+                        break
+                    if winner is None:
+                        winner = attempt
+                        if attempt is hedge:
+                            self.hedge_wins += 1
+                        self._record_ttft(stage, loop.time() - attempt_started)
+                        for other in attempts:
+                            if other is not winner:
+                                other.task.cancel()
+                    if kind == "end":
+                        self.retry_budget.deposit()
+                        return
+                    last_activity = loop.time()
+                    yield payload
+
+                # Failed before any output: retry if the count, budget and deadline allow
+                for attempt in attempts:
+                    attempt.task.cancel()
+                attempts.clear()
+                backoff = LLM_RETRY_BACKOFF_SECONDS * (2 ** retries) * random.uniform(0.5, 1.5)
+                if retries >= LLM_MAX_RETRIES or loop.time() + backoff >= deadline or not self.retry_budget.try_withdraw():
+                    raise failure
+                retries += 1
+                self.retries += 1
+                metrics.llm_retries_total.inc(stage=stage)
+                log.warning(f"Retrying {stage} call ({retries}/{LLM_MAX_RETRIES}) after: {failure}")
+                await asyncio.sleep(backoff)
+        finally:
+            for attempt in attempts:
+                attempt.task.cancel()
+
+    async def stream(
+        self,
+        prompt: str,
+        model_name: str,
+        temperature: float,
+        static_prefix: Optional[str] = None,
+        stage: Optional[str] = None
+    ) -> AsyncIterator[str]:
+        """Drop-in for backend.stream_text() that goes through admission control and single-flight."""
+        stage = stage or llm_backends.detect_prompt_stage(prompt)
+        priority = PRIORITIES.get(current_priority.get() or stage, PRIORITIES["unknown"])
+        key = hashlib.sha256(f"{model_name}|{temperature}|{prompt}".encode("utf-8")).hexdigest()
+
+        shared = self._shared.get(key) if self.single_flight else None
+        if shared is not None:
+            self.coalesced += 1
+        else:
+            shared = _SharedStream()
+            if self.single_flight:
+                self._shared[key] = shared
+            shared.producer = asyncio.create_task(self._produce(shared, key, prompt, model_name, temperature, static_prefix, stage, priority))
+
+        shared.consumers += 1
+        try:
+            async for text in shared.consume():
+                yield text
+        finally:
+            shared.consumers -= 1
+            if shared.consumers == 0 and not shared.done:
+                shared.producer.cancel() # Nobody is listening any more
+                self.cancelled += 1
+                metrics.llm_cancellations_total.inc(stage=stage)
+
+    async def generate(
+        self,
+        prompt: str,
+        model_name: str,
+        temperature: float,
+        static_prefix: Optional[str] = None,
+        stage: Optional[str] = None
+    ) -> str:
+        """Drop-in for backend.generate_text()."""
+        parts = []
+        async for text in self.stream(prompt, model_name, temperature, static_prefix, stage):
+            parts.append(text)
+        return "".join(parts)
+
+    def stats(self) -> Dict[str, Any]:
+        queued: Dict[str, int] = {}
+        for _, _, stage, future in self._waiters:
+            if not future.done():
+                queued[stage] = queued.get(stage, 0) + 1
+        return {
+            "in_flight": self._in_flight,
+            "in_flight_by_stage": dict(self._stage_in_flight),
+            "queue_depth": sum(queued.values()),
+            "queued_by_stage": queued,
+            "max_queue_depth": self.max_queue_depth,
+            "started": self.started,
+            "coalesced": self.coalesced,
+            "rate_limited_waits": self.rate_limited_waits,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "hedges_skipped": self.hedges_skipped,
+            "timeouts": self.timeouts,
+            "cancelled": self.cancelled,
+            "retry_budget_tokens": self.retry_budget.tokens,
+            "retry_budget_exhausted": self.retry_budget.exhausted,
+            "avg_queue_wait_ms": 1000 * self.total_queue_wait / self.started if self.started else 0.0
+        }
+
+
+class _PassthroughScheduler:
+    """Used with LLM_SCHEDULER=0: calls go straight to the backend."""
+
+    def stream(self, prompt, model_name, temperature, static_prefix=None, stage=None):
+        return llm_backends.get_backend().stream_text(prompt, model_name=model_name, temperature=temperature, static_prefix=static_prefix)
+
+    async def generate(self, prompt, model_name, temperature, static_prefix=None, stage=None):
+        return await llm_backends.get_backend().generate_text(prompt, model_name=model_name, temperature=temperature, static_prefix=static_prefix)
+
+    def stats(self) -> Dict[str, Any]:
+        return {}
+
+
+llm_scheduler = LLMScheduler() if LLM_SCHEDULER else _PassthroughScheduler()
@@ -1,47 +1,622 @@
 # main.py
 
 import json
-from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi.responses import HTMLResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Callable, Awaitable
 import uvicorn
 import copy
 import asyncio
-import traceback # For detailed error logging
+import math
+import uuid
+import os
+import time
+from contextlib import asynccontextmanager
+
+from session_store import create_session_store, SESSION_STORE, SessionState
+from shared_store import shared_store
+from history import history_compactor, prompt_token_report
+from admin_protocol import AdminUpdateChannel
+import fast_json
+from fast_json import send_frame
+import metrics
+import router
+import llm_backends
+import embeddings
+from retrieval_cache import retrieval_cache
+from vector_store import vector_store
+from llm_scheduler import llm_scheduler, run_with_priority
+from response_assembly import assemble_response, bypass_stats
+from structured_log import get_logger, structured_logging
+
+log = get_logger("Main")
 
 # --- Import your helper functions ---
 # ... (Imports remain the same) ...
 try:
     import helper2 as hlp
-    print("Main: Helper functions loaded successfully.")
+    log.info("Helper functions loaded successfully.")
     user_context = copy.deepcopy(hlp.user_context)
     business_summary = copy.deepcopy(hlp.business_summary)
     available_tools = copy.deepcopy(hlp.available_tools)
+    # Tools/context/business sections are serialized once, not on every turn
+    static_sections = hlp.get_static_sections(user_context, business_summary, available_tools)
 except ImportError:
-    print("Main ERROR: helper2.py not found.")
+    log.error("helper2.py not found.")
     # Dummy data/functions
     user_context = {"error": "helper missing"}
     business_summary = {"error": "helper missing"}
     available_tools = []
+    static_sections = None
     async def process_quickbooks_query(*args, **kwargs): yield {"type": "thought", "data": "Dummy plan thought"}; yield {"type": "function_calls", "data": []}; yield {"type": "explanation", "data": "Dummy explanation"}
     async def simulate_retrieval_stub(*args, **kwargs): return {"function_name": "dummy_tool", "retrieved_chunks": None, "present_as_is": False, "follow_up_question": None, "asked_for_sticky": False, "rejected": False, "rejection_reason": None, "error": None}
     async def generate_final_response(*args, **kwargs): yield {"type": "thought", "data": "Dummy summary thought"}; yield {"type": "final_response_text", "data": "Dummy final response"}; yield {"type": "citation_map", "data": {}}
     hlp = None
 except AttributeError as e:
-    print(f"Main ERROR: Missing expected variables/functions in helper2.py: {e}")
+    log.error(f"Missing expected variables/functions in helper2.py: {e}")
     raise
 
 
 # --- FastAPI App Setup ---
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Open the LLM provider connection before the first turn needs it (LLM_WARMUP, LLM_WARMUP_MODELS)
+    if llm_backends.LLM_WARMUP:
+        await llm_backends.get_backend().warmup(llm_backends.LLM_WARMUP_MODELS)
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
-# --- In-memory storage ---
-chat_history: List[Dict[str, str]] = []
-sticky_hint_for_next_turn: Optional[str] = None
+# --- Session storage (per-connection chat history and sticky hint) ---
+session_store = create_session_store()
+
+# --- Workers ---
+# WORKERS > 1 runs several uvicorn processes. Sessions must then live in a store all workers can read
+# (SESSION_STORE=sqlite) so a reconnect landing on another worker keeps its history; SHARED_STORE=sqlite
+# shares the retrieval and planner caches as well. Scheduler limits and /metrics are per worker.
+WORKERS = int(os.getenv("WORKERS", "1"))
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8000"))
+if WORKERS > 1 and SESSION_STORE == "memory":
+    log.warning("WORKERS > 1 with SESSION_STORE=memory; sessions will not follow clients between workers.")
+
+# --- Pipeline configuration ---
+# PIPELINED_RETRIEVAL: start retrieval tasks as soon as the planner's function_calls line is parsed.
+# SPECULATIVE_RETRIEVAL: while planning runs, retrieve for the sticky-hint tool (or the keyword
+# classifier's top tool); the result is reused if the plan picks that tool, cancelled otherwise.
+PIPELINED_RETRIEVAL = os.getenv("PIPELINED_RETRIEVAL", "1") == "1"
+SPECULATIVE_RETRIEVAL = os.getenv("SPECULATIVE_RETRIEVAL", "0") == "1"
+# PARTIAL_RESULTS: retrievals still running RETRIEVAL_DEADLINE_SECONDS after planning are cancelled and
+# passed to synthesis as rejected, instead of holding up the turn.
+PARTIAL_RESULTS = os.getenv("PARTIAL_RESULTS", "1") == "1"
+RETRIEVAL_DEADLINE_SECONDS = float(os.getenv("RETRIEVAL_DEADLINE_SECONDS", "15"))
+# Results are handled (and pushed to the admin panel) as each retrieval finishes. Once RETRIEVAL_QUORUM
+# of the planned calls (a fraction; 1.0 = all) have finished, or one asked a follow-up question, the rest
+# get RETRIEVAL_STRAGGLER_SECONDS more before synthesis starts without them.
+RETRIEVAL_QUORUM = float(os.getenv("RETRIEVAL_QUORUM", "1.0"))
+RETRIEVAL_STRAGGLER_SECONDS = float(os.getenv("RETRIEVAL_STRAGGLER_SECONDS", "2"))
+RETRIEVAL_TOP_K = 2
+# HTTP API: per-request cap on concurrently running /v1/batch turns, and on queries per batch
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "8"))
+BATCH_MAX_QUERIES = int(os.getenv("BATCH_MAX_QUERIES", "1000"))
+
+# --- Metrics: existing stats() values are exported alongside the pipeline metrics ---
+metrics.registry.register_stats("qb_session_store", session_store.stats)
+metrics.registry.register_stats("qb_fast_path", router.fast_path_router.stats)
+metrics.registry.register_stats("qb_prompt_tokens", prompt_token_report)
+metrics.registry.register_stats("qb_embedding_batches", embeddings.embedding_batcher.stats)
+metrics.registry.register_stats("qb_vector_search", vector_store.stats)
+metrics.registry.register_stats("qb_llm_scheduler", llm_scheduler.stats)
+metrics.registry.register_stats("qb_response_assembly", bypass_stats.stats)
+metrics.registry.register_stats("qb_logging", structured_logging.stats)
+metrics.registry.register_stats("qb_llm_clients", lambda: llm_backends.get_backend().stats())
+if retrieval_cache is not None:
+    metrics.registry.register_stats("qb_retrieval_cache", retrieval_cache.stats)
+if shared_store is not None:
+    metrics.registry.register_stats("qb_shared_store", shared_store.stats)
+
+
+async def _timed_retrieval(trace: metrics.TurnTrace, tool_name: str, coro):
+    """Awaits one retrieval and records its latency (cancelled speculative retrievals are not recorded)."""
+    started = time.perf_counter()
+    cancelled = False
+    try:
+        return await coro
+    except asyncio.CancelledError:
+        cancelled = True
+        raise
+    finally:
+        if not cancelled:
+            seconds = time.perf_counter() - started
+            metrics.retrieval_seconds.observe(seconds, tool=tool_name)
+            trace.record(f"retrieval:{tool_name}", seconds, observe=False)
+
+
+async def _iter_retrievals(simulation_tasks: List[asyncio.Task]):
+    """
+    Yields (task, None) for each retrieval as it finishes, then (task, reason) for each one still running
+    when waiting stops: "deadline" (RETRIEVAL_DEADLINE_SECONDS, with PARTIAL_RESULTS) or "straggler"
+    (RETRIEVAL_STRAGGLER_SECONDS after the quorum was met). Those tasks are cancelled.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + RETRIEVAL_DEADLINE_SECONDS if PARTIAL_RESULTS else None
+    reason = "deadline"
+    quorum = max(1, math.ceil(RETRIEVAL_QUORUM * len(simulation_tasks)))
+    finished = 0
+    pending = set(simulation_tasks)
+    while pending:
+        timeout = None if deadline is None else max(0.0, deadline - loop.time())
+        done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        if not done:
+            break
+        quorum_met = False
+        for task in done:
+            finished += 1
+            if not task.cancelled() and task.exception() is None and (task.result() or {}).get("follow_up_question"):
+                quorum_met = True # The follow-up question is the answer; the other results can't change that
+            yield task, None
+        if pending and reason != "straggler" and (quorum_met or finished >= quorum):
+            straggler_deadline = loop.time() + RETRIEVAL_STRAGGLER_SECONDS
+            if deadline is None or straggler_deadline < deadline:
+                deadline, reason = straggler_deadline, "straggler"
+    for task in pending:
+        task.cancel()
+        yield task, reason
+
+
+def _start_retrieval_tasks(
+    plan_calls: List[Dict[str, Any]],
+    admin: AdminUpdateChannel,
+    trace: metrics.TurnTrace,
+    speculative_tool: Optional[str] = None,
+    speculative_task: Optional[asyncio.Task] = None
+):
+    """
+    Creates one simulate_retrieval_stub task per planned call.
+    The speculative task is adopted for the first call to the same tool and cancelled if no call matches.
+    Returns (tasks, call_indices) where call_indices maps task -> index in plan_calls.
+    """
+    simulation_tasks = []
+    call_indices = {}
+    for index, call_plan in enumerate(plan_calls):
+        tool_name = call_plan.get("name")
+        arguments = call_plan.get("arguments", {})
+        query_arg = arguments.get("query") or arguments.get("data_request")
+
+        if tool_name and query_arg:
+            if speculative_task is not None and tool_name == speculative_tool:
+                log.info(f"Plan agrees with speculative retrieval for '{tool_name}', reusing it.")
+                task = speculative_task
+                speculative_task = None
+            else:
+                task = asyncio.create_task(_timed_retrieval(trace, tool_name, hlp.simulate_retrieval_stub(
+                    function_name=tool_name,
+                    queries=[query_arg],
+                    top_k=RETRIEVAL_TOP_K
+                )))
+            simulation_tasks.append(task)
+            call_indices[task] = index
+        else:
+            log.warning(f"Skipping simulation for invalid call structure: {call_plan}")
+            if index < len(admin.get(["function_calls_made"])):
+                admin.set(["function_calls_made", index, "raw_result"], {"error": "Invalid call structure, skipped simulation.", "rejected": True, "rejection_reason": "Invalid call structure"})
+
+    if speculative_task is not None:
+        log.info(f"Plan disagrees with speculative retrieval for '{speculative_tool}', cancelling it.")
+        speculative_task.cancel()
+    return simulation_tasks, call_indices
+
+async def _run_fused_turn(
+    query: str,
+    history: List[Dict[str, str]],
+    tool_name: str,
+    admin: AdminUpdateChannel,
+    trace: metrics.TurnTrace,
+    send,
+    all_thoughts: List[str]
+):
+    """
+    Runs helper2.process_fused_query and forwards its items like the planning and synthesis steps do.
+    Returns (answered, final_response_text, citation_map, retrieval_results); answered is False on a fallback.
+    """
+    log.debug(f"Fused pipeline for '{tool_name}'")
+    started = time.perf_counter()
+    first_item = True
+    final_text = None
+    citation_map = None
+    retrieval_results = []
+    async for item in hlp.process_fused_query(
+        new_user_query=query,
+        message_history=history,
+        user_context=user_context,
+        business_summary=business_summary,
+        available_tools=available_tools,
+        tool_name=tool_name,
+        top_k=RETRIEVAL_TOP_K,
+        static_sections=static_sections
+    ):
+        item_type = item.get("type")
+        item_data = item.get("data")
+        if item_type == "fused_retrieval":
+            call = item_data["call"]
+            retrieval_results = [item_data["result"]]
+            admin.set(["function_calls_made"], [{
+                "name": call["name"],
+                "query": query,
+                "all_args": call["arguments"],
+                "raw_result": item_data["result"]
+            }])
+            trace.record(f"retrieval:{tool_name}", time.perf_counter() - started, observe=False)
+            continue
+        if first_item and item_type != "prompt_stats":
+            trace.record_since("fused_ttft", started)
+            first_item = False
+
+        if item_type == "thought":
+            admin.append(["summarization_thoughts"], item_data)
+            all_thoughts.append(item_data)
+            await send({"type": "thought", "data": item_data})
+        elif item_type == "prompt_stats":
+            admin.set(["prompt_tokens", "fused"], item_data)
+        elif item_type == "final_response_text_delta":
+            await send({"type": "final_response_delta", "data": item_data})
+        elif item_type == "final_response_text":
+            final_text = item_data
+        elif item_type == "citation_map":
+            citation_map = item_data
+        elif item_type == "fused_fallback" and final_text is None:
+            log.info(f"Fused pipeline fell back to planning ({item_data}).")
+            metrics.fused_turns_total.inc(tool=tool_name, outcome="fallback")
+            admin.set(["function_calls_made"], [])
+            return False, None, None, []
+        elif item_type == "error":
+            raise Exception(f"Fused Pipeline Error: {item_data}")
+    trace.record_since("fused_total", started)
+    metrics.fused_turns_total.inc(tool=tool_name, outcome="answered")
+    return True, final_text or "I found information but encountered an issue summarizing it.", citation_map or {}, retrieval_results
+
+
+async def run_turn(
+    session: SessionState,
+    current_user_query: str,
+    send: Callable[[Dict[str, Any]], Awaitable[None]],
+    admin: AdminUpdateChannel,
+    trace: metrics.TurnTrace,
+    store=session_store
+) -> Optional[str]:
+    """
+    Runs one chat turn for session: planning, retrieval, synthesis and the history update.
+    Frames go out through send (thought, status, final_response_delta, final_response, error) and
+    admin panel state through admin. Used by /ws, /v1/turn and /v1/batch; store=None leaves the session unsaved.
+    Returns the final response text, or None if the turn failed outside the pipeline.
+    """
+    sticky_hint_before = session.sticky_hint
+    try:
+        metrics.turns_total.inc()
+        log.info(f"Received user query (trace {trace.trace_id}): {current_user_query}", extra={"fields": {"trace_id": trace.trace_id, "session_id": session.session_id}})
+
+        # Recent turns verbatim, older turns folded into the session's cached rolling summary
+        current_turn_history, session.history_summary, session.summarized_upto = await history_compactor.compact(
+            session.chat_history, session.history_summary, session.summarized_upto
+        )
+        current_sticky_hint = session.sticky_hint
+        session.sticky_hint = None # Reset hint for this turn
+
+        admin.reset({
+            "understanding_thoughts": [],
+            "function_calls_made": [],
+            "summarization_thoughts": [],
+            "prompt_tokens": {},
+            "trace": {"trace_id": trace.trace_id, "spans_ms": {}},
+            "error": None
+        })
+        plan_calls_local = None
+        retrieval_results_local = []
+        final_response_text_local = None
+        citation_map_local = None
+        explanation_local = None
+        follow_up_question_asked = None
+        all_thoughts_this_turn = []
+        simulation_tasks = []
+        call_indices = {}
+        retrieval_started = False
+
+        # Tools listed in FUSED_TOOLS skip planning (see _run_fused_turn)
+        fused_tool = hlp.select_fused_tool(current_user_query, current_turn_history, available_tools, current_sticky_hint) if hlp else None
+
+        # Speculative retrieval runs concurrently with planning
+        speculative_tool = None
+        speculative_task = None
+        if SPECULATIVE_RETRIEVAL and hlp and not fused_tool:
+            speculative_tool = current_sticky_hint or hlp.classify_query_tool(current_user_query, available_tools)
+            if speculative_tool:
+                log.info(f"Starting speculative retrieval for '{speculative_tool}'")
+                # Its LLM calls queue behind planning and synthesis under load
+                speculative_task = asyncio.create_task(_timed_retrieval(trace, speculative_tool, run_with_priority("speculative", hlp.simulate_retrieval_stub(
+                    function_name=speculative_tool,
+                    queries=[current_user_query],
+                    top_k=RETRIEVAL_TOP_K
+                ))))
+
+        try:
+            # Step 0: Fused single-call path for tools with a fast retriever (falls back to the three phases)
+            fused_answered = False
+            fused_results = []
+            if fused_tool:
+                fused_answered, final_response_text_local, citation_map_local, fused_results = await _run_fused_turn(
+                    current_user_query, current_turn_history, fused_tool, admin, trace, send, all_thoughts_this_turn
+                )
+
+            if not fused_answered:
+                # Step 1: Planning/Routing
+                log.debug(f"Step 1: Planning/Routing (hint: {current_sticky_hint})")
+                planning_started = time.perf_counter()
+                planning_first_item = True
+                async for item in hlp.process_quickbooks_query(
+                    new_user_query=current_user_query,
+                    message_history=current_turn_history,
+                    user_context=user_context,
+                    business_summary=business_summary,
+                    available_tools=available_tools,
+                    sticky_function_hint=current_sticky_hint,
+                    static_sections=static_sections
+                ):
+                    # ... (rest of Step 1 logic sending thoughts/admin updates)
+                    item_type = item.get("type")
+                    item_data = item.get("data")
+                    if planning_first_item and item_type != "prompt_stats":
+                        trace.record_since("planning_ttft", planning_started)
+                        planning_first_item = False
+
+                    if item_type == "thought":
+                        admin.append(["understanding_thoughts"], item_data)
+                        all_thoughts_this_turn.append(item_data)
+                        await send({"type": "thought", "data": item_data})
+                    elif item_type == "function_calls":
+                        plan_calls_local = item_data
+                        admin.set(["function_calls_made"], [
+                            {
+                                "name": call.get("name"),
+                                "query": call.get("arguments", {}).get("query") or call.get("arguments", {}).get("data_request"),
+                                "all_args": call.get("arguments", {}),
+                                "raw_result": None
+                            }
+                            for call in plan_calls_local or []
+                        ])
+                        if PIPELINED_RETRIEVAL and not retrieval_started:
+                            # Launch retrievals now instead of waiting for the rest of the planning stream
+                            simulation_tasks, call_indices = _start_retrieval_tasks(
+                                plan_calls_local or [], admin, trace, speculative_tool, speculative_task
+                            )
+                            speculative_task = None
+                            retrieval_started = True
+                    elif item_type == "explanation":
+                        explanation_local = item_data
+                    elif item_type == "prompt_stats":
+                        admin.set(["prompt_tokens", "planning"], item_data)
+                    elif item_type == "error":
+                        raise Exception(f"Planning Error: {item_data}")
+                trace.record_since("planning_total", planning_started)
+
+            # Step 2: Simulate Function Execution
+            log.debug("Step 2: Simulate function execution")
+            # ... (rest of Step 2 logic calling stubs, handling results, setting sticky hint) ...
+            if speculative_task is not None:
+                # Planning finished without function calls (or pipelining is off) - resolve speculation
+                if not plan_calls_local:
+                    log.info(f"No function calls planned, cancelling speculative retrieval for '{speculative_tool}'.")
+                    speculative_task.cancel()
+                    speculative_task = None
+
+            if plan_calls_local:
+                retrieval_results_local = []
+                if not retrieval_started:
+                    simulation_tasks, call_indices = _start_retrieval_tasks(
+                        plan_calls_local, admin, trace, speculative_tool, speculative_task
+                    )
+                    speculative_task = None
+                    retrieval_started = True
+
+                if simulation_tasks:
+                    retrieval_wait_started = time.perf_counter()
+                    finished_count = 0
+                    async for task, skip_reason in _iter_retrievals(simulation_tasks):
+                        original_index = call_indices[task]
+                        if skip_reason is not None:
+                            tool_label = plan_calls_local[original_index].get("name") or "unknown"
+                            metrics.retrieval_timeouts_total.inc(tool=tool_label, reason=skip_reason)
+                            log.info(f"Retrieval for '{tool_label}' skipped ({skip_reason}), continuing without it.")
+                            timeout_result = {"function_name": tool_label, "retrieved_chunks": None, "error": "Retrieval timed out", "rejected": True, "rejection_reason": "The search took too long and was skipped."}
+                            if original_index < len(admin.get(["function_calls_made"])):
+                                admin.set(["function_calls_made", original_index, "raw_result"], timeout_result)
+                            retrieval_results_local.append(timeout_result)
+                            continue
+                        try:
+                            sim_data = task.result()
+                            retrieval_results_local.append(sim_data)
+
+                            tool_label = sim_data.get("function_name") or "unknown"
+                            if sim_data.get("rejected"):
+                                metrics.rejections_total.inc(tool=tool_label)
+                            if sim_data.get("follow_up_question"):
+                                follow_up_question_asked = sim_data["follow_up_question"]
+                                metrics.follow_ups_total.inc(tool=tool_label)
+                                log.info(f"Follow-up question received from {sim_data.get('function_name')}")
+                            if sim_data.get("asked_for_sticky"):
+                                session.sticky_hint = sim_data.get("function_name")
+                                metrics.sticky_hints_total.inc(tool=tool_label)
+                                log.info(f"Sticky hint set for next turn: {session.sticky_hint}")
+
+                            if original_index < len(admin.get(["function_calls_made"])):
+                                admin.set(["function_calls_made", original_index, "raw_result"], sim_data)
+
+                        except Exception as sim_exc:
+                            log.exception(f"Error during simulation task result retrieval for call index {original_index}: {sim_exc}")
+                            error_result = {"error": f"Simulation task failed: {sim_exc}", "rejected": True, "rejection_reason": "Simulation task execution error"}
+                            if original_index < len(admin.get(["function_calls_made"])):
+                                admin.set(["function_calls_made", original_index, "raw_result"], error_result)
+                            retrieval_results_local.append(error_result) # Add error to results
+
+                        # Push each result to the client as it lands instead of after the slowest tool
+                        finished_count += 1
+                        if len(simulation_tasks) > 1:
+                            await send({"type": "status", "data": f"Search {finished_count}/{len(simulation_tasks)} finished..."})
+                        await admin.flush()
+                    trace.record_since("retrieval_wait", retrieval_wait_started)
+
+                await admin.flush() # Show results before synthesis starts
+            else:
+                log.info("No function calls proposed.")
+
+
+            # Step 3: Generate Final Response OR Use Follow-up Question
+            log.debug("Step 3: Determine final response")
+            # ... (rest of Step 3 logic calling generate_final_response or using follow_up/explanation) ...
+            # The synthesis decision is recorded here, once per turn (a fused fallback is not a second turn)
+            if fused_answered:
+                log.info(f"Fused pipeline answered via '{fused_tool}'.")
+                bypass_stats.record(assemble_response(fused_results))
+            elif follow_up_question_asked:
+                log.info(f"Using follow-up question as response: {follow_up_question_asked}")
+                bypass_stats.record(assemble_response(retrieval_results_local))
+                final_response_text_local = follow_up_question_asked
+                citation_map_local = {}
+                admin.set(["summarization_thoughts"], ["Skipped summarization - Follow-up question asked by function."])
+                await send({"type": "status", "data": "Asking a clarifying question..."})
+
+            else:
+                history_for_summary = current_turn_history + [{"role": "user", "content": current_user_query}]
+                # Fully determined outcomes (e.g. only the legal standard response) are rendered locally
+                assembled = assemble_response(retrieval_results_local) if retrieval_results_local else None
+                should_generate_response = bool(retrieval_results_local) and assembled is None
+                should_use_explanation = not retrieval_results_local and explanation_local
+
+                if should_generate_response or should_use_explanation:
+                     await send({"type": "status", "data": "Generating answer..."})
+
+                if retrieval_results_local:
+                    bypass_stats.record(assembled)
+                if assembled is not None:
+                    log.info(f"Deterministic '{assembled.outcome}' response, skipping synthesis.")
+                    final_response_text_local = assembled.final_response_text
+                    citation_map_local = assembled.citation_map
+                    admin.set(["summarization_thoughts"], [assembled.thought])
+                elif should_generate_response:
+                    final_response_text_local = None
+                    citation_map_local = None
+                    synthesis_started = time.perf_counter()
+                    synthesis_first_item = True
+                    async for item in hlp.generate_final_response(
+                        original_user_query=current_user_query,
+                        message_history=history_for_summary,
+                        user_context=user_context,
+                        business_summary=business_summary,
+                        all_retrieval_results=retrieval_results_local,
+                        static_sections=static_sections
+                    ):
+                        item_type = item.get("type")
+                        item_data = item.get("data")
+                        if synthesis_first_item and item_type != "prompt_stats":
+                            trace.record_since("synthesis_ttft", synthesis_started)
+                            synthesis_first_item = False
+
+                        if item_type == "thought":
+                            admin.append(["summarization_thoughts"], item_data)
+                            all_thoughts_this_turn.append(item_data)
+                            await send({"type": "thought", "data": item_data})
+                        elif item_type == "prompt_stats":
+                            admin.set(["prompt_tokens", "synthesis"], item_data)
+                        elif item_type == "final_response_text_delta":
+                            # Forward answer text as it streams; the final_response message stays authoritative
+                            await send({"type": "final_response_delta", "data": item_data})
+                        elif item_type == "final_response_text":
+                            final_response_text_local = item_data
+                        elif item_type == "citation_map":
+                            citation_map_local = item_data
+                        elif item_type == "error":
+                             raise Exception(f"Summarization/Citation Error: {item_data}")
+                    trace.record_since("synthesis_total", synthesis_started)
+
+                    if not final_response_text_local:
+                         final_response_text_local = "I found information but encountered an issue summarizing it."
+                         admin.set(["error"], "Summarization completed but no final_response_text key found.")
+                    if citation_map_local is None:
+                         citation_map_local = {}
+
+                elif should_use_explanation:
+                    log.info("Using planner explanation as final response.")
+                    final_response_text_local = explanation_local
+                    citation_map_local = {}
+                    admin.set(["summarization_thoughts"], ["No summarization needed - used planner explanation."])
+                else: # Fallback
+                    log.info("No retrieval results or planner explanation.")
+                    final_response_text_local = "I wasn't able to retrieve or generate a specific answer for that."
+                    citation_map_local = {}
+                    admin.set(["error"], "Could not generate response from planning or retrieval.")
+
+
+            # Send Final Response Package
+            await send({
+                "type": "final_response",
+                "data": {
+                    "ai_message": final_response_text_local,
+                    "citations": citation_map_local or {},
+                    "thinking_process": all_thoughts_this_turn
+                }
+            })
+            trace.finish()
+            admin.set(["trace"], trace.summary())
+            await admin.flush()
+            spans_ms = trace.summary()["spans_ms"]
+            log.info(f"Trace {trace.trace_id}: {spans_ms}", extra={"fields": {"trace_id": trace.trace_id, "spans_ms": spans_ms}})
+
+
+        except Exception as e:
+            log.exception(f"Error during processing turn: {e}")
+            error_msg = f"An error occurred: {e}"
+            admin.set(["error"], error_msg)
+            metrics.turn_errors_total.inc()
+            await send({"type": "error", "data": error_msg})
+            trace.finish()
+            admin.set(["trace"], trace.summary())
+            await admin.flush()
+            final_response_text_local = f"Sorry, an internal error occurred."
+        finally:
+            # Don't leave speculative or pipelined retrievals running past a failed turn
+            pending_tasks = [task for task in simulation_tasks if not task.done()]
+            if speculative_task is not None:
+                pending_tasks.append(speculative_task)
+            for task in pending_tasks:
+                task.cancel()
+
+
+        # Step 4: Update Session History
+        # Only update history for actual user queries, not reset commands
+        session.chat_history.append({"role": "user", "content": current_user_query})
+        if final_response_text_local:
+            session.chat_history.append({"role": "assistant", "content": final_response_text_local})
+        if store is not None:
+            await store.save(session)
+        log.info(f"History updated. Length: {len(session.chat_history)}")
+        log.info(f"Sticky hint for next turn is now: {session.sticky_hint}")
+        return final_response_text_local
+    except asyncio.CancelledError:
+        # The turn is discarded; keep the hint for the turn that replaces it
+        session.sticky_hint = sticky_hint_before
+        raise
+    except Exception as e:
+        log.exception(f"Error outside turn processing: {e}")
+        try:
+            await send({"type": "error", "data": f"An error occurred: {e}"})
+        except Exception:
+            pass
+        return None
+
 
 # --- Routes ---
 
@@ -50,11 +625,52 @@ async def get_chat_page(request: Request):
     """Serves the main chat HTML page."""
     return templates.TemplateResponse("index.html", {"request": request})
 
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus-style metrics: stage latencies, pipeline counters and cache/router/session stats."""
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    """Handles WebSocket connections for chat."""
+    """Handles WebSocket connections for chat. Each connection works on its own session."""
     await websocket.accept()
-    global chat_history, sticky_hint_for_next_turn
+    session_id = websocket.query_params.get("session_id") or uuid.uuid4().hex
+    session = await session_store.load(session_id)
+    log.info(f"Session {session_id} attached (history length: {len(session.chat_history)}).")
+    await send_frame(websocket, {"type": "session", "data": {"session_id": session_id}})
+    trace = metrics.TurnTrace() # Replaced at the start of each turn
+
+    async def send(message: Dict[str, Any]):
+        """send_frame plus accounting of WebSocket send time for the current turn's trace."""
+        started = time.perf_counter()
+        await send_frame(websocket, message)
+        trace.record("ws_send", time.perf_counter() - started, observe=False)
+        metrics.ws_frames_total.inc()
+
+    # Admin panel state is sent as coalesced deltas instead of full snapshots
+    admin = AdminUpdateChannel(send)
+
+    # The turn in progress runs as its own task so the receive loop can cancel it on a newer
+    # message, a reset or a disconnect (its retrievals and LLM streams are cancelled with it).
+    turn_task: Optional[asyncio.Task] = None
+
+    async def cancel_turn(reason: str):
+        nonlocal turn_task
+        if turn_task is not None and not turn_task.done():
+            log.info(f"Cancelling in-flight turn ({reason}).")
+            metrics.turn_cancellations_total.inc(reason=reason)
+            turn_task.cancel()
+            try:
+                await turn_task
+            except asyncio.CancelledError:
+                pass
+        turn_task = None
+
+    async def run_turn_task(current_user_query: str):
+        """Runs one chat turn on this connection's session with a fresh trace."""
+        nonlocal trace
+        trace = metrics.TurnTrace()
+        await run_turn(session, current_user_query, send, admin, trace)
 
     try:
         while True:
@@ -64,247 +680,236 @@ async def websocket_endpoint(websocket: WebSocket):
             # --- MODIFIED: Check for Reset Command ---
             message_type = message_data.get("type")
             if message_type == "reset":
-                print("Main: Received reset command.")
-                chat_history.clear()
-                sticky_hint_for_next_turn = None
-                print("Main: Chat history and sticky hint reset.")
+                log.info("Received reset command.")
+                await cancel_turn("reset")
+                session.reset()
+                await session_store.save(session)
+                log.info("Chat history and sticky hint reset.")
                 # Send confirmation back to client
-                await websocket.send_json({"type": "system_message", "data": "Chat history has been reset."})
+                await send({"type": "system_message", "data": "Chat history has been reset."})
                 continue # Skip the rest of the loop and wait for next message
             # -----------------------------------------
+            if message_type == "admin_resync":
+                # Client missed an admin_patch sequence number; resend the full state
+                admin.resync()
+                await admin.flush()
+                continue
 
             # --- Existing Logic for Handling User Query ---
             current_user_query = message_data.get("message")
             if not current_user_query:
                 # Ignore messages without a "message" key if not a reset command
-                print(f"Main: Received message without 'message' key: {message_data}")
+                log.warning(f"Received message without 'message' key: {message_data}")
                 continue
 
-            print(f"\n>>> Received User Query via WS: {current_user_query}")
-
-            current_turn_history = list(chat_history)
-            current_sticky_hint = sticky_hint_for_next_turn
-            sticky_hint_for_next_turn = None # Reset hint for this turn
-
-            admin_steps = {
-                "understanding_thoughts": [],
-                "function_calls_made": [],
-                "summarization_thoughts": [],
-                "error": None
-            }
-            plan_calls_local = None
-            retrieval_results_local = []
-            final_response_text_local = None
-            citation_map_local = None
-            explanation_local = None
-            follow_up_question_asked = None
-            all_thoughts_this_turn = []
-
-            try:
-                # Step 1: Planning/Routing
-                print(f"--- Main: Step 1: Planning/Routing (Hint: {current_sticky_hint}) ---")
-                async for item in hlp.process_quickbooks_query(
-                    new_user_query=current_user_query,
-                    message_history=current_turn_history,
-                    user_context=user_context,
-                    business_summary=business_summary,
-                    available_tools=available_tools,
-                    sticky_function_hint=current_sticky_hint
-                ):
-                    # ... (rest of Step 1 logic sending thoughts/admin updates)
-                    item_type = item.get("type")
-                    item_data = item.get("data")
-
-                    if item_type == "thought":
-                        admin_steps["understanding_thoughts"].append(item_data)
-                        all_thoughts_this_turn.append(item_data)
-                        await websocket.send_json({"type": "thought", "data": item_data})
-                        await websocket.send_json({"type": "admin_update", "data": admin_steps})
-                    elif item_type == "function_calls":
-                        plan_calls_local = item_data
-                        admin_steps["function_calls_made"] = []
-                        if plan_calls_local:
-                             for call in plan_calls_local:
-                                 admin_steps["function_calls_made"].append({
-                                     "name": call.get("name"),
-                                     "query": call.get("arguments", {}).get("query") or call.get("arguments", {}).get("data_request"),
-                                     "all_args": call.get("arguments", {}),
-                                     "raw_result": None
-                                 })
-                        await websocket.send_json({"type": "admin_update", "data": admin_steps})
-                    elif item_type == "explanation":
-                        explanation_local = item_data
-                    elif item_type == "error":
-                        raise Exception(f"Planning Error: {item_data}")
-
-
-                # Step 2: Simulate Function Execution
-                print("\n--- Main: Step 2: Simulate Function Execution ---")
-                # ... (rest of Step 2 logic calling stubs, handling results, setting sticky hint) ...
-                if plan_calls_local:
-                    retrieval_results_local = []
-                    simulation_tasks = []
-                    call_indices = {}
-
-                    for index, call_plan in enumerate(plan_calls_local):
-                        tool_name = call_plan.get("name")
-                        arguments = call_plan.get("arguments", {})
-                        query_arg = arguments.get("query") or arguments.get("data_request")
-
-                        if tool_name and query_arg:
-                            task = asyncio.create_task(hlp.simulate_retrieval_stub(
-                                function_name=tool_name,
-                                queries=[query_arg],
-                                top_k=2
-                            ))
-                            simulation_tasks.append(task)
-                            call_indices[task] = index
-                        else:
-                            print(f"Main Skipping simulation for invalid call structure: {call_plan}")
-                            if index < len(admin_steps["function_calls_made"]):
-                                admin_steps["function_calls_made"][index]["raw_result"] = {"error": "Invalid call structure, skipped simulation.", "rejected": True, "rejection_reason": "Invalid call structure"}
-
-                    if simulation_tasks:
-                        completed_tasks, _ = await asyncio.wait(simulation_tasks)
-                        for task in completed_tasks:
-                            original_index = call_indices[task]
-                            try:
-                                sim_data = task.result()
-                                retrieval_results_local.append(sim_data)
-
-                                if sim_data.get("follow_up_question"):
-                                    follow_up_question_asked = sim_data["follow_up_question"]
-                                    print(f"Main: Follow-up question received from {sim_data.get('function_name')}")
-                                if sim_data.get("asked_for_sticky"):
-                                    sticky_hint_for_next_turn = sim_data.get("function_name")
-                                    print(f"Main: Sticky hint set for next turn: {sticky_hint_for_next_turn}")
-
-                                if original_index < len(admin_steps["function_calls_made"]):
-                                     admin_steps["function_calls_made"][original_index]["raw_result"] = sim_data
-
-                            except Exception as sim_exc:
-                                print(f"Main ERROR during simulation task result retrieval for call index {original_index}: {sim_exc}")
-                                traceback.print_exc()
-                                error_result = {"error": f"Simulation task failed: {sim_exc}", "rejected": True, "rejection_reason": "Simulation task execution error"}
-                                if original_index < len(admin_steps["function_calls_made"]):
-                                    admin_steps["function_calls_made"][original_index]["raw_result"] = error_result
-                                retrieval_results_local.append(error_result) # Add error to results
-
-                    await websocket.send_json({"type": "admin_update", "data": admin_steps})
-                else:
-                    print("Main No function calls proposed.")
-
-
-                # Step 3: Generate Final Response OR Use Follow-up Question
-                print("\n--- Main: Step 3: Determine Final Response ---")
-                # ... (rest of Step 3 logic calling generate_final_response or using follow_up/explanation) ...
-                if follow_up_question_asked:
-                    print(f"Main: Using follow-up question as response: {follow_up_question_asked}")
-                    final_response_text_local = follow_up_question_asked
-                    citation_map_local = {}
-                    admin_steps["summarization_thoughts"] = ["Skipped summarization - Follow-up question asked by function."]
-                    await websocket.send_json({"type": "status", "data": "Asking a clarifying question..."})
-                    await websocket.send_json({"type": "admin_update", "data": admin_steps})
-
-                else:
-                    history_for_summary = current_turn_history + [{"role": "user", "content": current_user_query}]
-                    should_generate_response = bool(retrieval_results_local)
-                    should_use_explanation = not should_generate_response and explanation_local
-
-                    if should_generate_response or should_use_explanation:
-                         await websocket.send_json({"type": "status", "data": "Generating answer..."})
-
-                    if should_generate_response:
-                        final_response_text_local = None
-                        citation_map_local = None
-                        async for item in hlp.generate_final_response(
-                            original_user_query=current_user_query,
-                            message_history=history_for_summary,
-                            user_context=user_context,
-                            business_summary=business_summary,
-                            all_retrieval_results=retrieval_results_local
-                        ):
-                            item_type = item.get("type")
-                            item_data = item.get("data")
-
-                            if item_type == "thought":
-                                admin_steps["summarization_thoughts"].append(item_data)
-                                all_thoughts_this_turn.append(item_data)
-                                await websocket.send_json({"type": "thought", "data": item_data})
-                                await websocket.send_json({"type": "admin_update", "data": admin_steps})
-                            elif item_type == "final_response_text":
-                                final_response_text_local = item_data
-                            elif item_type == "citation_map":
-                                citation_map_local = item_data
-                            elif item_type == "error":
-                                 raise Exception(f"Summarization/Citation Error: {item_data}")
-
-                        if not final_response_text_local:
-                             final_response_text_local = "I found information but encountered an issue summarizing it."
-                             admin_steps["error"] = "Summarization completed but no final_response_text key found."
-                        if citation_map_local is None:
-                             citation_map_local = {}
-
-                    elif should_use_explanation:
-                        print("Main Using planner explanation as final response.")
-                        final_response_text_local = explanation_local
-                        citation_map_local = {}
-                        admin_steps["summarization_thoughts"] = ["No summarization needed - used planner explanation."]
-                        await websocket.send_json({"type": "admin_update", "data": admin_steps})
-                    else: # Fallback
-                        print("Main No retrieval results or planner explanation.")
-                        final_response_text_local = "I wasn't able to retrieve or generate a specific answer for that."
-                        citation_map_local = {}
-                        admin_steps["error"] = "Could not generate response from planning or retrieval."
-                        await websocket.send_json({"type": "admin_update", "data": admin_steps})
-
-
-                # Send Final Response Package
-                await websocket.send_json({
-                    "type": "final_response",
-                    "data": {
-                        "ai_message": final_response_text_local,
-                        "citations": citation_map_local or {},
-                        "thinking_process": all_thoughts_this_turn
-                    }
-                })
-                await websocket.send_json({"type": "admin_update", "data": admin_steps})
-
-
-            except Exception as e:
-                print(f"!!! Main ERROR during processing turn: {e}")
-                traceback.print_exc()
-                error_msg = f"An error occurred: {e}"
-                admin_steps["error"] = error_msg
-                await websocket.send_json({"type": "error", "data": error_msg})
-                await websocket.send_json({"type": "admin_update", "data": admin_steps})
-                final_response_text_local = f"Sorry, an internal error occurred."
-
-
-            # Step 4: Update Global History
-            # Only update history for actual user queries, not reset commands
-            chat_history.append({"role": "user", "content": current_user_query})
-            if final_response_text_local:
-                chat_history.append({"role": "assistant", "content": final_response_text_local})
-            print(f"Main History updated. Length: {len(chat_history)}")
-            print(f"Main Sticky hint for next turn is now: {sticky_hint_for_next_turn}")
+            await cancel_turn("superseded")
+            turn_task = asyncio.create_task(run_turn_task(current_user_query))
 
 
     except WebSocketDisconnect:
-        print("Main Client disconnected")
-        sticky_hint_for_next_turn = None
+        log.info(f"Client disconnected (session {session_id})")
+        await cancel_turn("disconnect")
+        admin.close()
+        session.sticky_hint = None
+        await session_store.save(session)
     except Exception as e:
-        print(f"Main WebSocket Error: {e}")
-        traceback.print_exc()
-        sticky_hint_for_next_turn = None
+        log.exception(f"WebSocket error: {e}")
+        await cancel_turn("error")
+        admin.close()
+        session.sticky_hint = None
+        await session_store.save(session)
         try:
-            await websocket.send_json({"type": "error", "data": f"WebSocket error: {e}"})
+            await send_frame(websocket, {"type": "error", "data": f"WebSocket error: {e}"})
         except:
             pass
         await websocket.close()
 
 
+# --- HTTP API ---
+# Stateless: each request carries the "history" ([{"role", "content"}, ...]) and "sticky_hint" its turn
+# should see, and nothing is written to the session store.
+
+def _turn_request_error(body: Dict[str, Any]) -> Optional[str]:
+    """Why a turn request ({"message", "history"?, "sticky_hint"?}) is malformed, or None if it is valid."""
+    query = body.get("message")
+    if not isinstance(query, str) or not query.strip():
+        return "'message' must be a non-empty string."
+    history = body.get("history")
+    if history is not None:
+        if not isinstance(history, list):
+            return "'history' must be a list."
+        for m in history:
+            if not isinstance(m, dict) or not isinstance(m.get("role"), str) or not isinstance(m.get("content"), str):
+                return "Each 'history' entry must be an object with string 'role' and 'content'."
+    sticky_hint = body.get("sticky_hint")
+    if sticky_hint is not None and not isinstance(sticky_hint, str):
+        return "'sticky_hint' must be a string or null."
+    return None
+
+
+def _request_session(body: Dict[str, Any]) -> SessionState:
+    history = [{"role": m["role"], "content": m["content"]} for m in body.get("history") or []]
+    return SessionState(f"http-{uuid.uuid4().hex}", chat_history=history, sticky_hint=body.get("sticky_hint"))
+
+
+def _sse_event(message: Dict[str, Any]) -> str:
+    return f"event: {message['type']}\ndata: {fast_json.dumps(message.get('data'))}\n\n"
+
+
+async def _read_json(request: Request) -> Dict[str, Any]:
+    try:
+        body = fast_json.loads(await request.body())
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Request body must be JSON.")
+    if not isinstance(body, dict):
+        raise HTTPException(status_code=400, detail="Request body must be a JSON object.")
+    return body
+
+
+@app.post("/v1/turn")
+async def http_turn(request: Request):
+    """
+    Runs one turn and streams its frames as Server-Sent Events (event = frame type: thought, status,
+    admin_patch, final_response_delta, final_response, error), then a turn_state event with the
+    sticky_hint for the next turn. Body: {"message", "history"?, "sticky_hint"?, "admin"? (default true)}.
+    Closing the connection cancels the turn.
+    """
+    body = await _read_json(request)
+    error = _turn_request_error(body)
+    if error:
+        raise HTTPException(status_code=400, detail=error)
+    query = body["message"]
+    session = _request_session(body)
+    include_admin = body.get("admin", True)
+    trace = metrics.TurnTrace()
+    frames: asyncio.Queue = asyncio.Queue()
+
+    async def send(message: Dict[str, Any]):
+        if include_admin or message["type"] != "admin_patch":
+            frames.put_nowait(message)
+
+    admin = AdminUpdateChannel(send)
+
+    async def turn():
+        try:
+            await run_turn(session, query, send, admin, trace, store=None)
+        finally:
+            admin.close()
+            frames.put_nowait(None)
+
+    turn_task = asyncio.create_task(turn())
+
+    async def events():
+        try:
+            while True:
+                message = await frames.get()
+                if message is None:
+                    break
+                yield _sse_event(message)
+            yield _sse_event({"type": "turn_state", "data": {"sticky_hint": session.sticky_hint, "trace_id": trace.trace_id}})
+        finally:
+            if not turn_task.done():
+                log.info("HTTP client went away, cancelling its turn.")
+                metrics.turn_cancellations_total.inc(reason="disconnect")
+                turn_task.cancel()
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+async def _run_batch_turn(index: int, item: Dict[str, Any]) -> Dict[str, Any]:
+    """One /v1/batch query through run_turn; returns its answer, tool calls and timing."""
+    result = {"index": index, "id": item.get("id", index)}
+    error = _turn_request_error(item)
+    if error:
+        result["error"] = error
+        return result
+    query = item["message"]
+    session = _request_session(item)
+    outcome: Dict[str, Any] = {}
+
+    async def send(message: Dict[str, Any]):
+        if message["type"] in ("final_response", "error"):
+            outcome.setdefault(message["type"], message["data"])
+
+    admin = AdminUpdateChannel(send)
+    trace = metrics.TurnTrace()
+    started = time.perf_counter()
+    try:
+        await run_with_priority("batch", run_turn(session, query, send, admin, trace, store=None))
+    finally:
+        admin.close()
+    final = outcome.get("final_response") or {}
+    result.update({
+        "ai_message": final.get("ai_message"),
+        "citations": final.get("citations", {}),
+        "function_calls": [
+            {"name": call.get("name"), "query": call.get("query"), "rejected": bool((call.get("raw_result") or {}).get("rejected"))}
+            for call in admin.state.get("function_calls_made", [])
+        ],
+        "sticky_hint": session.sticky_hint,
+        "error": outcome.get("error"),
+        "seconds": round(time.perf_counter() - started, 4),
+        "trace_id": trace.trace_id
+    })
+    return result
+
+
+@app.post("/v1/batch")
+async def http_batch(request: Request):
+    """
+    Runs independent queries concurrently (at most "concurrency", capped by BATCH_MAX_CONCURRENCY) and
+    streams one JSON line per query as it finishes, in completion order (match on "index" or "id").
+    Body: {"queries": ["...", {"id", "message", "history"?, "sticky_hint"?}, ...], "concurrency"?}.
+    Batch LLM calls are scheduled behind interactive sessions.
+    """
+    body = await _read_json(request)
+    items = body.get("queries")
+    if not isinstance(items, list) or not items:
+        raise HTTPException(status_code=400, detail="'queries' must be a non-empty list.")
+    if len(items) > BATCH_MAX_QUERIES:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_QUERIES} queries per batch.")
+    if not all(isinstance(item, (str, dict)) for item in items):
+        raise HTTPException(status_code=400, detail="Each query must be a string or an object.")
+    items = [item if isinstance(item, dict) else {"message": item} for item in items]
+    concurrency = body.get("concurrency", BATCH_MAX_CONCURRENCY)
+    if isinstance(concurrency, bool) or not isinstance(concurrency, int):
+        raise HTTPException(status_code=400, detail="'concurrency' must be an integer.")
+    concurrency = max(1, min(concurrency, BATCH_MAX_CONCURRENCY))
+    log.info(f"Batch of {len(items)} queries, concurrency {concurrency}.")
+
+    async def results():
+        pending = iter(enumerate(items))
+        running: Dict[asyncio.Task, int] = {}
+        try:
+            while True:
+                # Start at most `concurrency` turns at a time; the rest wait as (index, item) pairs, not tasks
+                for index, item in pending:
+                    running[asyncio.create_task(_run_batch_turn(index, item))] = index
+                    if len(running) >= concurrency:
+                        break
+                if not running:
+                    break
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    index = running.pop(task)
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        # One failing query gets an error line; the rest of the batch keeps streaming
+                        log.error(f"Batch query {index} failed: {e}")
+                        result = {"index": index, "id": items[index].get("id", index), "error": f"Internal error: {e}"}
+                    yield fast_json.dumps(result) + "\n"
+        finally:
+            for task in running:
+                task.cancel()
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
+
 # --- Run the app ---
 if __name__ == "__main__":
-    print("Starting FastAPI server with WebSocket support...")
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    log.info("Starting FastAPI server with WebSocket support...")
+    if WORKERS > 1:
+        uvicorn.run("main:app", host=HOST, port=PORT, workers=WORKERS) # reload is single-process only
+    else:
+        uvicorn.run("main:app", host=HOST, port=PORT, reload=True)
\ No newline at end of file
@@ -0,0 +1,253 @@
+# metrics.py
+
+import bisect
+import math
+import os
+import time
+import uuid
+from typing import List, Dict, Any, Callable, Optional, Tuple
+
+from structured_log import get_logger
+
+log = get_logger("Metrics")
+
+# --- Configuration ---
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict[str, Any]) -> LabelKey:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(key) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+# --- Metric Types ---
+# Metrics are updated from the event loop only, so no locking is needed.
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self._values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        if METRICS_ENABLED:
+            key = _label_key(labels)
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(_label_key(labels), 0.0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        lines.extend(f"{self.name}{_format_labels(key)} {_format_value(value)}" for key, value in self._values.items())
+        return lines
+
+
+class Gauge:
+    """A value that is set directly, or read from callback at scrape time."""
+
+    def __init__(self, name: str, help_text: str, callback: Optional[Callable[[], float]] = None):
+        self.name = name
+        self.help_text = help_text
+        self.callback = callback
+        self._values: Dict[LabelKey, float] = {}
+
+    def set(self, value: float, **labels):
+        self._values[_label_key(labels)] = value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        values = dict(self._values)
+        if self.callback is not None:
+            values[()] = self.callback()
+        lines.extend(f"{self.name}{_format_labels(key)} {_format_value(value)}" for key, value in values.items())
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[LabelKey, List[float]] = {} # Per label set: bucket counts..., +Inf count, sum
+
+    def observe(self, value: float, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = _label_key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [0.0] * (len(self.buckets) + 2)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def count(self, **labels) -> int:
+        series = self._series.get(_label_key(labels))
+        return int(sum(series[:-1])) if series else 0
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, series in self._series.items():
+            cumulative = 0.0
+            for bound, count in zip(self.buckets + (float("inf"),), series[:-1]):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(key, ('le', _format_value(bound)))} {_format_value(cumulative)}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(series[-1])}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {_format_value(cumulative)}")
+        return lines
+
+
+# --- Registry ---
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Any] = {}
+        self._stats_sources: List[Tuple[str, Callable[[], Dict[str, Any]]]] = []
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            return self._metrics[metric.name]
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self._register(Counter(name, help_text))
+
+    def gauge(self, name: str, help_text: str, callback: Optional[Callable[[], float]] = None) -> Gauge:
+        return self._register(Gauge(name, help_text, callback))
+
+    def histogram(self, name: str, help_text: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, buckets))
+
+    def register_stats(self, prefix: str, stats_fn: Callable[[], Dict[str, Any]]):
+        """Exposes the numeric values of an existing stats() dict as gauges named <prefix>_<key>."""
+        self._stats_sources.append((prefix, stats_fn))
+
+    def _stats_lines(self) -> List[str]:
+        lines = []
+        for prefix, stats_fn in self._stats_sources:
+            try:
+                stats = stats_fn()
+            except Exception as e:
+                log.warning(f"stats source '{prefix}' failed ({e}).")
+                continue
+            for key, value in _flatten(stats):
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                name = f"{prefix}_{key}"
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {_format_value(value)}")
+        return lines
+
+    def render(self) -> str:
+        """Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        lines.extend(self._stats_lines())
+        return "\n".join(lines) + "\n"
+
+
+def _flatten(stats: Dict[str, Any], prefix: str = "") -> List[Tuple[str, Any]]:
+    items = []
+    for key, value in stats.items():
+        name = f"{prefix}{key}".replace(":", "_").replace("-", "_").replace(".", "_")
+        if isinstance(value, dict):
+            items.extend(_flatten(value, name + "_"))
+        else:
+            items.append((name, value))
+    return items
+
+
+registry = Registry()
+
+# --- Pipeline Metrics ---
+stage_seconds = registry.histogram("qb_stage_seconds", "Latency of pipeline stages (planning_ttft, planning_total, retrieval, synthesis_ttft, synthesis_total, fused_ttft, fused_total, ws_send, turn_total).")
+retrieval_seconds = registry.histogram("qb_retrieval_seconds", "Latency of individual retrieval tasks by tool.")
+turns_total = registry.counter("qb_turns_total", "Chat turns processed.")
+turn_errors_total = registry.counter("qb_turn_errors_total", "Chat turns that ended with an error.")
+turn_cancellations_total = registry.counter("qb_turn_cancellations_total", "In-flight chat turns cancelled, by reason (superseded, reset, disconnect, error).")
+rejections_total = registry.counter("qb_rejections_total", "Retrieval results marked rejected, by tool.")
+follow_ups_total = registry.counter("qb_follow_ups_total", "Follow-up questions asked instead of an answer, by tool.")
+llm_bypass_total = registry.counter("qb_llm_bypass_total", "Turns answered by deterministic response assembly instead of the synthesizer, by outcome.")
+fused_turns_total = registry.counter("qb_fused_turns_total", "Turns tried on the fused single-call path, by tool and outcome (answered, fallback).")
+sticky_hints_total = registry.counter("qb_sticky_hints_total", "Sticky hints set for the next turn, by tool.")
+llm_errors_total = registry.counter("qb_llm_errors_total", "LLM calls that failed, by stage.")
+llm_queue_wait_seconds = registry.histogram("qb_llm_queue_wait_seconds", "Time LLM calls waited for a scheduler slot, by stage.")
+llm_timeouts_total = registry.counter("qb_llm_timeouts_total", "LLM calls that missed their deadline or stalled, by stage and kind.")
+llm_retries_total = registry.counter("qb_llm_retries_total", "LLM calls retried after failing before their first chunk, by stage.")
+llm_cancellations_total = registry.counter("qb_llm_cancellations_total", "LLM calls cancelled because every caller went away, by stage.")
+llm_hedges_total = registry.counter("qb_llm_hedges_total", "Hedged duplicate LLM calls started, by stage.")
+retrieval_timeouts_total = registry.counter("qb_retrieval_timeouts_total", "Retrievals dropped from synthesis, by tool and reason (deadline, or straggler after the quorum).")
+ws_frames_total = registry.counter("qb_ws_frames_total", "WebSocket frames sent.")
+process_start_time = registry.gauge("qb_process_start_time_seconds", "Unix time the process started.")
+process_start_time.set(time.time())
+
+
+# --- Per-Turn Tracing ---
+class TurnTrace:
+    """
+    Spans for one chat turn. Durations are recorded in the stage histogram as they complete and kept
+    on the trace for the admin panel. Spans recorded more than once (e.g. ws_send) accumulate.
+    """
+
+    def __init__(self, trace_id: Optional[str] = None):
+        self.trace_id = trace_id or uuid.uuid4().hex[:16]
+        self.started = time.perf_counter()
+        self.spans: Dict[str, float] = {}
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def record(self, name: str, seconds: float, observe: bool = True):
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+        if observe:
+            stage_seconds.observe(seconds, stage=name)
+
+    def record_since(self, name: str, started: float):
+        """Records perf_counter() - started, e.g. a time-to-first-token from the start of a stage."""
+        self.record(name, time.perf_counter() - started)
+
+    def span(self, name: str) -> "_Span":
+        return _Span(self, name)
+
+    def finish(self):
+        self.record("turn_total", self.elapsed())
+        # ws_send is observed once per turn as a total, not per frame
+        if "ws_send" in self.spans:
+            stage_seconds.observe(self.spans["ws_send"], stage="ws_send")
+
+    def summary(self) -> Dict[str, Any]:
+        return {"trace_id": self.trace_id, "spans_ms": {name: round(seconds * 1000, 1) for name, seconds in self.spans.items()}}
+
+
+class _Span:
+    def __init__(self, trace: TurnTrace, name: str):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.trace.record(self.name, time.perf_counter() - self.start)
+        return False
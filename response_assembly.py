@@ -0,0 +1,115 @@
+# response_assembly.py
+
+from typing import List, Dict, Any, Optional
+
+import metrics
+
+# --- Deterministic Outcomes ---
+# follow_up      a tool asked a clarifying question: that question is the answer
+# rejection_only no successful content: standard warnings from rejected tools, else their reasons
+# empty          nothing successful and nothing rejected
+# verbatim       every successful chunk is present_as_is (e.g. the legal standard response): the chunks
+#                with their citation ids, plus a note about any rejected parts
+# Anything with content to summarize still goes to the LLM synthesizer.
+EMPTY_RESPONSE = "I couldn't find specific information to answer your question based on the search results."
+
+
+class AssembledResponse:
+    def __init__(self, outcome: str, final_response_text: str, citation_map: Dict[str, Dict[str, str]], thought: str):
+        self.outcome = outcome
+        self.final_response_text = final_response_text
+        self.citation_map = citation_map
+        self.thought = thought
+
+    def as_events(self) -> List[Dict[str, Any]]:
+        """Same item shapes generate_final_response yields."""
+        return [
+            {"type": "thought", "data": self.thought},
+            {"type": "final_response_text", "data": self.final_response_text},
+            {"type": "citation_map", "data": self.citation_map}
+        ]
+
+
+def _rejection_reasons(rejected: List[Dict[str, Any]]) -> List[str]:
+    return [r["rejection_reason"] for r in rejected if r.get("rejection_reason")]
+
+
+def assemble_response(all_retrieval_results: List[Dict[str, Any]]) -> Optional[AssembledResponse]:
+    """
+    Renders the answer locally if the retrieval results fully determine it, else returns None.
+    Citation ids are numbered like generate_final_response numbers its sources.
+    """
+    for result in all_retrieval_results:
+        if result.get("follow_up_question"):
+            return AssembledResponse("follow_up", result["follow_up_question"], {}, "A tool asked a clarifying question.")
+
+    rejected = [r for r in all_retrieval_results if r.get("rejected", False)]
+    successful = [r for r in all_retrieval_results if not r.get("rejected", False) and r.get("retrieved_chunks")]
+    standard_warnings = [
+        chunk.get("chunk_content", "")
+        for r in rejected if r.get("present_as_is") and r.get("retrieved_chunks")
+        for chunk in r["retrieved_chunks"] if chunk.get("chunk_content")
+    ]
+
+    if not successful:
+        if not rejected:
+            return AssembledResponse("empty", EMPTY_RESPONSE, {}, "No usable information retrieved from functions.")
+        if standard_warnings:
+            text = "\n".join(standard_warnings)
+        else:
+            reasons = _rejection_reasons(rejected)
+            text = ("I couldn't process your request fully because: " + " ".join(reasons)) if reasons else "I was unable to process your request with the available tools."
+        return AssembledResponse("rejection_only", text, {}, "All tools rejected the request or could not provide data.")
+
+    if not all(r.get("present_as_is") for r in successful):
+        return None
+
+    parts = []
+    citation_map = {}
+    citation_id = 1
+    for result in successful:
+        for chunk in result["retrieved_chunks"]:
+            content = chunk.get("chunk_content", "")
+            link = chunk.get("source_link", "#")
+            if not content or not link:
+                continue
+            parts.append(f"{content} [{citation_id}]")
+            citation_map[str(citation_id)] = {"title": chunk.get("source_article", "Unknown Source"), "link": link}
+            citation_id += 1
+    if not parts:
+        return None
+
+    text = "\n\n".join(parts)
+    if standard_warnings:
+        text = "\n".join(standard_warnings) + "\n\n" + text
+    reasons = _rejection_reasons(rejected)
+    if reasons:
+        text += "\n\nNote: I couldn't process part of your request: " + " ".join(reasons)
+    return AssembledResponse("verbatim", text, citation_map, "Sources are presented verbatim; no summarization needed.")
+
+
+# --- Bypass Accounting ---
+class BypassStats:
+    """Counts synthesis decisions: record() once per turn with the assemble_response() result."""
+
+    def __init__(self):
+        self.checked = 0
+        self.by_outcome: Dict[str, int] = {}
+
+    def record(self, assembled: Optional[AssembledResponse]):
+        self.checked += 1
+        if assembled is not None:
+            self.by_outcome[assembled.outcome] = self.by_outcome.get(assembled.outcome, 0) + 1
+            metrics.llm_bypass_total.inc(outcome=assembled.outcome)
+
+    def stats(self) -> Dict[str, Any]:
+        bypassed = sum(self.by_outcome.values())
+        return {
+            "checked": self.checked,
+            "bypassed": bypassed,
+            "by_outcome": dict(self.by_outcome),
+            "bypass_share": bypassed / self.checked if self.checked else 0.0
+        }
+
+
+bypass_stats = BypassStats()
@@ -0,0 +1,239 @@
+# retrieval_cache.py
+
+import copy
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+
+import embeddings
+from shared_store import shared_store
+from structured_log import get_logger
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+log = get_logger("Retrieval Cache")
+
+# --- Configuration ---
+RETRIEVAL_CACHE_ENABLED = os.getenv("RETRIEVAL_CACHE_ENABLED", "1") == "1"
+RETRIEVAL_CACHE_MAX = int(os.getenv("RETRIEVAL_CACHE_MAX", "5000"))
+RETRIEVAL_CACHE_TTL_SECONDS = float(os.getenv("RETRIEVAL_CACHE_TTL_SECONDS", "900"))
+RETRIEVAL_CACHE_SEMANTIC = os.getenv("RETRIEVAL_CACHE_SEMANTIC", "0") == "1"
+RETRIEVAL_CACHE_SIMILARITY = float(os.getenv("RETRIEVAL_CACHE_SIMILARITY", "0.92"))
+# Tools whose results depend on the user's account, not just the query, are never cached (comma-separated)
+RETRIEVAL_CACHE_EXCLUDE = os.getenv("RETRIEVAL_CACHE_EXCLUDE", "user_data_query")
+
+CacheKey = Tuple[str, str, int]
+
+
+def normalize_query(query: str) -> str:
+    """Lowercases, drops punctuation and collapses whitespace so trivially different phrasings share a key."""
+    query = re.sub(r"[^\w\s]", " ", query.lower())
+    return re.sub(r"\s+", " ", query).strip()
+
+
+# --- Semantic Tier ---
+class _SemanticIndex:
+    """
+    Nearest-neighbour index over cached query embeddings for one (function_name, top_k) namespace.
+    Uses a faiss inner-product index when available, otherwise a numpy matrix.
+    """
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self._next_id = 0
+        self._id_to_key: Dict[int, CacheKey] = {}
+        self._key_to_id: Dict[CacheKey, int] = {}
+        if faiss is not None:
+            self._index = faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+        else:
+            self._index = None
+            self._vectors: Dict[int, Any] = {}
+
+    def add(self, key: CacheKey, vector):
+        self.remove(key)
+        vector_id = self._next_id
+        self._next_id += 1
+        self._id_to_key[vector_id] = key
+        self._key_to_id[key] = vector_id
+        if self._index is not None:
+            self._index.add_with_ids(vector.reshape(1, -1), embeddings.np.array([vector_id], dtype="int64"))
+        else:
+            self._vectors[vector_id] = vector
+
+    def remove(self, key: CacheKey):
+        vector_id = self._key_to_id.pop(key, None)
+        if vector_id is None:
+            return
+        del self._id_to_key[vector_id]
+        if self._index is not None:
+            self._index.remove_ids(embeddings.np.array([vector_id], dtype="int64"))
+        else:
+            self._vectors.pop(vector_id, None)
+
+    def nearest(self, vector) -> Optional[Tuple[CacheKey, float]]:
+        if not self._id_to_key:
+            return None
+        if self._index is not None:
+            scores, ids = self._index.search(vector.reshape(1, -1), 1)
+            if ids[0][0] < 0:
+                return None
+            return self._id_to_key[int(ids[0][0])], float(scores[0][0])
+        ids = list(self._vectors.keys())
+        matrix = embeddings.np.stack([self._vectors[i] for i in ids])
+        scores = matrix @ vector
+        best = int(scores.argmax())
+        return self._id_to_key[ids[best]], float(scores[best])
+
+
+# --- Retrieval Cache ---
+class RetrievalCache:
+    """
+    Caches simulate_retrieval_stub results keyed by (function_name, normalized query, top_k).
+    Exact-match lookups first; if the semantic tier is enabled, a miss falls back to the most
+    similar cached query for the same tool/top_k above similarity_threshold.
+    Entries expire after ttl_seconds; the least recently used entry is evicted beyond max_entries.
+    With a shared store (SHARED_STORE), exact entries are also written there, and local misses are
+    looked up there, so results cached by one worker serve all of them.
+    Tools in excluded_tools (per-account data) are neither looked up nor stored.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = RETRIEVAL_CACHE_MAX,
+        ttl_seconds: float = RETRIEVAL_CACHE_TTL_SECONDS,
+        semantic: bool = RETRIEVAL_CACHE_SEMANTIC,
+        similarity_threshold: float = RETRIEVAL_CACHE_SIMILARITY,
+        shared=shared_store,
+        excluded_tools: str = RETRIEVAL_CACHE_EXCLUDE
+    ):
+        self.max_entries = max_entries
+        self.excluded_tools = {name.strip() for name in excluded_tools.split(",") if name.strip()}
+        self.shared = shared
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.semantic = semantic and embeddings.embeddings_available()
+        if semantic and not self.semantic:
+            log.warning("Semantic tier requested but embeddings are unavailable; using exact match only.")
+        self._entries: "OrderedDict[CacheKey, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._semantic_indexes: Dict[Tuple[str, int], _SemanticIndex] = {}
+        self._embedding_memo: "OrderedDict[str, Any]" = OrderedDict()
+        self.hits = 0
+        self.shared_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.excluded = 0
+
+    def cacheable(self, function_name: str) -> bool:
+        return function_name not in self.excluded_tools
+
+    def _drop(self, key: CacheKey):
+        self._entries.pop(key, None)
+        index = self._semantic_indexes.get((key[0], key[2]))
+        if index is not None:
+            index.remove(key)
+
+    def _get_live(self, key: CacheKey, now: float) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, result = entry
+        if expires_at < now:
+            self._drop(key)
+            self.evictions += 1
+            return None
+        self._entries.move_to_end(key)
+        return result
+
+    @staticmethod
+    def _shared_key(key: CacheKey) -> str:
+        return f"{key[0]}|{key[2]}|{key[1]}"
+
+    async def _embed(self, normalized_query: str):
+        vector = self._embedding_memo.get(normalized_query)
+        if vector is None:
+            vector = await embeddings.embed_query_async(normalized_query)
+            self._embedding_memo[normalized_query] = vector
+            while len(self._embedding_memo) > 256:
+                self._embedding_memo.popitem(last=False)
+        return vector
+
+    async def get(self, function_name: str, query: str, top_k: int) -> Optional[Dict[str, Any]]:
+        """Returns a copy of the cached result, or None on a miss."""
+        if not self.cacheable(function_name):
+            self.excluded += 1
+            return None
+        now = time.time()
+        key = (function_name, normalize_query(query), top_k)
+        result = self._get_live(key, now)
+        if result is not None:
+            self.hits += 1
+            return copy.deepcopy(result)
+
+        if self.shared is not None:
+            result = await self.shared.get("retrieval", self._shared_key(key))
+            if result is not None:
+                self.shared_hits += 1
+                await self._put_local(key, result)
+                return copy.deepcopy(result)
+
+        if self.semantic:
+            index = self._semantic_indexes.get((function_name, top_k))
+            if index is not None:
+                nearest = index.nearest(await self._embed(key[1]))
+                if nearest and nearest[1] >= self.similarity_threshold:
+                    result = self._get_live(nearest[0], now)
+                    if result is not None:
+                        self.semantic_hits += 1
+                        return copy.deepcopy(result)
+
+        self.misses += 1
+        return None
+
+    async def put(self, function_name: str, query: str, top_k: int, result: Dict[str, Any]):
+        if not self.cacheable(function_name):
+            return
+        key = (function_name, normalize_query(query), top_k)
+        await self._put_local(key, result)
+        if self.shared is not None:
+            await self.shared.set("retrieval", self._shared_key(key), result, self.ttl_seconds)
+
+    async def _put_local(self, key: CacheKey, result: Dict[str, Any]):
+        function_name, _, top_k = key
+        self._entries[key] = (time.time() + self.ttl_seconds, copy.deepcopy(result))
+        self._entries.move_to_end(key)
+        if self.semantic:
+            vector = await self._embed(key[1])
+            index = self._semantic_indexes.get((function_name, top_k))
+            if index is None:
+                index = self._semantic_indexes[(function_name, top_k)] = _SemanticIndex(len(vector))
+            index.add(key, vector)
+        while len(self._entries) > self.max_entries:
+            oldest_key = next(iter(self._entries))
+            self._drop(oldest_key)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._semantic_indexes.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.shared_hits + self.semantic_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "excluded": self.excluded,
+            "hit_rate": (self.hits + self.shared_hits + self.semantic_hits) / lookups if lookups else 0.0
+        }
+
+
+retrieval_cache = RetrievalCache() if RETRIEVAL_CACHE_ENABLED else None
@@ -0,0 +1,247 @@
+# router.py
+
+import hashlib
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple
+
+import embeddings
+from retrieval_cache import normalize_query
+from shared_store import shared_store
+
+# --- Configuration ---
+FAST_PATH_ROUTING = os.getenv("FAST_PATH_ROUTING", "1") == "1"
+FAST_PATH_CONFIDENCE = float(os.getenv("FAST_PATH_CONFIDENCE", "0.8"))
+FAST_PATH_EMBEDDINGS = os.getenv("FAST_PATH_EMBEDDINGS", "0") == "1"
+FAST_PATH_MAX_WORDS = int(os.getenv("FAST_PATH_MAX_WORDS", "25"))
+PLANNER_CACHE_MAX = int(os.getenv("PLANNER_CACHE_MAX", "2000"))
+PLANNER_CACHE_TTL_SECONDS = float(os.getenv("PLANNER_CACHE_TTL_SECONDS", "3600"))
+
+# --- Routing Rules ---
+# (tool_name, pattern, confidence). Specific rules win over generic ones; if specific rules for
+# different tools match, the query is ambiguous and goes to the LLM planner.
+# Generic rules score below FAST_PATH_CONFIDENCE: "how do I ..." alone never skips the planner, it only
+# has to agree with the embedding match.
+SPECIFIC_RULES = [
+    ("legal_compliance_retrieval", r'\b(illegal(ly)?|evade|evasion|launder\w*|under the table|hide (income|money)|credit ?worth\w*|credit score|(application|loan) (was )?(rejected|denied)|why (was|am) i (rejected|denied))\b', 0.95),
+    ("payroll_qna_retrieval", r'\bcontributions?\b', 0.95),
+    ("payroll_qna_retrieval", r'\b(payroll|paychecks?|pay stubs?|w-?2s?|w-?4s?|1099s?|withholding|payroll tax(es)?)\b', 0.9),
+    ("user_data_query", r"\b(how many|how much (do|did|does|have|has)|what('s| is) (my|the current)|show me my|list (my|all my))\b.*\b(balance|customers?|vendors?|invoices?|bills?|accounts?|sales|expenses|revenue|total)\b", 0.85),
+]
+GENERIC_RULES = [
+    ("general_product_support_retrieval", r'^\s*(how (do|can|should) i|how to|where (do|can) i|can i|is there a way to)\b', 0.6),
+]
+
+# Phrases that make a query depend on earlier turns or ask for several things at once
+CONTEXT_DEPENDENT = re.compile(r'\b(it|that|this|those|these|them|the same|above|previous|again|also|as well)\b', re.IGNORECASE)
+MULTI_INTENT = re.compile(r'\?.+\?|\b(and also|as well as|and then|plus)\b', re.IGNORECASE)
+
+# Example queries used by the embedding nearest-neighbour classifier (alongside tool descriptions)
+TOOL_EXEMPLARS = {
+    "payroll_qna_retrieval": ["How do I run payroll?", "When are W2 forms due?", "How do I set up a new employee for payroll?", "How do I file 1099s for contractors?"],
+    "general_product_support_retrieval": ["How do I create an invoice?", "How do I reconcile my bank account?", "How do I add a vendor?", "How do I run a profit and loss report?"],
+    "legal_compliance_retrieval": ["How can I hide income from the IRS?", "Why was my loan application rejected?", "How do I pay employees under the table?"],
+    "user_data_query": ["What is my total bank balance?", "How many active customers do I have?", "How much do I owe Acme Supplies?"],
+}
+
+
+def _primary_argument_name(tool: Dict[str, Any]) -> str:
+    """Name of the first required parameter (e.g. 'query' or 'data_request')."""
+    for param in tool.get("parameters", []):
+        if param.get("required"):
+            return param["name"]
+    return "query"
+
+
+def build_tool_call(tool: Dict[str, Any], query: str) -> Dict[str, Any]:
+    """A function_calls entry passing the query as the tool's primary argument."""
+    return {"name": tool["name"], "arguments": {_primary_argument_name(tool): query}}
+
+
+def rule_matches(query: str, tool_names: Optional[set] = None) -> List[Tuple[str, float]]:
+    """Returns (tool_name, confidence) for every specific rule that matches, else the generic matches."""
+    matches = []
+    for rules in (SPECIFIC_RULES, GENERIC_RULES):
+        for tool_name, pattern, confidence in rules:
+            if tool_names is not None and tool_name not in tool_names:
+                continue
+            if re.search(pattern, query, re.IGNORECASE):
+                matches.append((tool_name, confidence))
+        if matches:
+            break
+    return matches
+
+
+class RouteDecision:
+    """A planning outcome produced without the LLM planner."""
+
+    def __init__(self, function_calls: List[Dict[str, Any]], confidence: float, source: str, reason: str):
+        self.function_calls = function_calls
+        self.confidence = confidence
+        self.source = source # "rule", "embedding" or "cache"
+        self.reason = reason
+
+    def as_events(self) -> List[Dict[str, Any]]:
+        """Same item shapes process_quickbooks_query yields for an LLM plan."""
+        return [
+            {"type": "thought", "data": f"Fast-path routing ({self.source}, confidence {self.confidence:.2f}): {self.reason}"},
+            {"type": "function_calls", "data": self.function_calls},
+        ]
+
+
+# --- Fast-Path Router ---
+class FastPathRouter:
+    """
+    Routes keyword-obvious, self-contained queries to a single tool without an LLM call,
+    and remembers recent LLM planner decisions for repeated queries.
+    Anything ambiguous, context-dependent or below confidence_threshold returns None (use the LLM).
+    """
+
+    def __init__(
+        self,
+        confidence_threshold: float = FAST_PATH_CONFIDENCE,
+        use_embeddings: bool = FAST_PATH_EMBEDDINGS,
+        max_words: int = FAST_PATH_MAX_WORDS,
+        cache_max: int = PLANNER_CACHE_MAX,
+        cache_ttl_seconds: float = PLANNER_CACHE_TTL_SECONDS,
+        shared=shared_store
+    ):
+        self.shared = shared # Planner decisions are also shared with other workers when set
+        self.confidence_threshold = confidence_threshold
+        self.use_embeddings = use_embeddings and embeddings.embeddings_available()
+        self.max_words = max_words
+        self.cache_max = cache_max
+        self.cache_ttl_seconds = cache_ttl_seconds
+        self._decision_cache: "OrderedDict[str, Tuple[float, List[Dict[str, Any]]]]" = OrderedDict()
+        self._exemplar_matrix = None
+        self._exemplar_tools: List[str] = []
+        self._exemplar_tools_key = None
+        self.turns = 0
+        self.short_circuited = {"rule": 0, "embedding": 0, "cache": 0}
+
+    # --- Helpers ---
+    def _is_self_contained(self, query: str, message_history: List[Dict[str, str]]) -> bool:
+        if len(query.split()) > self.max_words or MULTI_INTENT.search(query):
+            return False
+        return not (message_history and CONTEXT_DEPENDENT.search(query))
+
+    @staticmethod
+    def _cache_key(query: str, available_tools: List[Dict[str, Any]]) -> str:
+        tool_names = ",".join(sorted(tool.get("name", "") for tool in available_tools))
+        raw = f"{normalize_query(query)}|{tool_names}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _build_call(self, tool: Dict[str, Any], query: str) -> Dict[str, Any]:
+        return build_tool_call(tool, query)
+
+    async def _embedding_scores(self, query: str, available_tools: List[Dict[str, Any]]) -> List[Tuple[str, float]]:
+        tools_key = tuple(tool.get("name") for tool in available_tools)
+        if self._exemplar_matrix is None or self._exemplar_tools_key != tools_key:
+            texts, owners = [], []
+            for tool in available_tools:
+                for text in [tool.get("description", "")] + TOOL_EXEMPLARS.get(tool["name"], []):
+                    texts.append(text)
+                    owners.append(tool["name"])
+            self._exemplar_matrix = await embeddings.embed_texts_async(texts)
+            self._exemplar_tools = owners
+            self._exemplar_tools_key = tools_key
+        scores = self._exemplar_matrix @ (await embeddings.embed_query_async(query))
+        best_per_tool: Dict[str, float] = {}
+        for owner, score in zip(self._exemplar_tools, scores.tolist()):
+            best_per_tool[owner] = max(best_per_tool.get(owner, -1.0), score)
+        return sorted(best_per_tool.items(), key=lambda item: item[1], reverse=True)
+
+    # --- Public API ---
+    async def route(
+        self,
+        query: str,
+        message_history: List[Dict[str, str]],
+        available_tools: List[Dict[str, Any]],
+        sticky_hint: Optional[str] = None
+    ) -> Optional[RouteDecision]:
+        self.turns += 1
+        tools_by_name = {tool["name"]: tool for tool in available_tools if tool.get("name")}
+
+        # Sticky hints and conversational follow-ups need the planner's judgement
+        if sticky_hint or not self._is_self_contained(query, message_history):
+            return None
+
+        # 1. Planner decision cache (repeat of a self-contained query seen recently)
+        key = self._cache_key(query, available_tools)
+        entry = self._decision_cache.get(key)
+        if entry is not None:
+            if entry[0] >= time.time():
+                self._decision_cache.move_to_end(key)
+                self.short_circuited["cache"] += 1
+                return RouteDecision(json.loads(json.dumps(entry[1])), 1.0, "cache", "reusing the plan for an identical recent query.")
+            del self._decision_cache[key]
+        # Missing or expired locally: another worker may have stored a fresher plan
+        if self.shared is not None:
+            function_calls = await self.shared.get("planner", key)
+            if function_calls is not None:
+                self._remember_local(key, function_calls)
+                self.short_circuited["cache"] += 1
+                return RouteDecision(function_calls, 1.0, "cache", "reusing the plan for an identical recent query.")
+
+        # 2. Keyword rules
+        matches = rule_matches(query, set(tools_by_name))
+        matched_tools = {tool_name for tool_name, _ in matches}
+        if len(matched_tools) == 1:
+            tool_name = matches[0][0]
+            confidence = max(confidence for _, confidence in matches)
+            if confidence >= self.confidence_threshold:
+                self.short_circuited["rule"] += 1
+                return RouteDecision([self._build_call(tools_by_name[tool_name], query)], confidence, "rule", f"query matches {tool_name} keywords.")
+        elif len(matched_tools) > 1:
+            return None
+
+        # 3. Embedding nearest neighbour over tool descriptions and exemplars
+        if self.use_embeddings and tools_by_name:
+            ranked = await self._embedding_scores(query, available_tools)
+            if ranked:
+                best_tool, best_score = ranked[0]
+                runner_up = ranked[1][1] if len(ranked) > 1 else 0.0
+                # Require agreement with any rule match and a clear margin over the next tool
+                agrees = not matched_tools or best_tool in matched_tools
+                confidence = best_score if best_score - runner_up >= 0.1 else 0.0
+                if agrees and confidence >= self.confidence_threshold:
+                    self.short_circuited["embedding"] += 1
+                    return RouteDecision([self._build_call(tools_by_name[best_tool], query)], confidence, "embedding", f"query is closest to {best_tool} examples.")
+        return None
+
+    async def remember(
+        self,
+        query: str,
+        message_history: List[Dict[str, str]],
+        available_tools: List[Dict[str, Any]],
+        sticky_hint: Optional[str],
+        function_calls: List[Dict[str, Any]]
+    ):
+        """Stores an LLM planner decision for a self-contained query so repeats skip the LLM."""
+        if not function_calls or sticky_hint or not self._is_self_contained(query, message_history):
+            return
+        key = self._cache_key(query, available_tools)
+        self._remember_local(key, function_calls)
+        if self.shared is not None:
+            await self.shared.set("planner", key, function_calls, self.cache_ttl_seconds)
+
+    def _remember_local(self, key: str, function_calls: List[Dict[str, Any]]):
+        self._decision_cache[key] = (time.time() + self.cache_ttl_seconds, json.loads(json.dumps(function_calls)))
+        self._decision_cache.move_to_end(key)
+        while len(self._decision_cache) > self.cache_max:
+            self._decision_cache.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        total_short = sum(self.short_circuited.values())
+        return {
+            "turns": self.turns,
+            "short_circuited": dict(self.short_circuited),
+            "short_circuit_share": total_short / self.turns if self.turns else 0.0,
+            "cached_decisions": len(self._decision_cache)
+        }
+
+
+fast_path_router = FastPathRouter()
@@ -0,0 +1,223 @@
+# session_store.py
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional
+
+# --- Configuration ---
+SESSION_STORE = os.getenv("SESSION_STORE", "memory").lower() # "memory" or "sqlite"
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "sessions.db")
+SESSION_MAX = int(os.getenv("SESSION_MAX", "10000"))
+SESSION_TTL_SECONDS = float(os.getenv("SESSION_TTL_SECONDS", "3600"))
+
+
+# --- Session State ---
+class SessionState:
+    """
+    Conversation state for one session: chat history, the sticky function hint and the cached
+    rolling summary of older turns (history_summary covers chat_history[:summarized_upto]).
+    """
+
+    def __init__(
+        self,
+        session_id: str,
+        chat_history: Optional[List[Dict[str, str]]] = None,
+        sticky_hint: Optional[str] = None,
+        last_active: Optional[float] = None,
+        history_summary: str = "",
+        summarized_upto: int = 0
+    ):
+        self.session_id = session_id
+        self.chat_history: List[Dict[str, str]] = chat_history if chat_history is not None else []
+        self.sticky_hint: Optional[str] = sticky_hint
+        self.last_active = last_active if last_active is not None else time.time()
+        self.history_summary = history_summary
+        self.summarized_upto = summarized_upto
+
+    def reset(self):
+        self.chat_history.clear()
+        self.sticky_hint = None
+        self.history_summary = ""
+        self.summarized_upto = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "session_id": self.session_id,
+            "chat_history": self.chat_history,
+            "sticky_hint": self.sticky_hint,
+            "last_active": self.last_active,
+            "history_summary": self.history_summary,
+            "summarized_upto": self.summarized_upto
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "SessionState":
+        return cls(
+            session_id=data["session_id"],
+            chat_history=data.get("chat_history") or [],
+            sticky_hint=data.get("sticky_hint"),
+            last_active=data.get("last_active"),
+            history_summary=data.get("history_summary", ""),
+            summarized_upto=data.get("summarized_upto", 0)
+        )
+
+
+# --- In-Memory Store (LRU + TTL) ---
+class InMemorySessionStore:
+    """
+    Process-local session store bounded by max_sessions (least recently used evicted first)
+    and ttl_seconds (sessions idle longer than this are dropped).
+    """
+
+    def __init__(self, max_sessions: int = SESSION_MAX, ttl_seconds: float = SESSION_TTL_SECONDS):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self._sessions: "OrderedDict[str, SessionState]" = OrderedDict()
+        self.evictions = 0
+
+    def _purge(self, now: float):
+        # OrderedDict is kept in last-access order, so expired sessions are always at the front
+        while self._sessions:
+            oldest_id, oldest = next(iter(self._sessions.items()))
+            expired = self.ttl_seconds > 0 and now - oldest.last_active > self.ttl_seconds
+            if not expired and len(self._sessions) <= self.max_sessions:
+                break
+            del self._sessions[oldest_id]
+            self.evictions += 1
+
+    async def load(self, session_id: str) -> SessionState:
+        """Returns the session, creating a fresh one if it does not exist or has expired."""
+        now = time.time()
+        self._purge(now)
+        session = self._sessions.get(session_id)
+        if session is None:
+            session = SessionState(session_id, last_active=now)
+            self._sessions[session_id] = session
+        session.last_active = now
+        self._sessions.move_to_end(session_id)
+        self._purge(now)
+        return session
+
+    async def save(self, session: SessionState):
+        session.last_active = time.time()
+        self._sessions[session.session_id] = session
+        self._sessions.move_to_end(session.session_id)
+        self._purge(session.last_active)
+
+    async def delete(self, session_id: str):
+        self._sessions.pop(session_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "memory", "sessions": len(self._sessions), "evictions": self.evictions}
+
+
+# --- SQLite Store ---
+class SQLiteSessionStore:
+    """
+    On-disk session store. Sessions survive restarts and can be shared by several
+    uvicorn workers on one host (WAL mode). Blocking SQLite calls run in a thread.
+    The session count in stats() is refreshed by saves, at most every count_refresh_seconds,
+    so /metrics scrapes never query SQLite on the event loop.
+    """
+
+    def __init__(
+        self,
+        db_path: str = SESSION_DB_PATH,
+        max_sessions: int = SESSION_MAX,
+        ttl_seconds: float = SESSION_TTL_SECONDS,
+        purge_every: int = 100,
+        count_refresh_seconds: float = 5.0
+    ):
+        self.db_path = db_path
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.purge_every = purge_every
+        self.count_refresh_seconds = count_refresh_seconds
+        self._writes_since_purge = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " session_id TEXT PRIMARY KEY,"
+            " data TEXT NOT NULL,"
+            " last_active REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_last_active ON sessions(last_active)")
+        self.evictions = 0
+        self._sessions = 0
+        self._counted_at = 0.0
+        self._refresh_count_locked(time.time())
+
+    def _refresh_count_locked(self, now: float):
+        self._sessions = self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+        self._counted_at = now
+
+    def _load_sync(self, session_id: str) -> SessionState:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT data, last_active FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        if row is None or (self.ttl_seconds > 0 and now - row[1] > self.ttl_seconds):
+            return SessionState(session_id, last_active=now)
+        session = SessionState.from_dict(json.loads(row[0]))
+        session.last_active = now
+        return session
+
+    def _save_sync(self, session: SessionState):
+        session.last_active = time.time()
+        data = json.dumps(session.to_dict(), separators=(",", ":"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, data, last_active) VALUES (?, ?, ?)",
+                (session.session_id, data, session.last_active)
+            )
+            self._writes_since_purge += 1
+            if self._writes_since_purge >= self.purge_every:
+                self._writes_since_purge = 0
+                self._purge_locked(session.last_active)
+            if session.last_active - self._counted_at >= self.count_refresh_seconds:
+                self._refresh_count_locked(session.last_active)
+
+    def _purge_locked(self, now: float):
+        removed = 0
+        if self.ttl_seconds > 0:
+            removed += self._conn.execute("DELETE FROM sessions WHERE last_active < ?", (now - self.ttl_seconds,)).rowcount
+        if self.max_sessions > 0:
+            removed += self._conn.execute(
+                "DELETE FROM sessions WHERE session_id IN ("
+                " SELECT session_id FROM sessions ORDER BY last_active DESC LIMIT -1 OFFSET ?)",
+                (self.max_sessions,)
+            ).rowcount
+        self.evictions += max(removed, 0)
+
+    def _delete_sync(self, session_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    async def load(self, session_id: str) -> SessionState:
+        return await asyncio.to_thread(self._load_sync, session_id)
+
+    async def save(self, session: SessionState):
+        await asyncio.to_thread(self._save_sync, session)
+
+    async def delete(self, session_id: str):
+        await asyncio.to_thread(self._delete_sync, session_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "sqlite", "sessions": self._sessions, "evictions": self.evictions}
+
+
+def create_session_store(backend: Optional[str] = None):
+    """Builds the session store selected by SESSION_STORE ('memory' or 'sqlite')."""
+    backend = (backend or SESSION_STORE).lower()
+    if backend == "memory":
+        return InMemorySessionStore()
+    if backend == "sqlite":
+        return SQLiteSessionStore()
+    raise ValueError(f"Unknown session store '{backend}'. Expected 'memory' or 'sqlite'.")
@@ -0,0 +1,155 @@
+# shared_store.py
+
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+
+import fast_json
+
+# --- Configuration ---
+# SHARED_STORE: "none" (default, caches stay process-local), "memory" or "sqlite".
+# With "sqlite", every worker pointed at the same SHARED_STORE_PATH sees the same cache entries.
+SHARED_STORE = os.getenv("SHARED_STORE", "none").lower()
+SHARED_STORE_PATH = os.getenv("SHARED_STORE_PATH", "shared_state.db")
+SHARED_STORE_MAX = int(os.getenv("SHARED_STORE_MAX", "50000"))
+
+
+# --- In-Memory Store ---
+class InMemorySharedStore:
+    """
+    Process-local key/value store with per-entry TTL, bounded by max_entries (LRU).
+    Same interface as SQLiteSharedStore; useful for a single worker and for exercising the shared code path.
+    """
+
+    def __init__(self, max_entries: int = SHARED_STORE_MAX):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[float, str]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, namespace: str, key: str) -> Optional[Any]:
+        entry = self._entries.get((namespace, key))
+        if entry is None or entry[0] < time.time():
+            self._entries.pop((namespace, key), None)
+            self.misses += 1
+            return None
+        self._entries.move_to_end((namespace, key))
+        self.hits += 1
+        return fast_json.loads(entry[1])
+
+    async def set(self, namespace: str, key: str, value: Any, ttl_seconds: float):
+        self._entries[(namespace, key)] = (time.time() + ttl_seconds, fast_json.dumps(value))
+        self._entries.move_to_end((namespace, key))
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def delete(self, namespace: str, key: str):
+        self._entries.pop((namespace, key), None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "memory", "entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+# --- SQLite Store ---
+class SQLiteSharedStore:
+    """
+    Key/value store in one SQLite file (WAL mode), shareable by all uvicorn workers on a host.
+    Values are JSON. Expired rows are purged every purge_every writes, oldest rows beyond max_entries too.
+    Blocking SQLite calls run in a thread. The entry count in stats() is refreshed by writes, at most
+    every count_refresh_seconds, so /metrics scrapes never query SQLite on the event loop.
+    """
+
+    def __init__(self, db_path: str = SHARED_STORE_PATH, max_entries: int = SHARED_STORE_MAX, purge_every: int = 500,
+                 count_refresh_seconds: float = 5.0):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.purge_every = purge_every
+        self.count_refresh_seconds = count_refresh_seconds
+        self._writes_since_purge = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=5.0)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv ("
+            " namespace TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " value TEXT NOT NULL,"
+            " expires_at REAL NOT NULL,"
+            " PRIMARY KEY (namespace, key))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_kv_expires_at ON kv(expires_at)")
+        self.hits = 0
+        self.misses = 0
+        self._entries = 0
+        self._counted_at = 0.0
+        self._refresh_count_locked(time.time())
+
+    def _refresh_count_locked(self, now: float):
+        self._entries = self._conn.execute("SELECT COUNT(*) FROM kv").fetchone()[0]
+        self._counted_at = now
+
+    def _get_sync(self, namespace: str, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM kv WHERE namespace = ? AND key = ? AND expires_at >= ?", (namespace, key, time.time())
+            ).fetchone()
+        return row[0] if row else None
+
+    def _set_sync(self, namespace: str, key: str, value: str, ttl_seconds: float):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO kv (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                (namespace, key, value, now + ttl_seconds)
+            )
+            self._writes_since_purge += 1
+            if self._writes_since_purge >= self.purge_every:
+                self._writes_since_purge = 0
+                self._conn.execute("DELETE FROM kv WHERE expires_at < ?", (now,))
+                self._conn.execute(
+                    "DELETE FROM kv WHERE rowid IN (SELECT rowid FROM kv ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,)
+                )
+            if now - self._counted_at >= self.count_refresh_seconds:
+                self._refresh_count_locked(now)
+
+    def _delete_sync(self, namespace: str, key: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM kv WHERE namespace = ? AND key = ?", (namespace, key))
+
+    async def get(self, namespace: str, key: str) -> Optional[Any]:
+        value = await asyncio.to_thread(self._get_sync, namespace, key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return fast_json.loads(value)
+
+    async def set(self, namespace: str, key: str, value: Any, ttl_seconds: float):
+        await asyncio.to_thread(self._set_sync, namespace, key, fast_json.dumps(value), ttl_seconds)
+
+    async def delete(self, namespace: str, key: str):
+        await asyncio.to_thread(self._delete_sync, namespace, key)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "sqlite", "entries": self._entries, "hits": self.hits, "misses": self.misses}
+
+
+def create_shared_store(backend: Optional[str] = None):
+    """Builds the store selected by SHARED_STORE, or None for 'none'."""
+    backend = (backend or SHARED_STORE).lower()
+    if backend == "none":
+        return None
+    if backend == "memory":
+        return InMemorySharedStore()
+    if backend == "sqlite":
+        return SQLiteSharedStore()
+    raise ValueError(f"Unknown shared store '{backend}'. Expected 'none', 'memory' or 'sqlite'.")
+
+
+shared_store = create_shared_store()
@@ -11,6 +11,9 @@ const resetButton = document.getElementById('reset-button'); // Get reset button
 const adminUnderstanding = document.getElementById('admin-understanding');
 const adminFunctions = document.getElementById('admin-functions');
 const adminSummarization = document.getElementById('admin-summarization');
+const adminPromptTokens = document.getElementById('admin-prompt-tokens');
+const adminTraceId = document.getElementById('admin-trace-id');
+const adminTraceSpans = document.getElementById('admin-trace-spans');
 const adminErrorSection = document.getElementById('admin-error-section');
 const adminErrorMessage = document.getElementById('admin-error-message');
 
@@ -21,6 +24,8 @@ let currentThinkingUl = null;
 let thoughtQueue = [];
 let isProcessingQueue = false;
 let isThinkingGloballyVisible = false;
+let adminState = emptyAdminState(); // Client copy of the server's admin state, kept current by admin_patch ops
+let adminSeq = 0; // Sequence number of the last applied admin_patch
 
 // --- Animation Configuration ---
 const thoughtFadeInDuration = 500;
@@ -30,13 +35,16 @@ const interThoughtDelay = 100;
 // ... (connectWebSocket remains the same) ...
 function connectWebSocket() {
     const wsProtocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-    const wsUrl = `${wsProtocol}//${window.location.host}/ws`;
+    const sessionId = sessionStorage.getItem('sessionId'); // Resume this tab's session on reconnect
+    const sessionQuery = sessionId ? `?session_id=${encodeURIComponent(sessionId)}` : '';
+    const wsUrl = `${wsProtocol}//${window.location.host}/ws${sessionQuery}`;
     console.log(`Connecting to WebSocket: ${wsUrl}`);
 
     websocket = new WebSocket(wsUrl);
 
     websocket.onopen = (event) => {
         console.log("WebSocket connection opened");
+        adminSeq = 0; // Each connection has its own admin_patch sequence
         userInput.disabled = false;
         sendButton.disabled = false;
         resetButton.disabled = false; // Enable reset button on connect
@@ -191,6 +199,27 @@ function processThoughtQueue() {
     }, interThoughtDelay);
 }
 
+// --- Streams answer text into the current message as deltas arrive ---
+function appendResponseDelta(deltaText) {
+    if (!currentAiMessageDiv) {
+        createAiMessageContainer();
+    }
+    const contentDiv = currentAiMessageDiv.querySelector('.message-content');
+    const thinkingPlaceholder = contentDiv.querySelector('.thinking-placeholder');
+    if (thinkingPlaceholder) {
+        contentDiv.removeChild(thinkingPlaceholder);
+    }
+
+    let streamingDiv = contentDiv.querySelector('.ai-response-text.streaming');
+    if (!streamingDiv) {
+        streamingDiv = document.createElement('div');
+        streamingDiv.classList.add('ai-response-text', 'streaming');
+        contentDiv.appendChild(streamingDiv);
+    }
+    streamingDiv.textContent += deltaText;
+    scrollToBottom();
+}
+
 function addFinalResponseToCurrentMessage(aiMessageText, citationsMap) {
      if (!currentAiMessageDiv) {
         console.error("Trying to add final response but no current AI message container exists.");
@@ -203,6 +232,12 @@ function addFinalResponseToCurrentMessage(aiMessageText, citationsMap) {
         contentDiv.removeChild(thinkingPlaceholder);
     }
 
+    // The final text replaces whatever was streamed so far
+    const streamingDiv = contentDiv.querySelector('.ai-response-text.streaming');
+    if (streamingDiv) {
+        contentDiv.removeChild(streamingDiv);
+    }
+
     const responseDiv = document.createElement('div');
     responseDiv.classList.add('ai-response-text');
     aiMessageText.split('\n').forEach(paragraph => {
@@ -312,83 +347,163 @@ function toggleThinking(button) {
     }
 }
 
-function updateAdminPanel(adminData) {
-    adminUnderstanding.innerHTML = '';
+function emptyAdminState() {
+    return {
+        understanding_thoughts: [],
+        function_calls_made: [],
+        summarization_thoughts: [],
+        prompt_tokens: {},
+        trace: null,
+        error: null
+    };
+}
+
+function renderThoughtList(ul, thoughts) {
+    ul.innerHTML = '';
+    (thoughts || []).forEach(thought => appendThoughtItem(ul, thought));
+}
+
+function appendThoughtItem(ul, thought) {
+    const li = document.createElement('li');
+    li.textContent = thought;
+    ul.appendChild(li);
+}
+
+function renderFunctionCalls(calls) {
     adminFunctions.innerHTML = '';
-    adminSummarization.innerHTML = '';
-    adminErrorSection.style.display = 'none';
-    adminErrorMessage.textContent = '';
-
-    // Understanding
-    if (adminData.understanding_thoughts && adminData.understanding_thoughts.length > 0) {
-        adminData.understanding_thoughts.forEach(thought => {
-            const li = document.createElement('li');
-            li.textContent = thought;
-            adminUnderstanding.appendChild(li);
-        });
-    }
+    (calls || []).forEach(call => {
+        const li = document.createElement('li');
+        const callInfoDiv = document.createElement('div');
+        const rawResult = call.raw_result;
+
+        let flagsHTML = '';
+        if (rawResult?.asked_for_sticky) {
+            flagsHTML += `<span class="admin-flag sticky-flag">(Sticky Request)</span> `;
+        }
+        if (rawResult?.rejected) {
+            flagsHTML += `<span class="admin-flag rejected-flag">(Rejected)</span> `;
+        }
 
-    // Function Calling
-    if (adminData.function_calls_made && adminData.function_calls_made.length > 0) {
-        adminData.function_calls_made.forEach(call => {
-            const li = document.createElement('li');
-            const callInfoDiv = document.createElement('div');
-            const rawResult = call.raw_result;
+        const argsString = JSON.stringify(call.all_args || {}, null, 2);
+        callInfoDiv.innerHTML = `<strong>${call.name || 'N/A'}</strong> ${flagsHTML}: ${call.query || 'N/A'}<pre>${argsString}</pre>`;
 
-            let flagsHTML = '';
-            if (rawResult?.asked_for_sticky) {
-                flagsHTML += `<span class="admin-flag sticky-flag">(Sticky Request)</span> `;
-            }
-            if (rawResult?.rejected) {
-                flagsHTML += `<span class="admin-flag rejected-flag">(Rejected)</span> `;
-            }
+        if (rawResult?.rejected && rawResult?.rejection_reason) {
+             const reasonP = document.createElement('p');
+             reasonP.classList.add('admin-rejection-reason');
+             reasonP.textContent = `Reason: ${rawResult.rejection_reason}`;
+             callInfoDiv.appendChild(reasonP);
+        }
 
-            const argsString = JSON.stringify(call.all_args || {}, null, 2);
-            callInfoDiv.innerHTML = `<strong>${call.name || 'N/A'}</strong> ${flagsHTML}: ${call.query || 'N/A'}<pre>${argsString}</pre>`;
+        li.appendChild(callInfoDiv);
+
+        if (rawResult !== undefined && rawResult !== null) {
+            const details = document.createElement('details');
+            details.classList.add('admin-raw-result');
+            const summary = document.createElement('summary');
+            summary.textContent = 'Show Raw Result / Details';
+            details.appendChild(summary);
+            const resultPre = document.createElement('pre');
+            resultPre.textContent = JSON.stringify(rawResult, null, 2);
+            details.appendChild(resultPre);
+            li.appendChild(details);
+        } else {
+             const pendingSpan = document.createElement('span');
+             pendingSpan.classList.add('admin-pending-result');
+             pendingSpan.textContent = ' (Result pending...)';
+             callInfoDiv.appendChild(pendingSpan);
+        }
+        adminFunctions.appendChild(li);
+    });
+}
 
-            if (rawResult?.rejected && rawResult?.rejection_reason) {
-                 const reasonP = document.createElement('p');
-                 reasonP.classList.add('admin-rejection-reason');
-                 reasonP.textContent = `Reason: ${rawResult.rejection_reason}`;
-                 callInfoDiv.appendChild(reasonP);
-            }
+function renderPromptTokens(promptTokens) {
+    // Prompt token estimates per stage
+    adminPromptTokens.innerHTML = '';
+    Object.values(promptTokens || {}).forEach(stats => {
+        const li = document.createElement('li');
+        const sections = Object.entries(stats.sections || {})
+            .map(([name, tokens]) => `${name}: ${tokens}`)
+            .join(', ');
+        li.textContent = `${stats.stage}: ~${stats.prompt_tokens} tokens${sections ? ` (${sections})` : ''}`;
+        adminPromptTokens.appendChild(li);
+    });
+}
 
-            li.appendChild(callInfoDiv);
-
-            if (rawResult !== undefined && rawResult !== null) {
-                const details = document.createElement('details');
-                details.classList.add('admin-raw-result');
-                const summary = document.createElement('summary');
-                summary.textContent = 'Show Raw Result / Details';
-                details.appendChild(summary);
-                const resultPre = document.createElement('pre');
-                resultPre.textContent = JSON.stringify(rawResult, null, 2);
-                details.appendChild(resultPre);
-                li.appendChild(details);
-            } else {
-                 const pendingSpan = document.createElement('span');
-                 pendingSpan.classList.add('admin-pending-result');
-                 pendingSpan.textContent = ' (Result pending...)';
-                 callInfoDiv.appendChild(pendingSpan);
-            }
-            adminFunctions.appendChild(li);
-        });
-    }
+function renderTrace(trace) {
+    // Trace id (matches the server log) and per-stage span durations
+    adminTraceId.textContent = trace ? `Trace ID: ${trace.trace_id}` : '';
+    adminTraceSpans.innerHTML = '';
+    Object.entries(trace?.spans_ms || {}).forEach(([name, ms]) => {
+        const li = document.createElement('li');
+        li.textContent = `${name}: ${ms} ms`;
+        adminTraceSpans.appendChild(li);
+    });
+}
 
-    // Summarization
-    if (adminData.summarization_thoughts && adminData.summarization_thoughts.length > 0) {
-        adminData.summarization_thoughts.forEach(thought => {
-            const li = document.createElement('li');
-            li.textContent = thought;
-            adminSummarization.appendChild(li);
-        });
-    }
+function renderAdminError(error) {
+    adminErrorMessage.textContent = error || '';
+    adminErrorSection.style.display = error ? 'block' : 'none';
+}
+
+const adminSectionRenderers = {
+    understanding_thoughts: () => renderThoughtList(adminUnderstanding, adminState.understanding_thoughts),
+    function_calls_made: () => renderFunctionCalls(adminState.function_calls_made),
+    summarization_thoughts: () => renderThoughtList(adminSummarization, adminState.summarization_thoughts),
+    prompt_tokens: () => renderPromptTokens(adminState.prompt_tokens),
+    trace: () => renderTrace(adminState.trace),
+    error: () => renderAdminError(adminState.error)
+};
+
+function updateAdminPanel(adminData) {
+    adminState = Object.assign(emptyAdminState(), adminData);
+    Object.values(adminSectionRenderers).forEach(render => render());
+}
 
-     // Error
-    if (adminData.error) {
-        adminErrorMessage.textContent = adminData.error;
-        adminErrorSection.style.display = 'block';
+function resolveAdminPath(path) {
+    return path.reduce((node, key) => node[key], adminState);
+}
+
+// Applies one admin_patch message. Thought appends are added to the DOM directly; any other
+// change re-renders only the admin sections it touched.
+function applyAdminPatch(patch) {
+    const ops = patch.ops || [];
+    const startsWithReset = ops.length > 0 && ops[0].op === 'reset';
+    if (patch.seq !== adminSeq + 1 && !startsWithReset) {
+        console.warn(`Admin patch sequence gap (expected ${adminSeq + 1}, got ${patch.seq}); requesting resync.`);
+        adminSeq = patch.seq;
+        websocket.send(JSON.stringify({ type: 'admin_resync' }));
+        return;
     }
+    adminSeq = patch.seq;
+
+    const rerender = new Set();
+    const appendedThoughts = [];
+    ops.forEach(op => {
+        if (op.op === 'reset') {
+            adminState = Object.assign(emptyAdminState(), op.value);
+            Object.keys(adminSectionRenderers).forEach(section => rerender.add(section));
+            return;
+        }
+        const section = op.path[0];
+        if (op.op === 'append') {
+            resolveAdminPath(op.path).push(op.value);
+            if (section === 'understanding_thoughts' || section === 'summarization_thoughts') {
+                appendedThoughts.push([section, op.value]);
+            } else {
+                rerender.add(section);
+            }
+        } else if (op.op === 'set') {
+            resolveAdminPath(op.path.slice(0, -1))[op.path[op.path.length - 1]] = op.value;
+            rerender.add(section);
+        }
+    });
+
+    rerender.forEach(section => adminSectionRenderers[section]?.());
+    appendedThoughts.forEach(([section, thought]) => {
+        if (!rerender.has(section)) { // A re-rendered section already includes it
+            appendThoughtItem(section === 'understanding_thoughts' ? adminUnderstanding : adminSummarization, thought);
+        }
+    });
 }
 
 function scrollToBottom() {
@@ -401,14 +516,20 @@ function scrollToBottom() {
 // --- WebSocket Message Handler (MODIFIED for system_message) ---
 function handleWebSocketMessage(data) {
     switch (data.type) {
+        case 'session':
+            sessionStorage.setItem('sessionId', data.data.session_id);
+            break;
         case 'thought':
             queueThoughtOrStatusForAnimation(data.data, false);
             break;
         case 'status':
              queueThoughtOrStatusForAnimation(data.data, true);
             break;
-        case 'admin_update':
-            updateAdminPanel(data.data);
+        case 'admin_patch':
+            applyAdminPatch(data.data);
+            break;
+        case 'final_response_delta':
+            appendResponseDelta(data.data);
             break;
         case 'final_response':
             addFinalResponseToCurrentMessage(data.data.ai_message, data.data.citations);
@@ -431,6 +552,10 @@ function handleWebSocketMessage(data) {
         case 'system_message':
             console.log("Received system message:", data.data);
             addSystemMessageToChat(data.data);
+            // A reset may have cancelled a turn in progress; accept input again
+            userInput.disabled = false;
+            sendButton.disabled = false;
+            resetButton.disabled = false;
             break;
         // -------------------------------------------------------------
         default:
@@ -451,7 +576,7 @@ chatForm.addEventListener('submit', async (e) => {
     userInput.value = '';
     userInput.disabled = true;
     sendButton.disabled = true;
-    resetButton.disabled = true; // Disable reset during processing
+    // Reset stays enabled during processing: the server cancels the turn in progress
 
     currentAiMessageDiv = null;
     currentThinkingUl = null;
@@ -0,0 +1,192 @@
+# structured_log.py
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+from typing import Dict, Any, Optional
+
+# --- Configuration ---
+# LOG_LEVEL: DEBUG, INFO (default), WARNING, ERROR or OFF.
+# LOG_FORMAT: "text" keeps the familiar "Main: ..." / "Helper WARNING: ..." lines, "json" writes one object per line.
+# LOG_ASYNC=1 (default): records go through a bounded queue to a writer thread, so a slow stdout
+# (a pipe to a log collector) never blocks the event loop. When the queue is full records are dropped and counted.
+# LOG_SAMPLE_RATES: fraction of records kept per sample key, for high-volume messages
+# Keys in use: "thought" (per model thought, DEBUG), "parse_warning" (per unparseable JSON line), "stub" (per retrieval call).
+# Deterministic: rate 0.1 keeps every 10th record.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+LOG_ASYNC = os.getenv("LOG_ASYNC", "1") == "1"
+LOG_QUEUE_MAX = int(os.getenv("LOG_QUEUE_MAX", "10000"))
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "thought=0.1,parse_warning=0.1")
+
+ROOT_LOGGER = "qb"
+
+
+def parse_sample_rates(spec: str) -> Dict[str, float]:
+    rates = {}
+    for part in spec.split(","):
+        if "=" in part:
+            key, value = part.split("=", 1)
+            rates[key.strip()] = min(max(float(value), 0.0), 1.0)
+    return rates
+
+
+# --- Formatters ---
+def _component(record: logging.LogRecord) -> str:
+    return record.name.split(".", 1)[1] if record.name.startswith(ROOT_LOGGER + ".") else record.name
+
+
+class TextFormatter(logging.Formatter):
+    """'Main: message' for INFO/DEBUG, 'Main WARNING: message' otherwise, like the print lines it replaces."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        message = record.getMessage()
+        if record.levelno >= logging.WARNING:
+            line = f"{_component(record)} {record.levelname}: {message}"
+        else:
+            line = f"{_component(record)}: {message}"
+        if record.exc_info:
+            record.exc_text = record.exc_text or self.formatException(record.exc_info)
+        if record.exc_text:
+            line += "\n" + record.exc_text
+        return line
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per record: ts, level, component, msg, any extra={"fields": {...}}, and exc."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        import fast_json # Not at module level: fast_json logs through this module while it loads
+        entry = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "component": _component(record),
+            "msg": record.getMessage()
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            record.exc_text = record.exc_text or self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return fast_json.dumps(entry)
+
+
+# --- Sampling ---
+class SamplingFilter(logging.Filter):
+    """Keeps 1 in round(1/rate) records per extra={"sample": key}; records without a sample key always pass."""
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+        self._seen: Dict[str, int] = {}
+        self.sampled_out: Dict[str, int] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = getattr(record, "sample", None)
+        if key is None or key not in self.rates:
+            return True
+        rate = self.rates[key]
+        seen = self._seen.get(key, 0)
+        self._seen[key] = seen + 1
+        if rate > 0 and seen % max(1, round(1 / rate)) == 0:
+            return True
+        self.sampled_out[key] = self.sampled_out.get(key, 0) + 1
+        return False
+
+
+# --- Queue Handler ---
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never blocks: a record that does not fit in the queue is dropped and counted."""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.enqueued = 0
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+            self.enqueued += 1
+        except queue.Full:
+            self.dropped += 1
+
+
+class StructuredLogging:
+    """
+    Owns the 'qb' logger tree; components log through get_logger(name).
+    With a queue, QueueHandler.prepare formats each record in the caller and the listener thread only writes it.
+    """
+
+    def __init__(self, level: str = LOG_LEVEL, fmt: str = LOG_FORMAT, use_queue: bool = LOG_ASYNC,
+                 queue_max: int = LOG_QUEUE_MAX, sample_rates: Optional[Dict[str, float]] = None, stream=None):
+        self.level = level
+        self.format = fmt
+        self.use_queue = use_queue
+        self.stream = stream or sys.stdout
+        self.sampling = SamplingFilter(parse_sample_rates(LOG_SAMPLE_RATES) if sample_rates is None else sample_rates)
+        self.write_seconds = 0.0
+        self.written = 0
+        self._listener: Optional[logging.handlers.QueueListener] = None
+
+        formatter = JSONFormatter() if fmt == "json" else TextFormatter()
+        self.writer = logging.StreamHandler(self.stream)
+        self.writer.setFormatter(logging.Formatter("%(message)s") if use_queue else formatter)
+        original_emit = self.writer.emit
+
+        def timed_emit(record):
+            started = time.perf_counter()
+            original_emit(record)
+            self.write_seconds += time.perf_counter() - started
+            self.written += 1
+        self.writer.emit = timed_emit
+
+        if use_queue:
+            self.handler = DroppingQueueHandler(queue.Queue(maxsize=queue_max))
+            self.handler.setFormatter(formatter)
+            self._listener = logging.handlers.QueueListener(self.handler.queue, self.writer)
+            self._listener.start()
+            atexit.register(self.shutdown)
+        else:
+            self.handler = self.writer
+        self.handler.addFilter(self.sampling)
+
+        self.root = logging.getLogger(ROOT_LOGGER)
+        self.root.handlers = [self.handler]
+        self.root.propagate = False
+        self.root.setLevel(logging.CRITICAL + 1 if level == "OFF" else getattr(logging, level, logging.INFO))
+
+    def get_logger(self, component: str) -> logging.Logger:
+        return self.root.getChild(component)
+
+    def shutdown(self):
+        """Flushes queued records and stops the writer thread."""
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "level": self.level,
+            "format": self.format,
+            "async": self.use_queue,
+            "queue_depth": self.handler.queue.qsize() if self.use_queue else 0,
+            "enqueued": getattr(self.handler, "enqueued", 0),
+            "dropped": getattr(self.handler, "dropped", 0),
+            "written": self.written,
+            "write_seconds": round(self.write_seconds, 6),
+            "sampled_out": dict(self.sampling.sampled_out)
+        }
+
+
+structured_logging = StructuredLogging()
+
+
+def get_logger(component: str) -> logging.Logger:
+    """Logger whose records are prefixed with component, e.g. get_logger("Main")."""
+    return structured_logging.get_logger(component)
@@ -0,0 +1,191 @@
+# vector_store.py
+
+import asyncio
+import json
+import os
+import re
+import threading
+from typing import List, Dict, Any, Optional, Tuple
+
+import embeddings
+from batching import MicroBatcher, MICRO_BATCHING
+from structured_log import get_logger
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+log = get_logger("Vector Store")
+
+# --- Configuration ---
+RETRIEVAL_INDEX_DIR = os.getenv("RETRIEVAL_INDEX_DIR", "retrieval_index")
+# "auto": use a tool's index when one exists, else the LLM simulation; "vector" / "llm" force one path
+RETRIEVAL_BACKEND = os.getenv("RETRIEVAL_BACKEND", "auto").lower()
+RETRIEVAL_MIN_SCORE = float(os.getenv("RETRIEVAL_MIN_SCORE", "0.2"))
+
+INDEX_FILE = "index.faiss"
+CHUNKS_FILE = "chunks.jsonl"
+META_FILE = "meta.json"
+NAMESPACE_PATTERN = re.compile(r"^[A-Za-z0-9_\-]+$")
+
+
+def vector_search_available() -> bool:
+    return faiss is not None and embeddings.embeddings_available()
+
+
+def namespace_dir(index_dir: str, namespace: str) -> str:
+    if not NAMESPACE_PATTERN.match(namespace):
+        raise ValueError(f"Invalid retrieval namespace '{namespace}'")
+    return os.path.join(index_dir, namespace)
+
+
+# --- Namespace Index ---
+class NamespaceIndex:
+    """One tool's faiss index (memory-mapped when supported) and its chunk metadata."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, META_FILE), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        index_path = os.path.join(path, INDEX_FILE)
+        self.mtime_ns = os.stat(index_path).st_mtime_ns
+        try:
+            self.index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except Exception:
+            self.index = faiss.read_index(index_path) # Index type without mmap support
+        self.chunks: List[Dict[str, str]] = []
+        with open(os.path.join(path, CHUNKS_FILE), "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    self.chunks.append(json.loads(line))
+
+    def search_vectors(self, query_vectors, top_k: int, min_score: float) -> List[List[Dict[str, Any]]]:
+        """
+        Searches a batch of query vectors. Returns, per query, up to top_k chunks in the
+        {chunk_content, source_article, source_link} shape, at most one per source_link.
+        """
+        candidates = min(top_k * 3, len(self.chunks)) # Over-fetch so per-article dedup can still fill top_k
+        if candidates == 0:
+            return [[] for _ in range(len(query_vectors))]
+        scores, ids = self.index.search(query_vectors, candidates)
+        results = []
+        for row_scores, row_ids in zip(scores, ids):
+            seen_links = set()
+            hits = []
+            hit_scores = []
+            for score, chunk_id in zip(row_scores.tolist(), row_ids.tolist()):
+                if chunk_id < 0 or score < min_score:
+                    continue
+                chunk = self.chunks[chunk_id]
+                if chunk["source_link"] in seen_links:
+                    continue
+                seen_links.add(chunk["source_link"])
+                hits.append({
+                    "chunk_content": chunk["chunk_content"],
+                    "source_article": chunk["source_article"],
+                    "source_link": chunk["source_link"]
+                })
+                hit_scores.append(round(score, 4))
+                if len(hits) >= top_k:
+                    break
+            # Scores stay out of the hits so they match the LLM-simulated chunks downstream
+            log.debug(f"{os.path.basename(self.path)}: {len(hits)} hits, scores {hit_scores}")
+            results.append(hits)
+        return results
+
+
+# --- Vector Store ---
+class VectorStore:
+    """
+    Local retrieval engine over per-tool namespaces built by ingest.py
+    (<index_dir>/<namespace>/{index.faiss, chunks.jsonl, meta.json}).
+    Namespaces are loaded lazily on first use, and reloaded when ingest.py has swapped in a new index
+    (its index file's mtime changed), so re-ingesting doesn't need a server restart.
+    """
+
+    def __init__(self, index_dir: str = RETRIEVAL_INDEX_DIR, min_score: float = RETRIEVAL_MIN_SCORE):
+        self.index_dir = index_dir
+        self.min_score = min_score
+        self._namespaces: Dict[str, NamespaceIndex] = {}
+        self._namespaces_lock = threading.Lock() # get_namespace/reload run in to_thread workers
+        self._batchers: Dict[str, MicroBatcher] = {}
+
+    def has_namespace(self, namespace: str) -> bool:
+        if not vector_search_available():
+            return False
+        try:
+            path = namespace_dir(self.index_dir, namespace)
+        except ValueError:
+            return False
+        return os.path.exists(os.path.join(path, INDEX_FILE))
+
+    def get_namespace(self, namespace: str) -> NamespaceIndex:
+        # Check, load and publish under one lock so concurrent searches load each index once
+        with self._namespaces_lock:
+            index = self._namespaces.get(namespace)
+            if index is not None:
+                mtime_ns = self._index_mtime_ns(namespace)
+                # None: ingest.py is mid-swap; keep serving the loaded index until the new one is in place
+                if mtime_ns is not None and mtime_ns != index.mtime_ns:
+                    log.info(f"Namespace '{namespace}' was re-ingested, reloading.")
+                    index = None
+            if index is None:
+                index = NamespaceIndex(namespace_dir(self.index_dir, namespace))
+                self._namespaces[namespace] = index
+                log.info(f"Loaded namespace '{namespace}' ({len(index.chunks)} chunks).")
+            return index
+
+    def _index_mtime_ns(self, namespace: str) -> Optional[int]:
+        try:
+            return os.stat(os.path.join(namespace_dir(self.index_dir, namespace), INDEX_FILE)).st_mtime_ns
+        except OSError:
+            return None
+
+    def reload(self, namespace: Optional[str] = None):
+        """Drops a loaded namespace (all of them if None) so the next search reads it from disk."""
+        with self._namespaces_lock:
+            if namespace is None:
+                self._namespaces.clear()
+            else:
+                self._namespaces.pop(namespace, None)
+
+    def search_many_sync(self, namespace: str, requests: List[Tuple[str, int]]) -> List[List[Dict[str, Any]]]:
+        """Embeds and searches a batch of (query, top_k) requests with one encode and one faiss call."""
+        index = self.get_namespace(namespace)
+        query_vectors = embeddings.embed_texts([query for query, _ in requests])
+        max_k = max(top_k for _, top_k in requests)
+        results = index.search_vectors(query_vectors, max_k, self.min_score)
+        return [hits[:top_k] for hits, (_, top_k) in zip(results, requests)]
+
+    def _batcher(self, namespace: str) -> MicroBatcher:
+        batcher = self._batchers.get(namespace)
+        if batcher is None:
+            async def process(requests, namespace=namespace):
+                return await asyncio.to_thread(self.search_many_sync, namespace, requests)
+            batcher = self._batchers[namespace] = MicroBatcher(process, name=f"vector_search:{namespace}")
+        return batcher
+
+    async def search(self, namespace: str, query: str, top_k: int) -> List[Dict[str, Any]]:
+        """
+        Embeds the query and searches the namespace off the event loop. Concurrent searches of the
+        same namespace are micro-batched into one embedding/faiss call when MICRO_BATCHING=1.
+        """
+        if not MICRO_BATCHING:
+            return (await asyncio.to_thread(self.search_many_sync, namespace, [(query, top_k)]))[0]
+        return await self._batcher(namespace).submit((query, top_k))
+
+    def stats(self) -> Dict[str, Any]:
+        return {namespace: batcher.stats() for namespace, batcher in self._batchers.items()}
+
+
+vector_store = VectorStore()
+
+
+def use_vector_retrieval(function_name: str) -> bool:
+    """Whether simulate_retrieval_stub should answer this tool from the local index."""
+    if RETRIEVAL_BACKEND == "llm":
+        return False
+    if RETRIEVAL_BACKEND == "vector":
+        return True
+    return vector_store.has_namespace(function_name)